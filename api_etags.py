@@ -0,0 +1,73 @@
+"""
+Conditional GET (ETag / If-None-Match) for the read APIs
+
+Pages such as viewboard.html and myboards.html fetch the same boards and posts over and over,
+and every fetch used to sort, read and serialize the full payload even when nothing had
+changed. AppDB gives every board, post and the board list a version stamp (the versions
+collection), replaced after each write to it. The read APIs build a strong ETag from the
+stamps their payload depends on (and the viewer, for payloads saying whether they subscribed
+or upvoted), which costs one small read. A request whose If-None-Match holds that ETag is
+answered 304 Not Modified before any of the heavy queries are made.
+
+Responses are sent with "Cache-Control: private, no-cache", so browsers keep them but
+revalidate every time; jQuery's requests then get the cached payload back on a 304 without
+any change to the scripts.
+"""
+
+import hashlib
+
+import flask
+
+import server_metrics
+
+# Changed whenever the payloads of the read APIs change shape, so clients drop the copies they hold
+PAYLOAD_FORMAT = "3"
+
+
+def make_etag(*parts):
+    """
+    Builds a strong ETag
+
+    Parameters:
+     - parts: everything the payload depends on (version stamps, the viewer's id, ...)
+    Returns:
+     - The ETag, unquoted
+    """
+    digest = hashlib.blake2b(digest_size=12)
+    for part in (PAYLOAD_FORMAT,) + parts:
+        digest.update(str(part).encode("utf8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def not_modified(etag: str):
+    """
+    Answers a request that already holds the current payload
+
+    Parameters:
+     - etag: the current ETag of the payload
+    Returns:
+     - A 304 response if the request's If-None-Match matches the ETag, otherwise None
+    """
+    # Weak comparison, as compressed responses carry the weak form of the ETag (see compression.py)
+    if not flask.request.if_none_match.contains_weak(etag):
+        server_metrics.record_cache("etags", False)
+        return None
+    server_metrics.record_cache("etags", True)
+    return tagged(flask.Response(status=304), etag)
+
+
+def tagged(response, etag: str):
+    """
+    Sets the ETag and caching headers of a response
+
+    Parameters:
+     - response: anything a view function may return
+     - etag: the ETag of the payload
+    Returns:
+     - The response object
+    """
+    response = flask.make_response(response)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
@@ -0,0 +1,100 @@
+"""
+Fast JSON encoding of API responses
+
+The API used to serialize documents with bson.json_util.dumps, which walks every document in
+Python to turn BSON types into MongoDB extended JSON ({"$oid": ...}, {"$date": ...}) before
+encoding it, so board payloads with thousands of upvoter ids spent most of their time there.
+Here, documents are encoded directly by orjson when it is installed, or else by the json
+module's C encoder, both of which only call back into Python for the values they do not know:
+ - ObjectId becomes its 24 character hex string
+ - datetime becomes an ISO 8601 string in UTC with milliseconds, "2021-04-01T12:30:00.000Z"
+   (MongoDB dates are UTC, and naive datetimes read from it are taken as UTC)
+ - date becomes "2021-04-01"
+ - any other BSON type is encoded as json_util would
+The output is compact (no spaces) and keeps non-ASCII characters as UTF-8, and is the same
+with either encoder.
+"""
+
+import datetime
+import json
+
+import flask
+from bson import json_util
+from bson.objectid import ObjectId
+
+try:
+    import orjson
+except ImportError: # Optional, the json module is used without it
+    orjson = None
+
+
+def _default(value):
+    """
+    Converts the values the json module cannot encode itself
+    """
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return value.isoformat(timespec="milliseconds") + "Z"
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return json_util.default(value)
+
+
+# Shared by every thread; encoding keeps no state in the encoder
+_encoder = json.JSONEncoder(default=_default, ensure_ascii=False, separators=(",", ":"))
+
+# Dates are handed to _default too, so that they are formatted the same as with the json module
+_ORJSON_OPTIONS = (orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS) if orjson is not None else 0
+
+
+def encode_json(obj):
+    """
+    Encodes an API payload with the json module
+
+    Returns:
+     - The JSON string
+    """
+    return _encoder.encode(obj)
+
+
+def encode_orjson(obj):
+    """
+    Encodes an API payload with orjson, which must be installed
+
+    Returns:
+     - The UTF-8 encoded JSON
+    """
+    return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+
+
+# The fastest encoder available
+_encode = encode_orjson if orjson is not None else encode_json
+
+
+def dumps(obj):
+    """
+    Encodes an API payload
+
+    Parameters:
+     - obj: the payload, which may hold ObjectIds, datetimes and other BSON types
+    Returns:
+     - The JSON string
+    """
+    data = _encode(obj)
+    return data.decode("utf8") if isinstance(data, bytes) else data
+
+
+def response(obj, status: int = 200):
+    """
+    Builds a JSON response of an API payload
+
+    Parameters:
+     - obj: the payload (see dumps)
+     - status: the HTTP status
+    Returns:
+     - The Flask response
+    """
+    return flask.Response(_encode(obj), status=status, mimetype="application/json")
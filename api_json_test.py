@@ -0,0 +1,76 @@
+"""
+Unit tests for the API JSON encoder
+
+To run the tests on this file do the following:
+    Basic test:
+        $ python3 api_json_test.py
+    Verbose test to see each test function's success or failure:
+        $ python3 -m unittest -v api_json_test.py
+"""
+
+import datetime
+import json
+import unittest
+
+from bson import json_util
+from bson.int64 import Int64
+from bson.objectid import ObjectId
+
+import api_json
+
+
+class ApiJsonTests(unittest.TestCase):
+    """
+    Unit test driver for api_json.py
+    """
+
+    def test_bson_types(self):
+        """
+        Tests that ObjectIds and dates become plain strings
+        """
+        oid = ObjectId("5f9b3b3b9d3b3b3b3b3b3b3b")
+        payload = {"_id": oid,
+                   "ids": [oid, oid],
+                   "naive": datetime.datetime(2021, 4, 1, 12, 30, 0, 123456),
+                   "aware": datetime.datetime(2021, 4, 1, 14, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=2))),
+                   "day": datetime.date(2021, 4, 1),
+                   "count": Int64(3)}
+        self.assertEqual({"_id": "5f9b3b3b9d3b3b3b3b3b3b3b",
+                          "ids": ["5f9b3b3b9d3b3b3b3b3b3b3b", "5f9b3b3b9d3b3b3b3b3b3b3b"],
+                          "naive": "2021-04-01T12:30:00.123Z",
+                          "aware": "2021-04-01T12:30:00.000Z",
+                          "day": "2021-04-01",
+                          "count": 3}, json.loads(api_json.dumps(payload)))
+
+    def test_compact_utf8(self):
+        """
+        Tests that the output has no spaces and keeps non-ASCII characters
+        """
+        self.assertEqual('{"a":[1,2],"b":"é"}', api_json.dumps({"a": [1, 2], "b": "é"}))
+
+    def test_other_types_match_json_util(self):
+        """
+        Tests that BSON types without a plain form are encoded as json_util would
+        """
+        value = json_util.loads('{"$numberDecimal": "1.5"}')
+        self.assertEqual(json.loads(json_util.dumps({"v": value})), json.loads(api_json.dumps({"v": value})))
+
+    @unittest.skipIf(api_json.orjson is None, "orjson is not installed")
+    def test_encoders_agree(self):
+        """
+        Tests that orjson and the json module produce the same JSON
+        """
+        payload = {"_id": ObjectId(), "date": datetime.datetime(2021, 4, 1, 12, 30), "day": datetime.date(2021, 4, 1),
+                   "posts": [{"n": i, "f": 1.5, "ok": True, "none": None, "text": "é\n\"x\""} for i in range(3)], "count": Int64(3)}
+        self.assertEqual(api_json.encode_json(payload), api_json.encode_orjson(payload).decode("utf8"))
+
+    def test_unknown_type(self):
+        """
+        Tests that values with no JSON form are still refused
+        """
+        with self.assertRaises(TypeError):
+            api_json.dumps({"v": object()})
+
+
+if __name__ == "__main__":
+    unittest.main()
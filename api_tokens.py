@@ -0,0 +1,112 @@
+"""
+HMAC signed bearer tokens for API clients
+
+Scripts and integrations authenticate API requests with an "Authorization: Bearer <token>"
+header instead of logging in through /login.html, which costs a password hash (see
+password_hasher.py) and a form post with its CSRF token. A user creates a token once from
+a logged in session (POST /api/tokens) and the client keeps using it until it is revoked.
+
+A token is "<token id>.<signature>", the signature being the HMAC-SHA256 of the token id
+with the "api_token_secret" config entry (the Flask secret key by default). Only the
+token's metadata (owner, name, revocation) is stored in the api_tokens collection, so the
+database never holds anything a client could authenticate with. Signatures are checked in
+constant time before the database is involved, so forged tokens cost no reads.
+
+Each server process caches the claims of the tokens it has seen for "api_token_cache_seconds",
+including the tokens found to be revoked (the revocation list), so a client's requests do
+not read the token or its user again. Revoking a token takes effect at once in the process
+that revoked it and within the cache time in the others.
+"""
+
+import hashlib
+import hmac
+import threading
+import time
+
+from bson.objectid import ObjectId
+
+import server_metrics
+
+# Most tokens a process keeps in its cache
+MAX_CACHED_TOKENS = 10000
+
+
+def sign(secret: str, token_id: str):
+    """
+    Returns the signature of a token id
+    """
+    return hmac.new(secret.encode("utf8"), token_id.encode("utf8"), hashlib.sha256).hexdigest()
+
+
+def make_token(secret: str, token_id: ObjectId):
+    """
+    Builds the bearer token of a token id
+
+    Parameters:
+     - secret: the signing secret
+     - token_id: the ID of the token's api_tokens entry
+    Returns:
+     - The token string
+    """
+    return "%s.%s" % (token_id, sign(secret, str(token_id)))
+
+
+def parse_token(secret: str, token: str):
+    """
+    Checks the signature of a bearer token, in constant time
+
+    Parameters:
+     - secret: the signing secret
+     - token: the token string
+    Returns:
+     - The token id, or None if the token is malformed or its signature does not match
+    """
+    token_id, _, signature = (token or "").partition(".")
+    if not hmac.compare_digest(sign(secret, token_id), signature):
+        return None
+    try:
+        return ObjectId(token_id)
+    except Exception:
+        return None
+
+
+class TokenCache:
+    """
+    Caches the session claims of tokens, or None for revoked and unknown tokens.
+    Safe to share between threads
+    """
+
+    def __init__(self, ttl: float, max_entries: int = MAX_CACHED_TOKENS):
+        """
+        Parameters:
+         - ttl: seconds an entry is trusted
+         - max_entries: entries kept before the oldest are dropped
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, token_id: ObjectId):
+        """
+        Returns:
+         - A (found, claims) pair; claims is None for a revoked or unknown token
+        """
+        with self.lock:
+            entry = self.entries.get(token_id)
+        found = entry is not None and entry[0] >= time.monotonic()
+        server_metrics.record_cache("api_tokens", found)
+        return (True, entry[1]) if found else (False, None)
+
+    def put(self, token_id: ObjectId, claims: dict):
+        with self.lock:
+            self.entries.pop(token_id, None)
+            while len(self.entries) >= self.max_entries:
+                del self.entries[next(iter(self.entries))] # Oldest first
+            self.entries[token_id] = (time.monotonic() + self.ttl, claims)
+
+    def revoke(self, token_id: ObjectId):
+        """
+        Remembers that a token was revoked
+        """
+        self.put(token_id, None)
@@ -0,0 +1,92 @@
+"""
+Benchmarks password verification (logins) across password hasher processes
+
+A login verifies one sha256_crypt hash, which is CPU bound. This hashes a password once,
+then verifies it from many concurrent threads (standing in for the request threads of a
+server process), first in the calling threads (processes 0) and then with increasing
+numbers of password hasher processes. For each, we report logins per second, latency
+percentiles and the number of logins turned away because max pending was reached.
+
+To run the benchmark:
+    $ python3 auth_bench.py --logins 200 --processes 0,1,2,4,8 --rounds 535000
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import password_hasher
+
+
+def percentile(values: list, p: float):
+    """
+    Returns the p-th percentile of a sorted list of values
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(hasher: password_hasher.PasswordHasher, hash_value: str, logins: int, threads: int):
+    """
+    Verifies the password logins times from threads concurrent threads
+
+    Returns:
+     - The elapsed seconds, the latencies of the accepted logins (sorted) and the number rejected
+    """
+    def login(_):
+        start = time.perf_counter()
+        try:
+            if not hasher.verify("bench-password", hash_value):
+                raise SystemExit("The password did not verify")
+        except password_hasher.PasswordHasherBusy:
+            return None
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        start = time.perf_counter()
+        latencies = list(pool.map(login, range(logins)))
+        elapsed = time.perf_counter() - start
+    accepted = sorted(l for l in latencies if l is not None)
+    return elapsed, accepted, len(latencies) - len(accepted)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks password verification across password hasher processes")
+    parser.add_argument("--logins", type=int, default=200, help="number of logins per run")
+    parser.add_argument("--processes", default="0,1,2,4", help="comma separated hasher process counts to try (0 hashes in the calling threads)")
+    parser.add_argument("--threads", type=int, default=16, help="concurrent logins (server request threads)")
+    parser.add_argument("--max-pending", type=int, default=0, help="max pending hashes before logins are turned away (default: --threads, none turned away)")
+    parser.add_argument("--rounds", type=int, default=password_hasher.DEFAULT_ROUNDS, help="sha256_crypt rounds")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    hash_value = password_hasher.hash_password("bench-password", "benchsaltbenchsa", args.rounds)
+    max_pending = args.max_pending or args.threads
+    print("%d CPU cores, %d rounds" % (os.cpu_count(), args.rounds))
+    results = {}
+    print("%-10s %12s %10s %10s %10s" % ("processes", "logins/sec", "p50_ms", "p95_ms", "rejected"))
+    for processes in [int(p) for p in args.processes.split(",")]:
+        hasher = password_hasher.PasswordHasher(processes, max_pending, args.rounds)
+        if processes > 0:
+            run(hasher, hash_value, processes, processes) # Start every process before timing
+        elapsed, accepted, rejected = run(hasher, hash_value, args.logins, args.threads)
+        hasher.close()
+        results[str(processes)] = {"seconds": round(elapsed, 3),
+                                   "logins_per_sec": round(len(accepted) / elapsed, 1),
+                                   "p50_ms": round(percentile(accepted, 50) * 1000, 1),
+                                   "p95_ms": round(percentile(accepted, 95) * 1000, 1),
+                                   "rejected": rejected}
+        print("%-10d %12.1f %10.1f %10.1f %10d" % (processes, len(accepted) / elapsed, percentile(accepted, 50) * 1000,
+                                                 percentile(accepted, 95) * 1000, rejected))
+
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump({"config": vars(args), "cpu_count": os.cpu_count(), "results": results}, outfile, indent=4)
+        print("Results written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Compresses responses with gzip or brotli
+
+Board and post payloads carry every post's upvoter list, so they grow with the board's
+activity, and they are sent on every page load. Responses of the types in
+"compression_mimetypes" are compressed with the best coding the client accepts
+(Accept-Encoding): brotli when the brotli package is installed, otherwise gzip.
+
+ - Responses under "compression_min_bytes" are sent as is, as compressing them saves less
+   than it costs.
+ - Bodies over "compression_stream_bytes", and bodies that are streamed (such as static
+   files), are compressed chunk by chunk as they are sent, rather than all at once first.
+ - Live update streams (text/event-stream) are never compressed, as compression would
+   hold their events back until enough of them were buffered.
+ - "compression_level" sets the gzip level (1 to 9) and "compression_brotli_quality" the
+   brotli quality (0 to 11); higher values make smaller responses for more CPU.
+
+The ETag of a compressed response is made weak, since its bytes differ from the uncompressed
+response's. If-None-Match compares ETags weakly, so clients still get 304 with either.
+"""
+
+import zlib
+
+import flask
+
+import config
+
+try:
+    import brotli
+except ImportError: # Optional, gzip is used without it
+    brotli = None
+
+# Codings in order of preference, when the client accepts them equally
+CODINGS = ["br", "gzip"] if brotli is not None else ["gzip"]
+
+# Types compressed by default
+DEFAULT_MIMETYPES = ["text/html", "text/css", "text/plain", "text/javascript",
+                     "application/javascript", "application/json", "image/svg+xml"]
+
+# Size of the pieces large bodies are compressed in
+CHUNK_SIZE = 64 * 1024
+
+
+class Compressor:
+    """
+    Incremental compressor for one response body
+    """
+
+    def __init__(self, coding: str, level: int):
+        """
+        Parameters:
+         - coding: "gzip" or "br"
+         - level: the gzip level or brotli quality
+        """
+        if coding == "br":
+            self.compressor = brotli.Compressor(quality=level)
+            self.compress = self.compressor.process
+            self.flush = self.compressor.finish
+        else:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # gzip header and trailer
+            self.compress = self.compressor.compress
+            self.flush = self.compressor.flush
+
+
+def compress(data: bytes, coding: str, level: int):
+    """
+    Compresses a whole body
+
+    Parameters:
+     - data: the body
+     - coding: "gzip" or "br"
+     - level: the gzip level or brotli quality
+    Returns:
+     - The compressed body
+    """
+    compressor = Compressor(coding, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_chunks(chunks, coding: str, level: int):
+    """
+    Compresses a body as it is produced
+
+    Parameters:
+     - chunks: iterable of the pieces of the body
+     - coding: "gzip" or "br"
+     - level: the gzip level or brotli quality
+    Returns:
+     - A generator of the pieces of the compressed body
+    """
+    compressor = Compressor(coding, level)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf8")
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def get_level(coding: str):
+    """
+    Returns the configured gzip level or brotli quality
+    """
+    if coding == "br":
+        return int(config.get("compression_brotli_quality", 4))
+    return int(config.get("compression_level", 6))
+
+
+def choose_coding(request):
+    """
+    Picks the coding to answer a request with
+
+    Returns:
+     - "br" or "gzip", or None if the client accepts neither
+    """
+    return request.accept_encodings.best_match(CODINGS)
+
+
+def compress_response(response):
+    """
+    Compresses a response if its type, size and the request allow it
+
+    Parameters:
+     - response: the Flask response
+    Returns:
+     - The response, compressed or not
+    """
+    if (response.status_code != 200 or flask.request.method == "HEAD"
+            or response.mimetype == "text/event-stream"
+            or response.mimetype not in config.get("compression_mimetypes", DEFAULT_MIMETYPES)
+            or "Content-Encoding" in response.headers or "Content-Range" in response.headers
+            or "no-transform" in response.headers.get("Cache-Control", "")):
+        return response
+    if response.is_streamed or response.direct_passthrough:
+        length = response.content_length # Only known from the header, the body must not be read here
+    else:
+        length = response.calculate_content_length()
+    if length is not None and length < int(config.get("compression_min_bytes", 1024)):
+        return response
+    response.vary.add("Accept-Encoding")
+    coding = choose_coding(flask.request)
+    if coding is None:
+        return response
+
+    level = get_level(coding)
+    if response.is_streamed or response.direct_passthrough:
+        # Files and generators are compressed as they are read
+        body = response.response
+        response.response = compress_chunks(body, coding, level)
+        if hasattr(body, "close"):
+            response.call_on_close(body.close)
+        response.direct_passthrough = False
+        del response.headers["Content-Length"]
+    elif length is not None and length > int(config.get("compression_stream_bytes", 1024 * 1024)):
+        data = response.get_data()
+        response.response = compress_chunks((data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)), coding, level)
+        del response.headers["Content-Length"]
+    else:
+        response.set_data(compress(response.get_data(), coding, level))
+    response.headers["Content-Encoding"] = coding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    """
+    Hooks response compression into the Flask app, unless the "compression" config entry is false
+
+    Parameters:
+     - app: the Flask app
+    """
+    if not config.get("compression", True):
+        return
+    app.after_request(compress_response)
@@ -0,0 +1,114 @@
+"""
+Benchmarks response compression: bytes on the wire and CPU cost per endpoint
+
+A user is logged in against a running server (see loadtest.py), boards and posts are
+seeded and every post is upvoted by every user, so board payloads carry realistic upvoter
+lists. Each endpoint is then fetched uncompressed, and its body is compressed here with
+every coding and level asked for, reporting the compressed size, the ratio and the CPU
+time per response. The bytes the server actually sent for a gzip request are reported as
+well, to check its compression is in place.
+
+To run the benchmark against a local server:
+    $ CONFIG_LOC=./config.json gunicorn --workers 2 --bind 0.0.0.0:5000 wsgi:app
+    $ python3 compression_bench.py --url http://localhost:5000 --users 20 --posts 50 --levels gzip:1,gzip:6,gzip:9,br:4,br:11
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import requests
+
+import compression
+import loadtest
+
+
+def measure(data: bytes, coding: str, level: int, repeat: int):
+    """
+    Compresses a body repeat times
+
+    Returns:
+     - The compressed size and the CPU milliseconds per compression
+    """
+    start = time.process_time()
+    for _ in range(repeat):
+        size = len(compression.compress(data, coding, level))
+    return size, (time.process_time() - start) * 1000 / repeat
+
+
+def wire_bytes(user: loadtest.VirtualUser, path: str, params: dict, coding: str):
+    """
+    Returns the bytes the server sends for a request accepting the given coding, and the coding it used
+    """
+    resp = user.session.get(user.base_url + path, params=params, headers={"Accept-Encoding": coding},
+                            stream=True, timeout=user.timeout)
+    body = resp.raw.read(decode_content=False)
+    resp.close()
+    return len(body), resp.headers.get("Content-Encoding", "identity")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks bytes on the wire and CPU cost of response compression per endpoint")
+    parser.add_argument("--url", default="http://localhost:5000", help="base URL of the server")
+    parser.add_argument("--users", type=int, default=20, help="number of users, each upvoting every post")
+    parser.add_argument("--posts", type=int, default=50, help="number of posts to seed")
+    parser.add_argument("--levels", default="gzip:1,gzip:6,gzip:9", help="comma separated coding:level pairs to try (br needs the brotli package)")
+    parser.add_argument("--repeat", type=int, default=20, help="compressions per measurement")
+    parser.add_argument("--timeout", type=float, default=30, help="request timeout in seconds")
+    parser.add_argument("--prefix", default="cb%d" % (int(time.time()) % 100000), help="name prefix for seeded users and boards")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    levels = []
+    for item in args.levels.split(","):
+        coding, _, level = item.partition(":")
+        if coding not in compression.CODINGS:
+            print("Coding %s is not available, expected one of %s" % (coding, ", ".join(compression.CODINGS)))
+            sys.exit(1)
+        levels.append((coding, int(level)))
+
+    try:
+        print("Logging in %d users and seeding %d posts..." % (args.users, args.posts))
+        users = [loadtest.VirtualUser(args.url, "%s_u%d" % (args.prefix, i), "compression", args.timeout) for i in range(args.users)]
+        for user in users:
+            user.register_and_login()
+        board_id, post_ids = loadtest.seed(users[0], users, 1, args.posts, args.prefix)[0]
+        for user in users:
+            for post_id in post_ids:
+                user.post("/api/post/upvote", {"board_id": board_id, "post_id": post_id})
+    except (loadtest.LoadTestError, requests.RequestException) as e:
+        print("Setup failed: %s" % e)
+        sys.exit(1)
+
+    endpoints = {
+        "/api/boards": ("/api/boards", {"search": args.prefix, "offset": 0}),
+        "/api/board": ("/api/board", {"board_id": board_id}),
+        "/api/board/user": ("/api/board/user", None),
+        "/api/post": ("/api/post", {"board_id": board_id, "post_id": post_ids[0]}),
+        "/viewboard.html": ("/viewboard.html", {"board": board_id}),
+        "/static/js/script.js": ("/static/js/script.js", None),
+    }
+    user = users[0]
+    results = {}
+    print("%-22s %10s %10s %12s %8s %10s" % ("endpoint", "coding", "bytes", "compressed", "ratio", "cpu_ms"))
+    for name, (path, params) in endpoints.items():
+        resp = user.session.get(user.base_url + path, params=params, headers={"Accept-Encoding": "identity"}, timeout=args.timeout)
+        data = resp.content
+        sent, sent_coding = wire_bytes(user, path, params, "gzip")
+        results[name] = {"bytes": len(data), "wire_bytes_gzip_request": sent, "wire_coding": sent_coding, "codings": {}}
+        for coding, level in levels:
+            size, cpu_ms = measure(data, coding, level, args.repeat)
+            label = "%s:%d" % (coding, level)
+            results[name]["codings"][label] = {"bytes": size, "ratio": round(size / max(1, len(data)), 3), "cpu_ms": round(cpu_ms, 3)}
+            print("%-22s %10s %10d %12d %8.3f %10.3f" % (name, label, len(data), size, size / max(1, len(data)), cpu_ms))
+        print("%-22s %10s %10d %12d (sent by the server)" % (name, sent_coding, len(data), sent))
+
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump({"config": vars(args), "results": results}, outfile, indent=4)
+        print("Results written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,24 @@
 """
 Handles all database transactions.
 
+Writes that pages show live (votes, new posts, comments, notifications) are also published
+as events on the in-process hub in db_events.py.
+
 The database has a number of MongoDB collections:
  - users: contains information about users
  - admins: contains information about system administrators
  - boards: contains information about boards
  - comments: contains posts id and comments
+ - slow_queries: capped collection of slow AppDB calls and their query plans
+ - notif_jobs: durable queue of notification fan-out jobs
+ - notif_deliveries: markers of pushes already delivered, so retried jobs never send twice
+ - checkpoints: how far periodic background jobs (such as the threshold sweep) have got
+ - push_subscriptions: the web push subscriptions of every user's devices, one per endpoint
+ - notif_ledger: one entry per notification fan-out, with its results and timings
+ - notif_digests: notifications waiting to be coalesced into one push per user (digest mode)
+ - notif_inbox: the in-app notification inbox of every user (capped)
+ - api_tokens: the bearer tokens API clients authenticate with
+ - versions: version stamps of boards and posts, changed by every write to them
 
 In the users collection, each user entry has the following form:
 {   "_id": id of user
@@ -13,12 +26,13 @@ In the users collection, each user entry has the following form:
     "password": hashed password of the user
     "subscriptions": list of board IDs
     "admin": whether the user is an administrator
-    "notification": info about the user's notification
+    "notification": legacy list of push subscriptions, moved to push_subscriptions by migrate_push_subscriptions
     "user_date": creation date of user
     "last_active_date": last active date
     "boards_owned": the board id of the board that the user made
     "posts_owned": the posts id of the post that the user posted
-
+    "claims_version": incremented whenever the session claims of the user change (username, password,
+                      admin flag or memberships), so sessions holding older claims refresh them. Missing means 0
 }
 
 In the admins collection, each admin entry has the following form:
@@ -41,6 +55,7 @@ In the boards collection, each board entry has the following form:
     "last_active_date": last active date
     "board_posts": actual posts without comments
     "finished_posts": past notified posts
+    "votes_changed": when the upvotes needed by the board's posts last changed (members or threshold)
 
 
 }
@@ -55,6 +70,8 @@ In a particular board's collection, each entry is a post which has the following
     "post_upvotes": number of upvotes on the post
     "post_upvoters": list of user IDs who voted on the post
     "post_notified": whether the post notification has already been triggered
+    "votes_needed": upvotes needed to trigger the notification, ceil(board_member_count * board_vote_threshold / 100).
+                     Kept up to date whenever the board's members or threshold change
     "comments_container": contariner id in which the container stores the comments
     "last_active_date": last active date
 
@@ -67,6 +84,98 @@ container Level (in comments collection):
     "comments": actual comments
 }
 
+In the slow_queries collection, each entry has the following form:
+{
+    "_id": id of the entry
+    "method": the AppDB method that was slow
+    "duration_ms": how long the method took
+    "date": when the method finished
+    "endpoint": the Flask endpoint that called the method, if any
+    "commands": the commands made by the method (collection, operation, duration, query shape)
+    "explain": summary of the explain("executionStats") output of the slowest command
+}
+
+In the push_subscriptions collection, each subscription has the following form:
+{
+    "_id": id of the subscription
+    "endpoint": the push service URL of the device. Unique
+    "keys": the device's encryption keys ("p256dh" and "auth")
+    "expirationTime": when the subscription expires, as given by the browser
+    "username": the user the device belongs to
+    "user_agent": the browser that subscribed, if known
+    "created": when the device first subscribed
+}
+
+In the notif_jobs collection, each job has the following form:
+{
+    "_id": id of the job. Fan-out jobs use "fanout:<post id>" so a post is only queued once
+    "kind": "fanout" (resolve the recipients of a post) or "batch" (send to a chunk of recipients)
+    "board_id": the board of the post
+    "post_id": the post to notify about
+    "recipients": for batch jobs, list of {"username", "subscription"}
+    "state": "pending", "leased", "done" or "dead" (gave up after too many attempts)
+    "attempts": number of times the job has been claimed
+    "available_at": the job may not be claimed before this date (used for backoff)
+    "lease_owner": the worker currently holding the job
+    "lease_expires": when the lease runs out and another worker may claim the job
+    "last_error": the error of the last failed attempt
+    "created": creation date of the job
+}
+
+In the notif_deliveries collection, each marker has the following form:
+{
+    "_id": "<post id>:<hash of the subscription endpoint>"
+    "date": when the push was delivered
+}
+
+In the notif_ledger collection, each fan-out has the following form:
+{
+    "_id": id of the post notified about
+    "board_id": the board of the post
+    "recipients": number of push subscriptions targeted
+    "sent", "failed", "pruned", "retried": number of pushes by result (pruned subscriptions had expired)
+    "queued": when the notification was queued
+    "started": when the fan-out started
+    "finished": when the last push of the fan-out was done
+    "services": per push service (keyed by host with dots replaced): {"origin", "pushes", "sent",
+                "failed", "pruned", "retried", "timed", "latency_ms" (sum over the timed pushes), "max_latency_ms"}
+}
+
+In the notif_digests collection, each user with digested notifications has the following form:
+{
+    "_id": username of the user
+    "pending": notifications not yet pushed, each {"board_id", "post_id", "board_name", "message"}
+    "recent": notifications already pushed, with the "sent" date, repeated in later digests
+              that may replace them before they reach the device
+    "due": when the pending notifications are pushed. Unset while nothing is pending
+}
+
+In the notif_inbox collection (capped, oldest entries dropped first), each notification has the following form:
+{
+    "_id": id of the entry, increasing with insertion time
+    "username": the user notified
+    "board_id": the board of the post
+    "post_id": the post that reached its threshold
+    "board_name": name of the board
+    "message": subject of the post
+    "date": when the notification was added
+}
+
+In the versions collection, each board, post and the board list has a stamp of the following form:
+{
+    "_id": the board or post id, or AppDB.BOARDS_VERSION for the board list
+    "version": an ObjectId, replaced after every write to the resource (so never reused)
+}
+
+In the api_tokens collection, each token has the following form (the token itself is never stored):
+{
+    "_id": id of the token, signed to make the bearer token (see api_tokens.py)
+    "userid": the user the token authenticates as
+    "name": name given to the token by its user
+    "created": creation date of the token
+    "revoked": when the token was revoked, missing while it is valid
+}
+
 Comments has the following form:
 {
     "_id": unique ID of the comment
@@ -82,10 +191,24 @@ Comments has the following form:
 import pymongo
 import re
 import datetime
+import hashlib
 from datetime import timedelta
 from pymongo import MongoClient
 from bson.objectid import ObjectId
 
+import db_events
+
+
+def _votes_needed(member_count, threshold):
+    """
+    Returns the aggregation expression for the upvotes a post needs to trigger its notification.
+    upvotes/members >= threshold/100 is the same as upvotes >= ceil(members * threshold / 100)
+
+    Parameters:
+     - member_count: expression of the board's member count
+     - threshold: expression of the board's vote threshold
+    """
+    return {"$ceil": {"$divide": [{"$multiply": [member_count, threshold]}, 100]}}
 
 
 class AppDB:
@@ -93,15 +216,19 @@ class AppDB:
     The manager for all database transactions
     """
 
-    def __init__(self,client):
+    # Key of the board list's version stamp in the versions collection
+    BOARDS_VERSION = "boards"
+
+    def __init__(self,client, db_name: str = "p2_db"):
         """
         Initiates the AppDB manager
 
         Parameters:
          - client: the MongoDB client
+         - db_name: the database to use, which is only changed for tests and benchmarks
         """
         self.client = client
-        self.db=self.client.p2_db
+        self.db=self.client[db_name]
 
 
     def fetch_user(self, userid: ObjectId, user_name: str ):
@@ -175,12 +302,14 @@ class AppDB:
         val=user.find_one(filter)
         if val != None:
             user.delete_one(filter)
+            self.db.push_subscriptions.delete_many({"username":val["username"]})
             subs=val["subscriptions"]
             for id in subs:
-                board.update_one({"_id":id},{"$pull":{"board_members":val["_id"]}})
-                board.update_one({"_id": id}, {"$inc": {"board_member_count": 1}})
+                board.update_one({"_id":id},{"$pull":{"board_members":val["_id"]},"$inc":{"board_member_count":-1}})
+                self.refresh_votes_needed(id) # The board's posts need fewer votes now
             if val["admin"]==1:
                 admin.delete_one({"userid":val["_id"]})
+            self.touch_versions(subs + val.get("posts_owned", []) + [self.BOARDS_VERSION])
             return val["_id"]
         else:
             return None
@@ -205,9 +334,11 @@ class AppDB:
         val=user.find_one(filter)
         check=user.find_one({"_id":new_username})
         if val != None and check==None:
-            user.update_one(filter,{"$set":{"username":new_username}})
+            user.update_one(filter,{"$set":{"username":new_username},"$inc":{"claims_version":1}})
+            self.db.push_subscriptions.update_many({"username":val["username"]},{"$set":{"username":new_username}})
             if val["admin"]==1:
                 admin.update_one({"userid":val["_id"]},{"$set":{"username":new_username}})
+            self.touch_versions(val.get("posts_owned", [])) # Posts show their owner's name
             return val["_id"]
         else:
             return None
@@ -231,7 +362,7 @@ class AppDB:
             filter={"_id":userid}
         val=user.find_one(filter)
         if val != None:
-            user.update_one(filter,{"$set":{"password":new_password}})
+            user.update_one(filter,{"$set":{"password":new_password},"$inc":{"claims_version":1}})
 
             return val["_id"]
         else:
@@ -239,6 +370,7 @@ class AppDB:
 
     def add_notification(self, userid: ObjectId, user_name: str, notification: dict):
         """
+        Registers a push subscription for a user. See save_push_subscription
 
          Parameters:
                  - userid: the id of the user
@@ -252,15 +384,16 @@ class AppDB:
             filter={"username":user_name}
         else:
             filter={"_id":userid}
-        theuser=user.find_one(filter)
-        if theuser!=None:
-            user.update_one(filter,{"$push":{"notification":notification}})
+        theuser=user.find_one(filter, {"username": 1})
+        if theuser!=None and self.save_push_subscription(theuser["username"], notification, None) != None:
             return theuser["_id"]
         else:
             return None
 
     def remove_notification(self, userid: ObjectId, user_name: str, notification: dict):
         """
+        Removes a push subscription of a user. See remove_push_subscription
+
          Parameters:
                  - userid: the id of the user
                  - username: the username of the administrator
@@ -273,9 +406,9 @@ class AppDB:
             filter = {"username": user_name}
         else:
             filter = {"_id": userid}
-        theuser = user.find_one(filter)
+        theuser = user.find_one(filter, {"username": 1})
         if theuser != None:
-            user.update_one(filter, {"$pull": {"notification": notification}})
+            self.remove_push_subscription(theuser["username"], notification.get("endpoint"))
             return theuser["_id"]
         else:
             return None
@@ -309,9 +442,10 @@ class AppDB:
 
         if (val!=None) and (check==None):
             if val["admin"]!=1:
-                user.update_one({"userid": val["_id"]},{"$set":{"admin":1}})
+                user.update_one({"_id": val["_id"]},{"$set":{"admin":1},"$inc":{"claims_version":1}})
                 admin.insert_one({"username":val["username"],
                                   "userid":val["_id"]})
+                self._refresh_admin_claims()
                 return admin.find_one({"username":val["username"]})["_id"]
             else:
                 return admin.find_one({"username":val["username"]})["_id"]
@@ -340,13 +474,36 @@ class AppDB:
         val=admin.find_one(filter)
         if val != None:
             admin.delete_one(filter)
-            user.update_one(filter, {"$set": {"admin": 0}})
+            user.update_one({"_id": val["userid"]}, {"$set": {"admin": 0}, "$inc": {"claims_version": 1}})
+            self._refresh_admin_claims()
             return val["_id"]
         else:
             return None
 
 
 
+    def _refresh_admin_claims(self):
+        """
+        Every user is an administrator while there are none, so adding the first admin or
+        removing the last one (at most one admin left) outdates the session claims of every user
+        """
+        if self.db.admins.count_documents({}, limit=2) < 2:
+            self.db.users.update_many({}, {"$inc": {"claims_version": 1}})
+
+    def fetch_claims_version(self, userid: ObjectId):
+        """
+        Fetches the claims version of a user, which changes whenever the user's session claims do
+
+        Parameters:
+         - userid: the id of the user
+        Return: the version
+        Error: return None if the user does not exist
+        """
+        user = self.db.users.find_one({"_id": userid}, {"_id": 0, "claims_version": 1})
+        if user == None:
+            return None
+        return user.get("claims_version", 0)
+
     def fetch_admins(self):
         """
         Fetches all admins of the system.
@@ -404,6 +561,20 @@ class AppDB:
         else:
             return {}
 
+    def board_exists(self, boardid: ObjectId, post_id: ObjectId = None):
+        """
+        Checks that a board, or a post of it, exists, without reading the board
+
+        Parameters:
+         - boardid: the unique board ID
+         - post_id: the ID of a post of the board to look for, or None to only check the board
+        Return: whether the board (and post) exists
+        """
+        filter = {"_id": boardid}
+        if post_id != None:
+            filter["board_posts._id"] = post_id
+        return self.db.boards.find_one(filter, {"_id": 1}) != None
+
     def create_board(self, ownerid: ObjectId, owner: str, boardname: str, desc: str, vote_threshold: int):
         """
         Creates a new board and assigns it a unique ID.
@@ -446,6 +617,7 @@ class AppDB:
 
             board_id=board.find_one({"board_name":boardname})["_id"]
             user.update_one(filter, {"$push": {"boards_owned":board_id}})
+            self.touch_versions([board_id, self.BOARDS_VERSION])
             return board_id
         else:
             raise ValueError('Could not find owner')
@@ -489,6 +661,7 @@ class AppDB:
                     user.update_one({"_id": uid}, {"$pull": {"subscriptions": val["_id"]}})
 
                 user.update_one({"_id": val["board_owner"]}, {"$pull": {"boards_owned": val["_id"]}})
+                self.touch_versions([val["_id"], self.BOARDS_VERSION] + [post["_id"] for post in posts])
                 return val["_id"]
         else:
             return None
@@ -523,6 +696,7 @@ class AppDB:
 
             if (admin.find_one({"userid": theuser["_id"]}) != None) or (val["board_owner"]==theuser["_id"]):
                 board.update_one(filter,{"$set":{"board_name":new_boardname}})
+                self.touch_versions([boardid, self.BOARDS_VERSION])
                 return val["_id"]
         else:
             return None
@@ -557,6 +731,7 @@ class AppDB:
 
             if (admin.find_one({"userid": theuser["_id"]}) != None) or (val["board_owner"]==theuser["_id"]):
                 board.update_one(filter,{"$set":{"board_owner":new_ownerid}})
+                self.touch_versions([boardid, self.BOARDS_VERSION])
                 return val["_id"]
         else:
             return None
@@ -591,6 +766,7 @@ class AppDB:
 
             if (admin.find_one({"userid": theuser["_id"]}) != None) or (val["board_owner"]==theuser["_id"]):
                 board.update_one(filter,{"$set":{"board_vote_threshold":new_threshold}})
+                self.refresh_votes_needed(boardid)
                 return val["_id"]
         else:
             return None
@@ -625,6 +801,7 @@ class AppDB:
 
             if (admin.find_one({"userid": theuser["_id"]}) != None) or (val["board_owner"]==theuser["_id"]):
                 board.update_one(filter,{"$set":{"board_description":new_description}})
+                self.touch_versions([boardid, self.BOARDS_VERSION])
                 return val["_id"]
         else:
             return None
@@ -690,9 +867,10 @@ class AppDB:
             if (boardid in theuser["subscriptions"]):
                 return theboard["_id"]
             elif (theboard != None):
-                user.update_one(u_filter, {"$push": {"subscriptions": theboard["_id"]}})
+                user.update_one(u_filter, {"$push": {"subscriptions": theboard["_id"]}, "$inc": {"claims_version": 1}})
                 board.update_one(b_filter, {"$push": {"board_members": theuser["_id"]}})
                 board.update_one(b_filter, {"$inc": {"board_member_count": 1}})
+                self.refresh_votes_needed(boardid)
                 return theboard["_id"]
             else:
                 return None
@@ -724,9 +902,10 @@ class AppDB:
             if (boardid not in theuser["subscriptions"]):
                 return theboard["_id"]
             elif (theboard != None):
-                user.update_one(u_filter, {"$pull": {"subscriptions": theboard["_id"]}})
+                user.update_one(u_filter, {"$pull": {"subscriptions": theboard["_id"]}, "$inc": {"claims_version": 1}})
                 board.update_one(b_filter, {"$pull": {"board_members": theuser["_id"]}})
                 board.update_one(b_filter, {"$inc": {"board_member_count": -1}})
+                self.refresh_votes_needed(boardid)
                 return theboard["_id"]
             else:
                 return None
@@ -779,6 +958,8 @@ class AppDB:
                     board.update_one({"_id":boardid},{"$push":{"finished_posts":post}})
                     board.update_one({"_id":boardid},{"$pull":{"board_posts":{"_id":post["_id"]}}})
                     ret.append(post["_id"])
+            if ret:
+                self.touch_versions([boardid, self.BOARDS_VERSION] + ret)
             return ret
         else:
             return None
@@ -815,6 +996,7 @@ class AppDB:
         if (theowner!=None) and (theboard!=None):
             if (theboard["_id"] in theowner["subscriptions"]):
                 post_id = ObjectId()
+                post_date = datetime.datetime.now()
                 comment.insert_one({"post_id": post_id,
                                     "comments": []})
                 container_id=comment.find_one({"post_id": post_id})["_id"]
@@ -822,15 +1004,20 @@ class AppDB:
                                                             "post_subject":subject,
                                                             "post_description":description,
                                                             "post_owner":theowner["_id"],
-                                                            "post_date":datetime.datetime.now(),
+                                                            "post_date":post_date,
                                                             "post_upvotes":0,
                                                             "post_upvoters":[],
                                                             "post_notified":0,
+                                                            "votes_needed":-(-theboard["board_member_count"]*theboard["board_vote_threshold"]//100),
                                                             "comments_container":container_id,
                                                             "last_active_date":None}}})
 
 
                 user.update_one({"_id":theowner["_id"]},{"$push":{"posts_owned":post_id}})
+                self.touch_versions([boardid, self.BOARDS_VERSION, post_id])
+                db_events.publish([db_events.board_channel(boardid)], "post",
+                                  {"_id": post_id, "post_subject": subject, "post_date": post_date,
+                                   "post_upvotes": 0, "post_notified": 0})
                 return post_id
             else:
                 return None
@@ -872,6 +1059,7 @@ class AppDB:
                     board.update_one(p_filter,{"$pull":{"board_posts":{"_id":post_id}}})
                     user.update_one({"_id":theownerid},{"$pull":{"posts_owned":post_id}})
                     comment.delete_one({"post_id":post_id})
+                    self.touch_versions([boardid, self.BOARDS_VERSION, post_id])
                     return post_id
             else:
                 return None
@@ -905,12 +1093,84 @@ class AppDB:
                 board.update_one(p_filter, {"$push":{"board_posts.$.post_upvoters":theupvoter["_id"]}})
                 board.update_one(p_filter, {"$inc": {"board_posts.$.post_upvotes": 1}})
                 board.update_one(p_filter, {"$set": {"board_posts.$.last_active_date":datetime.datetime.now()}})
+                self.touch_versions([boardid, self.BOARDS_VERSION, post_id])
+                self._publish_votes(boardid, post_id, thepost["post_upvotes"] + 1)
                 return post_id
             else:
                 return None
         else:
             return None
 
+    def _publish_votes(self, boardid: ObjectId, post_id: ObjectId, upvotes: int):
+        """
+        Publishes a post's new vote count, or its notification if the count shows it was notified
+        """
+        channels = [db_events.board_channel(boardid), db_events.post_channel(post_id)]
+        if upvotes < 0:
+            db_events.publish(channels, "notified", {"post_id": post_id})
+        else:
+            db_events.publish(channels, "vote", {"post_id": post_id, "post_upvotes": upvotes})
+
+    def upvote_post_atomic(self, upvoterid: ObjectId, upvoter: str, boardid: ObjectId, post_id: ObjectId):
+        """
+        Upvotes a post and detects whether this vote crossed the board's vote threshold,
+        in one atomic update. The post is marked as notified by the crossing vote, so
+        exactly one caller is told to send its notification
+
+        Parameters:
+         - upvoterid: id of the upvoter
+         - upvoter: name of the upvoter
+         NOTE: use only upvoterid or upvoter, pass "None" to unused parameters! Passing the id saves a round trip
+         - boardid: the ID of the board the post belongs under
+         - post_id: the ID of the post to upvote
+        Return: tuple of the id of the post upvoted and whether this vote triggered its notification
+        Error: return None if the post does not exist, is already notified or was already upvoted by the user
+        """
+        if upvoterid == None:
+            theupvoter = self.db.users.find_one({"username": upvoter}, {"_id": 1})
+            if theupvoter == None:
+                return None
+            upvoterid = theupvoter["_id"]
+
+        # Applied to the upvoted post only. Posts created before votes_needed existed fall back to the board's numbers
+        upvotes = {"$add": ["$$p.post_upvotes", 1]}
+        needed = {"$ifNull": ["$$p.votes_needed", _votes_needed("$board_member_count", "$board_vote_threshold")]}
+        crossed = {"$gte": [upvotes, needed]}
+        vote = {"$mergeObjects": ["$$p", {
+            "post_upvoters": {"$concatArrays": ["$$p.post_upvoters", [upvoterid]]},
+            "post_upvotes": {"$cond": [crossed, -1, upvotes]}, # Notified posts show -1 upvotes
+            "post_notified": {"$cond": [crossed, 1, 0]},
+            "last_active_date": "$$NOW",
+        }]}
+        thepost = self.db.boards.find_one_and_update(
+            {"_id": boardid, "board_posts": {"$elemMatch": {"_id": post_id, "post_notified": 0, "post_upvoters": {"$ne": upvoterid}}}},
+            [{"$set": {"board_posts": {"$map": {
+                "input": "$board_posts",
+                "as": "p",
+                "in": {"$cond": [{"$eq": ["$$p._id", post_id]}, vote, "$$p"]}}}}}],
+            projection={"board_posts": {"$elemMatch": {"_id": post_id}}},
+            return_document=pymongo.ReturnDocument.AFTER)
+        if thepost == None:
+            return None
+        self.touch_versions([boardid, self.BOARDS_VERSION, post_id])
+        self._publish_votes(boardid, post_id, thepost["board_posts"][0]["post_upvotes"])
+        return post_id, thepost["board_posts"][0]["post_notified"] == 1
+
+    def refresh_votes_needed(self, boardid: ObjectId):
+        """
+        Recomputes the upvotes every post of a board needs from its current member count and vote threshold
+
+        Parameters:
+         - boardid: the board whose members or threshold changed
+        """
+        self.db.boards.update_one({"_id": boardid}, [{"$set": {
+            "votes_changed": "$$NOW",
+            "board_posts": {"$map": {
+                "input": {"$ifNull": ["$board_posts", []]},
+                "as": "p",
+                "in": {"$mergeObjects": ["$$p", {"votes_needed": _votes_needed("$board_member_count", "$board_vote_threshold")}]}}}}}])
+        self.touch_versions([boardid, self.BOARDS_VERSION])
+
     def unupvote_post(self, upvoterid: ObjectId, upvoter: str, boardid: ObjectId, post_id: ObjectId):
         """
         Rescinds an upvote given to a post
@@ -937,7 +1197,8 @@ class AppDB:
             if (thepost["post_notified"]==0) and (theupvoter["_id"] in thepost["post_upvoters"]):
                 board.update_one(p_filter, {"$pull":{"board_posts.$.post_upvoters":theupvoter["_id"]}})
                 board.update_one(p_filter, {"$inc": {"board_posts.$.post_upvotes": -1}})
-
+                self.touch_versions([boardid, self.BOARDS_VERSION, post_id])
+                self._publish_votes(boardid, post_id, thepost["post_upvotes"] - 1)
                 return post_id
             else:
                 return None
@@ -974,6 +1235,8 @@ class AppDB:
                     user.update_one({"_id": post_owner}, {"$pull": {"posts_owned": post_id}})
                     comment.delete_one({"post_id": post_id})
                     ret.append(post_id)
+            if ret:
+                self.touch_versions([board_id, self.BOARDS_VERSION] + ret)
             return ret
         else:
             return None
@@ -1005,14 +1268,19 @@ class AppDB:
         thepost = board.find_one(p_filter)
         if (theowner != None) and (thepost != None):
             comment_id=ObjectId()
+            comment_date=datetime.datetime.now()
             comment.update_one({"_id":post_id}, {"$push": {"comments":
                                                                 {"_id":comment_id,
                                                                 "comment_owner":theowner["_id"],
                                                                 "comment_message":message,
-                                                                "comment_date":datetime.datetime.now(),
+                                                                "comment_date":comment_date,
                                                                 "comment_upvotes":0,
                                                                 "comment_upvoters":[]}}})
             board.update_one(p_filter, {"$set": {"board_posts.$.last_active_date": datetime.datetime.now()}})
+            self.touch_versions([boardid, self.BOARDS_VERSION, post_id])
+            db_events.publish([db_events.post_channel(post_id)], "comment",
+                              {"post_id": post_id, "comment_id": comment_id, "comment_username": theowner["username"],
+                               "comment_message": message, "comment_date": comment_date, "comment_upvotes": 0})
             return comment_id
         else:
             return None
@@ -1050,6 +1318,7 @@ class AppDB:
         if theoperator!=None:
             if  ((theoperator["_id"] == theownerid) or (admin.find_one({"userid": theoperator["_id"]}) != None)):
                 comment.update_one(c_filter, {"$pull":{"comments":{"_id":comment_id}}})
+                self.touch_versions([post_id])
                 return comment_id
             else:
                 return None
@@ -1089,6 +1358,7 @@ class AppDB:
         if theoperator!=None:
             if  ((theoperator["_id"] == theownerid) or (admin.find_one({"userid": theoperator["_id"]}) != None)):
                 comment.update_one(c_filter, {"$set":{"comments.$.comment_message":new_comment}})
+                self.touch_versions([post_id])
                 return comment_id
             else:
                 return None
@@ -1127,6 +1397,7 @@ class AppDB:
             if theupvoter["_id"] not in theupvoters:
                 comment.update_one(c_filter,{"$push":{"comments.$.comment_upvoters":theupvoter["_id"]}})
                 comment.update_one(c_filter,{"$inc": {"comments.$.comment_upvotes": 1}})
+                self.touch_versions([post_id])
                 return comment_id
             else:
                 return None
@@ -1165,6 +1436,7 @@ class AppDB:
             if theupvoter["_id"] in theupvoters:
                 comment.update_one(c_filter,{"$pull":{"comments.$.comment_upvoters":theupvoter["_id"]}})
                 comment.update_one(c_filter,{"$inc": {"comments.$.comment_upvotes": -1}})
+                self.touch_versions([post_id])
                 return comment_id
             else:
                 return None
@@ -1192,6 +1464,782 @@ class AppDB:
         if  (thepost != None):
             board.update_one(p_filter, {"$set": {"board_posts.$.post_notified": 1}})
             board.update_one(p_filter, {"$set": {"board_posts.$.post_upvotes": -1}})
+            self.touch_versions([boardid, self.BOARDS_VERSION, post_id])
+            self._publish_votes(boardid, post_id, -1)
             return post_id
         else:
             return None
+
+    def ensure_slow_query_log(self, size_bytes: int):
+        """
+        Creates the capped slow query collection if it does not exist yet
+
+        Parameters:
+         - size_bytes: the maximum size of the collection, after which the oldest entries are dropped
+        """
+        if "slow_queries" not in self.db.list_collection_names():
+            try:
+                self.db.create_collection("slow_queries", capped=True, size=size_bytes)
+            except pymongo.errors.CollectionInvalid:
+                pass # Created concurrently by another worker
+
+    def log_slow_query(self, entry: dict):
+        """
+        Records a slow AppDB call
+
+        Parameters:
+         - entry: the slow query entry (see the slow_queries form above)
+        Return: id of the entry added
+        """
+        return self.db.slow_queries.insert_one(entry).inserted_id
+
+    def fetch_slow_queries(self, limit: int):
+        """
+        Fetches the most recent slow AppDB calls
+
+        Parameters:
+         - limit: the maximum number of entries to return
+        Return: array of slow query entries, newest first
+        """
+        return list(self.db.slow_queries.find().sort("$natural", -1).limit(limit))
+
+    def ensure_notif_queue(self, retention_seconds: int = 7 * 24 * 3600):
+        """
+        Creates the indexes used by the notification job queue. Done and dead-lettered jobs,
+        and delivery markers, are deleted by MongoDB once they are older than retention_seconds
+
+        Parameters:
+         - retention_seconds: how long finished jobs and delivery markers are kept
+        """
+        jobs = self.db.notif_jobs
+        jobs.create_index([("state", pymongo.ASCENDING), ("available_at", pymongo.ASCENDING)])
+        jobs.create_index([("state", pymongo.ASCENDING), ("lease_expires", pymongo.ASCENDING)])
+        # Only jobs with a "finished" date expire, pending and leased jobs have none
+        jobs.create_index([("finished", pymongo.ASCENDING)], expireAfterSeconds=retention_seconds)
+        self.db.notif_deliveries.create_index([("date", pymongo.ASCENDING)], expireAfterSeconds=retention_seconds)
+
+    def enqueue_notif_job(self, boardid: ObjectId, post_id: ObjectId):
+        """
+        Queues the notification fan-out of a post. A post is only ever queued once
+
+        Parameters:
+         - boardid: the board of the post
+         - post_id: the post to notify about
+        Return: id of the job, or None if the post was already queued
+        """
+        now = datetime.datetime.now()
+        job_id = "fanout:%s" % post_id
+        try:
+            self.db.notif_jobs.insert_one({"_id": job_id,
+                                           "kind": "fanout",
+                                           "board_id": boardid,
+                                           "post_id": post_id,
+                                           "state": "pending",
+                                           "attempts": 0,
+                                           "available_at": now,
+                                           "lease_owner": None,
+                                           "lease_expires": None,
+                                           "last_error": None,
+                                           "created": now})
+        except pymongo.errors.DuplicateKeyError:
+            return None
+        return job_id
+
+    def add_notif_batches(self, boardid: ObjectId, post_id: ObjectId, batches: list, first: int = 0):
+        """
+        Queues batch jobs sending a post's notification to chunks of recipients.
+        Batches are numbered so re-running a fan-out does not queue them twice
+
+        Parameters:
+         - boardid: the board of the post
+         - post_id: the post to notify about
+         - batches: list of recipient lists, each recipient being {"username", "subscription"}
+         - first: the number of the first batch, when a fan-out queues its batches in several calls
+        Return: number of batches queued
+        """
+        if not batches:
+            return 0
+        now = datetime.datetime.now()
+        docs = [{"_id": "batch:%s:%d" % (post_id, i),
+                 "kind": "batch",
+                 "board_id": boardid,
+                 "post_id": post_id,
+                 "recipients": recipients,
+                 "state": "pending",
+                 "attempts": 0,
+                 "available_at": now,
+                 "lease_owner": None,
+                 "lease_expires": None,
+                 "last_error": None,
+                 "created": now} for i, recipients in enumerate(batches, first)]
+        try:
+            return len(self.db.notif_jobs.insert_many(docs, ordered=False).inserted_ids)
+        except pymongo.errors.BulkWriteError as e:
+            # Batches left over from an earlier attempt at this fan-out are kept as is
+            return e.details.get("nInserted", 0)
+
+    def claim_notif_job(self, worker: str, lease_seconds: int):
+        """
+        Claims the next available notification job. Jobs whose lease ran out
+        (their worker died) can be claimed again
+
+        Parameters:
+         - worker: name of the claiming worker
+         - lease_seconds: how long the worker may hold the job before others can claim it
+        Return: the claimed job, or None if there is no job available
+        """
+        now = datetime.datetime.now()
+        return self.db.notif_jobs.find_one_and_update(
+            {"$or": [{"state": "pending", "available_at": {"$lte": now}},
+                     {"state": "leased", "lease_expires": {"$lte": now}}]},
+            {"$set": {"state": "leased",
+                      "lease_owner": worker,
+                      "lease_expires": now + timedelta(seconds=lease_seconds)},
+             "$inc": {"attempts": 1}},
+            sort=[("available_at", pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER)
+
+    def extend_notif_lease(self, job_id: str, worker: str, lease_seconds: int):
+        """
+        Extends the lease of a claimed notification job, for jobs running longer than their lease
+
+        Parameters:
+         - job_id: the job
+         - worker: the worker holding the lease
+         - lease_seconds: how long from now the worker may hold the job
+        Return: whether the job was still leased by the worker
+        """
+        ret = self.db.notif_jobs.update_one({"_id": job_id, "lease_owner": worker, "state": "leased"},
+                                            {"$set": {"lease_expires": datetime.datetime.now() + timedelta(seconds=lease_seconds)}})
+        return ret.modified_count == 1
+
+    def mark_notif_job_inbox(self, job_id: str):
+        """
+        Records that a fan-out job wrote its post to the in-app inboxes, so that retries do not write it again
+
+        Parameters:
+         - job_id: the job
+        """
+        self.db.notif_jobs.update_one({"_id": job_id}, {"$set": {"inbox_written": True}})
+
+    def complete_notif_job(self, job_id: str, worker: str):
+        """
+        Marks a claimed notification job as done
+
+        Parameters:
+         - job_id: the job
+         - worker: the worker holding the lease
+        Return: whether the job was still leased by the worker
+        """
+        ret = self.db.notif_jobs.update_one({"_id": job_id, "lease_owner": worker, "state": "leased"},
+                                            {"$set": {"state": "done", "lease_expires": None,
+                                                      "finished": datetime.datetime.now()}})
+        return ret.modified_count == 1
+
+    def retry_notif_job(self, job_id: str, worker: str, error: str, delay_seconds: float, dead: bool):
+        """
+        Releases a failed notification job for a later retry, or dead-letters it
+
+        Parameters:
+         - job_id: the job
+         - worker: the worker holding the lease
+         - error: description of the failure
+         - delay_seconds: how long to wait before the job may be claimed again
+         - dead: whether to give up on the job instead
+        Return: whether the job was still leased by the worker
+        """
+        now = datetime.datetime.now()
+        ret = self.db.notif_jobs.update_one({"_id": job_id, "lease_owner": worker, "state": "leased"},
+                                            {"$set": {"state": "dead" if dead else "pending",
+                                                      "available_at": now + timedelta(seconds=delay_seconds),
+                                                      "lease_owner": None,
+                                                      "lease_expires": None,
+                                                      "last_error": error,
+                                                      "finished": now if dead else None}})
+        return ret.modified_count == 1
+
+    def fetch_dead_notif_jobs(self, limit: int):
+        """
+        Fetches notification jobs that were given up on
+
+        Parameters:
+         - limit: the maximum number of jobs to return
+        Return: array of jobs
+        """
+        return list(self.db.notif_jobs.find({"state": "dead"}, {"recipients": 0}).limit(limit))
+
+    def _delivery_id(self, post_id: ObjectId, endpoint: str):
+        return "%s:%s" % (post_id, hashlib.sha1(endpoint.encode("utf8")).hexdigest())
+
+    def fetch_delivered(self, post_id: ObjectId, endpoints: list):
+        """
+        Finds which subscription endpoints already received a post's notification
+
+        Parameters:
+         - post_id: the post
+         - endpoints: the subscription endpoints to check
+        Return: set of the endpoints already delivered to
+        """
+        ids = {self._delivery_id(post_id, e): e for e in endpoints}
+        found = self.db.notif_deliveries.find({"_id": {"$in": list(ids)}}, {"_id": 1})
+        return {ids[d["_id"]] for d in found}
+
+    def mark_delivered(self, post_id: ObjectId, endpoints: list):
+        """
+        Records that subscription endpoints received a post's notification
+
+        Parameters:
+         - post_id: the post
+         - endpoints: the subscription endpoints delivered to
+        """
+        if not endpoints:
+            return
+        now = datetime.datetime.now()
+        docs = [{"_id": self._delivery_id(post_id, e), "date": now} for e in endpoints]
+        try:
+            self.db.notif_deliveries.insert_many(docs, ordered=False)
+        except pymongo.errors.BulkWriteError:
+            pass # Some markers already existed
+
+    def ensure_recipient_index(self):
+        """
+        Creates the index on user subscriptions used to resolve notification recipients
+        """
+        self.db.users.create_index([("subscriptions", pymongo.ASCENDING)])
+
+    def fetch_notification_post(self, boardid: ObjectId, post_id: ObjectId):
+        """
+        Fetches what a post's notification needs, without the rest of the board
+
+        Parameters:
+         - boardid: the ID of the board the post belongs under
+         - post_id: the ID of the post
+        Return: tuple of the board (only its _id and board_name) and the post
+        Error: return None
+        """
+        board = self.db.boards.find_one({"_id": boardid, "board_posts._id": post_id},
+                                        {"board_name": 1, "board_posts.$": 1})
+        if board is None:
+            return None
+        return board, board.pop("board_posts")[0]
+
+    def iter_notification_recipients(self, boardid: ObjectId, batch_size: int):
+        """
+        Streams the push subscriptions of every member of a board with one aggregation
+
+        Parameters:
+         - boardid: the board whose members are notified
+         - batch_size: the number of recipients per yielded batch
+        Return: generator of lists of {"username", "subscription"}, subscription holding only endpoint and keys
+        """
+        cursor = self.db.users.aggregate([
+            {"$match": {"subscriptions": boardid}},
+            {"$project": {"_id": 0, "username": 1}},
+            {"$lookup": {"from": "push_subscriptions", "localField": "username", "foreignField": "username", "as": "device"}},
+            {"$unwind": "$device"},
+            {"$project": {"username": 1, "subscription": {"endpoint": "$device.endpoint", "keys": "$device.keys"}}},
+        ], batchSize=batch_size)
+        batch = []
+        for recipient in cursor:
+            batch.append(recipient)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def ensure_push_subscriptions(self):
+        """
+        Creates the indexes of the push subscription registry and moves any subscriptions
+        still stored in users.notification into it
+        """
+        subscriptions = self.db.push_subscriptions
+        subscriptions.create_index([("endpoint", pymongo.ASCENDING)], unique=True)
+        subscriptions.create_index([("username", pymongo.ASCENDING)])
+        self.migrate_push_subscriptions()
+
+    def migrate_push_subscriptions(self):
+        """
+        Moves the legacy users.notification lists into the push_subscriptions collection.
+        Safe to run repeatedly; duplicated endpoints are only stored once
+
+        Return: number of users migrated
+        """
+        users = self.db.users
+        migrated = 0
+        for theuser in users.find({"notification.0": {"$exists": True}}, {"username": 1, "notification": 1}):
+            for subscription in theuser["notification"]:
+                if isinstance(subscription, dict) and subscription.get("endpoint"):
+                    self.save_push_subscription(theuser["username"], subscription, None)
+            users.update_one({"_id": theuser["_id"]}, {"$unset": {"notification": ""}})
+            migrated += 1
+        return migrated
+
+    def save_push_subscription(self, user_name: str, subscription: dict, user_agent: str):
+        """
+        Registers (or refreshes) a device's push subscription. Refreshing an unchanged
+        subscription matches the existing entry without writing anything
+
+        Parameters:
+         - user_name: the user the device belongs to
+         - subscription: the subscription generated by the browser ("endpoint", "keys", "expirationTime")
+         - user_agent: the browser that subscribed, or None
+        Return: "created", "updated" or "unchanged"
+        Error: return None if the subscription has no endpoint
+        """
+        endpoint = subscription.get("endpoint")
+        if not endpoint:
+            return None
+        fields = {"username": user_name,
+                  "keys": subscription.get("keys", {}),
+                  "expirationTime": subscription.get("expirationTime")}
+        if user_agent != None:
+            fields["user_agent"] = user_agent
+        for _ in range(2):
+            try:
+                ret = self.db.push_subscriptions.update_one({"endpoint": endpoint},
+                                                            {"$set": fields, "$setOnInsert": {"created": datetime.datetime.now()}},
+                                                            upsert=True)
+                break
+            except pymongo.errors.DuplicateKeyError:
+                continue # Inserted concurrently, the retry matches it
+        else:
+            return None
+        if ret.upserted_id != None:
+            return "created"
+        return "updated" if ret.modified_count else "unchanged"
+
+    def remove_push_subscription(self, user_name: str, endpoint: str):
+        """
+        Removes one of a user's devices
+
+        Parameters:
+         - user_name: the user the device belongs to
+         - endpoint: the push service URL of the device
+        Return: whether the device was registered
+        """
+        ret = self.db.push_subscriptions.delete_one({"endpoint": endpoint, "username": user_name})
+        return ret.deleted_count == 1
+
+    def fetch_push_subscriptions(self, user_name: str):
+        """
+        Lists a user's devices
+
+        Parameters:
+         - user_name: the user
+        Return: array of subscriptions, oldest first
+        """
+        return list(self.db.push_subscriptions.find({"username": user_name}).sort("created", pymongo.ASCENDING))
+
+    def remove_push_subscriptions(self, endpoints: list):
+        """
+        Removes push subscriptions by endpoint, such as subscriptions that push services
+        reported as expired
+
+        Parameters:
+         - endpoints: the subscription endpoints to remove
+        Return: number of subscriptions removed
+        """
+        if not endpoints:
+            return 0
+        return self.db.push_subscriptions.delete_many({"endpoint": {"$in": endpoints}}).deleted_count
+
+    def ensure_threshold_sweep(self):
+        """
+        Creates the index used by the threshold sweep to find boards whose thresholds changed
+        """
+        self.db.boards.create_index([("votes_changed", pymongo.ASCENDING)])
+
+    def db_time(self):
+        """
+        Returns the current time according to the database server
+        """
+        return self.client.admin.command("isMaster")["localTime"]
+
+    def fetch_checkpoint(self, name: str):
+        """
+        Fetches how far a periodic background job has got
+
+        Parameters:
+         - name: the name of the job
+        Return: the date of the checkpoint, or None if the job never completed
+        """
+        checkpoint = self.db.checkpoints.find_one({"_id": name})
+        return checkpoint["date"] if checkpoint != None else None
+
+    def save_checkpoint(self, name: str, date: datetime.datetime):
+        """
+        Records how far a periodic background job has got
+
+        Parameters:
+         - name: the name of the job
+         - date: the date of the checkpoint
+        """
+        self.db.checkpoints.update_one({"_id": name}, {"$max": {"date": date}}, upsert=True)
+
+    def fetch_threshold_crossings(self, since: datetime.datetime):
+        """
+        Finds unnotified posts that reached their board's vote threshold without a vote
+        crossing it, such as after members left or the threshold was lowered. Done in one
+        aggregation over the boards whose thresholds changed since the given date
+
+        Parameters:
+         - since: only boards changed after this date are checked, or None to check every board
+        Return: array of (board id, post id) pairs
+        """
+        match = {"board_posts.post_notified": 0}
+        if since != None:
+            match["votes_changed"] = {"$gt": since}
+        cursor = self.db.boards.aggregate([
+            {"$match": match},
+            {"$project": {"board_member_count": 1, "board_vote_threshold": 1, "board_posts._id": 1,
+                          "board_posts.post_notified": 1, "board_posts.post_upvotes": 1, "board_posts.votes_needed": 1}},
+            {"$unwind": "$board_posts"},
+            {"$match": {"board_posts.post_notified": 0}},
+            {"$match": {"$expr": {"$gte": ["$board_posts.post_upvotes",
+                                           {"$ifNull": ["$board_posts.votes_needed",
+                                                        _votes_needed("$board_member_count", "$board_vote_threshold")]}]}}},
+            {"$project": {"_id": 1, "post_id": "$board_posts._id"}},
+        ])
+        return [(c["_id"], c["post_id"]) for c in cursor]
+
+    def notify_post_once(self, boardid: ObjectId, post_id: ObjectId):
+        """
+        Marks a post as notified unless it already was, so that only one caller sends its notification
+
+        Parameters:
+         - boardid: the ID of the board the post belongs under
+         - post_id: the ID of the post
+        Return: whether this call marked the post
+        """
+        ret = self.db.boards.update_one({"_id": boardid, "board_posts": {"$elemMatch": {"_id": post_id, "post_notified": 0}}},
+                                        {"$set": {"board_posts.$.post_notified": 1, "board_posts.$.post_upvotes": -1}})
+        if ret.modified_count == 1:
+            self.touch_versions([boardid, self.BOARDS_VERSION, post_id])
+            self._publish_votes(boardid, post_id, -1)
+        return ret.modified_count == 1
+
+    def unnotify_post(self, boardid: ObjectId, post_id: ObjectId):
+        """
+        Undoes marking a post as notified when its notification could not be sent, restoring
+        its upvotes. The board's votes_changed is bumped so the threshold sweep checks it again
+
+        Parameters:
+         - boardid: the ID of the board the post belongs under
+         - post_id: the ID of the post
+        Return: whether the post was notified before
+        """
+        undo = {"$mergeObjects": ["$$p", {"post_notified": 0, "post_upvotes": {"$size": "$$p.post_upvoters"}}]}
+        thepost = self.db.boards.find_one_and_update(
+            {"_id": boardid, "board_posts": {"$elemMatch": {"_id": post_id, "post_notified": 1}}},
+            [{"$set": {"votes_changed": "$$NOW",
+                       "board_posts": {"$map": {
+                           "input": "$board_posts",
+                           "as": "p",
+                           "in": {"$cond": [{"$eq": ["$$p._id", post_id]}, undo, "$$p"]}}}}}],
+            projection={"board_posts": {"$elemMatch": {"_id": post_id}}},
+            return_document=pymongo.ReturnDocument.AFTER)
+        if thepost == None:
+            return False
+        self.touch_versions([boardid, self.BOARDS_VERSION, post_id])
+        self._publish_votes(boardid, post_id, thepost["board_posts"][0]["post_upvotes"])
+        return True
+
+    def ensure_notif_digests(self):
+        """
+        Creates the index used to find the digests that are due
+        """
+        self.db.notif_digests.create_index([("due", pymongo.ASCENDING)], sparse=True)
+
+    def add_to_digests(self, user_names: list, item: dict, window_seconds: float, max_items: int):
+        """
+        Adds a notification to the digests of users. A digest with nothing pending
+        becomes due window_seconds from now; later notifications join it until then
+
+        Parameters:
+         - user_names: the users to notify
+         - item: the notification, {"board_id", "post_id", "board_name", "message"}
+         - window_seconds: how long notifications are coalesced for
+         - max_items: the most notifications a digest keeps
+        """
+        if not user_names:
+            return
+        due = datetime.datetime.now() + timedelta(seconds=window_seconds)
+        self.db.notif_digests.bulk_write([
+            pymongo.UpdateOne({"_id": u},
+                              {"$push": {"pending": {"$each": [item], "$slice": -max_items}},
+                               "$min": {"due": due}},
+                              upsert=True)
+            for u in user_names], ordered=False)
+
+    def fetch_due_digests(self, limit: int):
+        """
+        Finds the users whose digests are due
+
+        Parameters:
+         - limit: the maximum number of users to return
+        Return: array of usernames
+        """
+        now = datetime.datetime.now()
+        return [d["_id"] for d in self.db.notif_digests.find({"due": {"$lte": now}}, {"_id": 1}).limit(limit)]
+
+    def claim_digest(self, user_name: str):
+        """
+        Takes a user's due notifications, so that only one caller pushes them
+
+        Parameters:
+         - user_name: the user
+        Return: the digest as it was before being claimed, or None if it is not due (anymore)
+        """
+        now = datetime.datetime.now()
+        return self.db.notif_digests.find_one_and_update({"_id": user_name, "due": {"$lte": now}},
+                                                         {"$unset": {"due": "", "pending": ""}})
+
+    def add_recent_digests(self, user_name: str, items: list, max_items: int):
+        """
+        Records notifications that were just pushed in a user's digest
+
+        Parameters:
+         - user_name: the user
+         - items: the notifications pushed
+         - max_items: the most notifications a digest keeps
+        """
+        if not items:
+            return
+        now = datetime.datetime.now()
+        self.db.notif_digests.update_one({"_id": user_name},
+                                         {"$push": {"recent": {"$each": [dict(i, sent=now) for i in items],
+                                                               "$slice": -max_items}}})
+
+    def fetch_users_push_subscriptions(self, user_names: list):
+        """
+        Lists the devices of several users at once
+
+        Parameters:
+         - user_names: the users
+        Return: array of {"username", "endpoint", "keys"}
+        """
+        return list(self.db.push_subscriptions.find({"username": {"$in": user_names}},
+                                                    {"_id": 0, "username": 1, "endpoint": 1, "keys": 1}))
+
+    def ensure_notif_ledger(self):
+        """
+        Creates the indexes used to query the notification delivery ledger
+        """
+        ledger = self.db.notif_ledger
+        ledger.create_index([("started", pymongo.DESCENDING)])
+        ledger.create_index([("board_id", pymongo.ASCENDING), ("started", pymongo.DESCENDING)])
+
+    def record_fanout_ledger(self, boardid: ObjectId, post_id: ObjectId, queued: datetime.datetime,
+                             started: datetime.datetime, finished: datetime.datetime, recipients: int,
+                             counts: dict, services: dict):
+        """
+        Adds the results of a fan-out (or of one of its batches) to the post's ledger entry
+
+        Parameters:
+         - boardid: the board of the post
+         - post_id: the post notified about
+         - queued: when the notification was queued, or None if unknown
+         - started: when this part of the fan-out started
+         - finished: when this part of the fan-out finished
+         - recipients: number of push subscriptions targeted by this part
+         - counts: number of pushes by result ("sent", "failed", "pruned", "retried")
+         - services: per push service key, {"origin", "pushes", "timed", "latency_ms", "max_latency_ms", and the counts}
+        """
+        inc = {"recipients": recipients}
+        inc.update(counts)
+        earliest = {"started": started}
+        latest = {"finished": finished}
+        origins = {"board_id": boardid}
+        if queued != None:
+            earliest["queued"] = queued
+        for key, service in services.items():
+            for field, value in service.items():
+                if field == "origin":
+                    origins["services.%s.origin" % key] = value
+                elif field == "max_latency_ms":
+                    latest["services.%s.max_latency_ms" % key] = value
+                else:
+                    inc["services.%s.%s" % (key, field)] = value
+        self.db.notif_ledger.update_one({"_id": post_id},
+                                        {"$set": origins, "$inc": inc, "$min": earliest, "$max": latest},
+                                        upsert=True)
+
+    def fetch_fanout_ledger(self, limit: int, boardid: ObjectId = None, post_id: ObjectId = None):
+        """
+        Fetches notification ledger entries, most recent fan-outs first
+
+        Parameters:
+         - limit: the maximum number of entries to return
+         - boardid: only return fan-outs of this board, if given
+         - post_id: only return the fan-out of this post, if given
+        Return: array of ledger entries
+        """
+        query = {}
+        if boardid != None:
+            query["board_id"] = boardid
+        if post_id != None:
+            query["_id"] = post_id
+        return list(self.db.notif_ledger.find(query).sort("started", pymongo.DESCENDING).limit(limit))
+
+    def ensure_notif_inbox(self, size_bytes: int):
+        """
+        Creates the capped notification inbox collection and its index if they do not exist yet
+
+        Parameters:
+         - size_bytes: the maximum size of the collection, after which the oldest notifications are dropped
+        """
+        if "notif_inbox" not in self.db.list_collection_names():
+            try:
+                self.db.create_collection("notif_inbox", capped=True, size=size_bytes)
+            except pymongo.errors.CollectionInvalid:
+                pass # Created concurrently by another worker
+        self.db.notif_inbox.create_index([("username", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
+
+    def iter_board_members(self, boardid: ObjectId, batch_size: int):
+        """
+        Streams the usernames of every member of a board, with or without devices
+
+        Parameters:
+         - boardid: the board
+         - batch_size: the number of usernames per yielded batch
+        Return: generator of lists of usernames
+        """
+        cursor = self.db.users.find({"subscriptions": boardid}, {"_id": 0, "username": 1}, batch_size=batch_size)
+        batch = []
+        for user in cursor:
+            batch.append(user["username"])
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def add_to_inbox(self, user_names: list, item: dict):
+        """
+        Adds a notification to the inboxes of users
+
+        Parameters:
+         - user_names: the users to notify
+         - item: the notification, {"board_id", "post_id", "board_name", "message"}
+        """
+        if not user_names:
+            return
+        now = datetime.datetime.now()
+        self.db.notif_inbox.insert_many([dict(item, username=u, date=now) for u in user_names], ordered=False)
+
+    def fetch_inbox(self, user_name: str, after_id: ObjectId = None, limit: int = 20):
+        """
+        Fetches the notifications of a user's inbox
+
+        Parameters:
+         - user_name: the user
+         - after_id: only return notifications added after this one, if given
+         - limit: the maximum number of notifications to return
+        Return: array of notifications, oldest first. Without after_id, the latest ones
+        """
+        inbox = self.db.notif_inbox
+        if after_id is None:
+            latest = inbox.find({"username": user_name}, {"username": 0}).sort("_id", pymongo.DESCENDING).limit(limit)
+            return list(reversed(list(latest)))
+        return list(inbox.find({"username": user_name, "_id": {"$gt": after_id}}, {"username": 0})
+                    .sort("_id", pymongo.ASCENDING).limit(limit))
+
+    def fetch_last_inbox_id(self):
+        """
+        Return: the id of the notification last added to any inbox, or None if they are all empty
+        """
+        last = self.db.notif_inbox.find_one({}, {"_id": 1}, sort=[("$natural", pymongo.DESCENDING)])
+        return last["_id"] if last else None
+
+    def tail_inbox(self, after_id: ObjectId = None, max_await_ms: int = 1000):
+        """
+        Opens a tailable cursor on the notifications added to any inbox, in insertion order
+
+        Parameters:
+         - after_id: skip the notifications up to this one, if given
+         - max_await_ms: how long each fetch waits for new notifications on the server
+        Return: a cursor of {"_id", "username"}, alive until the collection wraps past its position
+        """
+        query = {"_id": {"$gt": after_id}} if after_id is not None else {}
+        return self.db.notif_inbox.find(query, {"username": 1},
+                                        cursor_type=pymongo.CursorType.TAILABLE_AWAIT).max_await_time_ms(max_await_ms)
+
+    def ensure_api_tokens(self):
+        """
+        Creates the index listing a user's API tokens
+        """
+        self.db.api_tokens.create_index([("userid", pymongo.ASCENDING)])
+
+    def add_api_token(self, userid: ObjectId, name: str):
+        """
+        Creates an API token for a user
+
+        Parameters:
+         - userid: the id of the user
+         - name: name of the token, to tell it apart from the user's other tokens
+        Return: the id of the token
+        """
+        return self.db.api_tokens.insert_one({"userid": userid,
+                                              "name": name,
+                                              "created": datetime.datetime.now()}).inserted_id
+
+    def fetch_api_token(self, token_id: ObjectId):
+        """
+        Fetches an API token that has not been revoked
+
+        Parameters:
+         - token_id: the id of the token
+        Return: the token entry
+        Error: return None if the token does not exist or was revoked
+        """
+        return self.db.api_tokens.find_one({"_id": token_id, "revoked": {"$exists": False}})
+
+    def fetch_api_tokens(self, userid: ObjectId):
+        """
+        Lists the API tokens of a user that have not been revoked
+
+        Parameters:
+         - userid: the id of the user
+        Return: array of token entries, oldest first
+        """
+        return list(self.db.api_tokens.find({"userid": userid, "revoked": {"$exists": False}}).sort("_id", pymongo.ASCENDING))
+
+    def revoke_api_token(self, userid: ObjectId, token_id: ObjectId):
+        """
+        Revokes one of a user's API tokens
+
+        Parameters:
+         - userid: the id of the user owning the token
+         - token_id: the id of the token
+        Return: whether a token was revoked
+        """
+        result = self.db.api_tokens.update_one({"_id": token_id, "userid": userid, "revoked": {"$exists": False}},
+                                               {"$set": {"revoked": datetime.datetime.now()}})
+        return result.modified_count == 1
+
+    def touch_versions(self, keys: list):
+        """
+        Gives resources new version stamps, after they were written to. Readers compare stamps
+        to tell whether anything changed without reading the resources themselves. This is one
+        round trip (a single bulk write) on top of the write itself, which endpoint round-trip
+        budgets (see db_monitor.py) include
+
+        Parameters:
+         - keys: the ids of the boards and posts written to, and BOARDS_VERSION if the board list changed
+        """
+        if not keys:
+            return
+        version = ObjectId()
+        self.db.versions.bulk_write([pymongo.UpdateOne({"_id": key}, {"$set": {"version": version}}, upsert=True)
+                                     for key in set(keys)], ordered=False)
+
+    def fetch_versions(self, keys: list):
+        """
+        Fetches the version stamps of resources, in one round trip
+
+        Parameters:
+         - keys: the ids of the boards and posts, or BOARDS_VERSION
+        Return: dictionary of key to stamp. Resources not written since stamps were introduced have none
+        """
+        return {v["_id"]: v["version"] for v in self.db.versions.find({"_id": {"$in": list(keys)}})}
@@ -0,0 +1,309 @@
+"""
+Micro-benchmarks for database interaction
+
+Every AppDB operation is run repeatedly against a seeded local MongoDB instance. For
+each operation we report the p50/p95/p99 latency, the throughput (ops/sec) and how many
+MongoDB commands (round trips) a single call makes. Results are stored as JSON so a run
+can be compared against a saved baseline to flag regressions.
+
+The benchmarks use their own database (p2_bench by default) which is dropped and
+reseeded on every run, so they never touch the app's data.
+
+To run the benchmarks do the following:
+    Basic run, printing a results table:
+        $ python3 db_bench.py
+    Save the results to use as a baseline later on:
+        $ python3 db_bench.py --output bench_baseline.json
+    Compare a run against a saved baseline (exits with status 1 on regression):
+        $ python3 db_bench.py --baseline bench_baseline.json --tolerance 0.25
+"""
+
+import argparse
+import datetime
+import json
+import math
+import sys
+import time
+
+import pymongo
+from bson.objectid import ObjectId
+
+import db_monitor
+from db import AppDB
+
+# The database the benchmarks seed and run against
+BENCH_DB_NAME = "p2_bench"
+
+
+class BenchState:
+    """
+    Holds the seeded data (users, boards, posts) that benchmarks operate on
+    """
+
+    def __init__(self, app_db: AppDB, args):
+        self.db = app_db
+        self.args = args
+        self.admin = "bench_admin"
+        self.usernames = []
+        self.user_ids = []
+        self.small_board = None
+        self.huge_board = None
+        self.write_board = None
+        self.vote_board = None
+        self.vote_posts = []
+        self.atomic_vote_board = None
+        self.atomic_vote_posts = []
+        self.comment_post = None
+
+    def seed(self):
+        """
+        Drops the benchmark database and fills it with users, boards, posts and comments
+        """
+        db = self.db.db
+        self.db.client.drop_database(db.name)
+
+        # Users, one of which is the administrator performing deletions
+        self.db.add_user(self.admin, "bench")
+        self.db.add_admin(None, self.admin)
+        for i in range(self.args.users):
+            username = "bench_user_%d" % i
+            self.user_ids.append(self.db.add_user(username, "bench"))
+            self.usernames.append(username)
+
+        # Filler boards for searching, some of which are old enough to be purged
+        old_date = datetime.datetime.now() - datetime.timedelta(days=365)
+        for i in range(self.args.boards):
+            board_id = self.db.create_board(None, self.admin, "bench-%d" % i, "filler board %d" % i, 50)
+            if i % 2 == 0:
+                db.boards.update_one({"_id": board_id}, {"$set": {"board_date": old_date}})
+
+        # Small board, huge board, and boards that absorb writes
+        self.small_board = self._make_board("bench-small", self.args.small_posts, min(10, self.args.users))
+        self.huge_board = self._make_board("bench-huge", self.args.huge_posts, self.args.users)
+        self.write_board = self._make_board("bench-write", 0, self.args.users)
+        self.vote_board = self._make_board("bench-vote", 0, self.args.users)
+        # A threshold of 100 means only the last vote on each post crosses it
+        self.atomic_vote_board = self._make_board("bench-vote-atomic", 0, self.args.users, 100)
+
+        # Enough posts so every timed upvote is a fresh (user, post) pair
+        vote_posts = math.ceil((self.args.iterations + self.args.warmup) / self.args.users)
+        for i in range(vote_posts):
+            self.vote_posts.append(self.db.create_post(None, self.usernames[0], self.vote_board, "vote %d" % i, "vote post"))
+            self.atomic_vote_posts.append(self.db.create_post(None, self.usernames[0], self.atomic_vote_board, "vote %d" % i, "vote post"))
+
+        # Post with a populated comments container
+        self.comment_post = self.db.create_post(None, self.usernames[0], self.write_board, "comments", "comment post")
+        comments = [{"_id": ObjectId(),
+                     "comment_owner": self.user_ids[i % len(self.user_ids)],
+                     "comment_message": "comment %d" % i,
+                     "comment_date": datetime.datetime.now(),
+                     "comment_upvotes": i % 7,
+                     "comment_upvoters": []} for i in range(self.args.comments)]
+        db.comments.update_one({"post_id": self.comment_post}, {"$set": {"comments": comments}})
+
+    def _make_board(self, name: str, posts: int, members: int, threshold: int = 50):
+        """
+        Creates a board with the given number of posts and subscribed members
+        """
+        board_id = self.db.create_board(None, self.admin, name, "benchmark board", threshold)
+        for username in self.usernames[:members]:
+            self.db.subscribe_board(None, username, board_id)
+        for i in range(posts):
+            self.db.create_post(None, self.usernames[i % members], board_id, "post %d" % i, "benchmark post")
+        return board_id
+
+
+def bench_operations(state: BenchState):
+    """
+    Returns the benchmarked operations as a dictionary of name to (setup, call) pairs.
+
+    setup runs untimed before every call and returns the argument passed to the call;
+    it may be None when no per-iteration setup is needed
+    """
+    db = state.db
+    users = state.usernames
+
+    def upvote_setup(i):
+        return users[i % len(users)], state.vote_posts[i // len(users)]
+
+    def atomic_upvote_setup(i):
+        return state.user_ids[i % len(users)], state.atomic_vote_posts[i // len(users)]
+
+    def subscribe_setup(i):
+        username = users[i % len(users)]
+        db.unsubscribe_board(None, username, state.small_board)
+        return username
+
+    def delete_setup(i):
+        board_id = db.create_board(None, state.admin, "bench-delete-%d" % i, "doomed board", 50)
+        for username in users[:10]:
+            db.subscribe_board(None, username, board_id)
+        for j in range(5):
+            db.create_post(None, users[0], board_id, "post %d" % j, "doomed post")
+        return board_id
+
+    return {
+        "fetch_boards": (None, lambda i, a: db.fetch_boards("", 0, False)),
+        "fetch_boards_search": (None, lambda i, a: db.fetch_boards("bench-1", 0, False)),
+        "fetch_board_small": (None, lambda i, a: db.fetch_board(state.small_board)),
+        "fetch_board_huge": (None, lambda i, a: db.fetch_board(state.huge_board)),
+        "fetch_versions": (None, lambda i, a: db.fetch_versions([state.huge_board])),
+        "create_post": (None, lambda i, a: db.create_post(None, users[i % len(users)], state.write_board, "new %d" % i, "new post")),
+        "upvote_post": (upvote_setup, lambda i, a: db.upvote_post(None, a[0], state.vote_board, a[1])),
+        "upvote_post_atomic": (atomic_upvote_setup, lambda i, a: db.upvote_post_atomic(a[0], None, state.atomic_vote_board, a[1])),
+        "add_comment": (None, lambda i, a: db.add_comment(None, users[0], state.write_board, state.comment_post, "comment %d" % i)),
+        "fetch_comments": (None, lambda i, a: db.fetch_comments(state.comment_post)),
+        "subscribe_board": (subscribe_setup, lambda i, a: db.subscribe_board(None, a, state.small_board)),
+        "delete_board": (delete_setup, lambda i, a: db.delete_board(None, state.admin, a)),
+        "purge_boards": (None, lambda i, a: db.purge_boards(180)),
+    }
+
+
+def percentile(samples: list, pct: float):
+    """
+    Returns the nearest-rank percentile of a sorted list of samples
+    """
+    if not samples:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(samples)))
+    return samples[rank - 1]
+
+
+def run_benchmark(setup, call, iterations: int, warmup: int):
+    """
+    Times a single operation
+
+    Parameters:
+     - setup: untimed per-iteration setup (or None)
+     - call: the timed operation
+     - iterations: number of timed calls
+     - warmup: number of untimed calls made first
+    Returns:
+     - A dictionary of latency percentiles (ms), throughput and commands per call
+    """
+    samples = []
+    commands = 0
+    for i in range(warmup + iterations):
+        arg = setup(i) if setup is not None else None
+        with db_monitor.track() as tracker:
+            start = time.perf_counter()
+            call(i, arg)
+            elapsed = time.perf_counter() - start
+        if i >= warmup:
+            samples.append(elapsed)
+            commands += tracker.count()
+    total = sum(samples)
+    samples.sort()
+    return {
+        "iterations": iterations,
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "mean_ms": round(total / iterations * 1000, 3),
+        "ops_per_sec": round(iterations / total, 1) if total > 0 else 0.0,
+        "commands_per_call": round(commands / iterations, 2),
+    }
+
+
+def compare_results(results: dict, baseline: dict, tolerance: float):
+    """
+    Compares benchmark results against a baseline
+
+    An operation regresses when its p95 latency grows or its throughput drops by more
+    than the tolerance, or when it makes more MongoDB commands per call than before
+
+    Parameters:
+     - results: the "results" dictionary of the current run
+     - baseline: the "results" dictionary of the baseline run
+     - tolerance: allowed relative slowdown, for example 0.2 for 20%
+    Returns:
+     - A list of human readable regression messages (empty if there are none)
+    """
+    regressions = []
+    for name, base in baseline.items():
+        curr = results.get(name)
+        if curr is None:
+            continue
+        if curr["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append("%s: p95 %.3fms -> %.3fms" % (name, base["p95_ms"], curr["p95_ms"]))
+        if curr["ops_per_sec"] < base["ops_per_sec"] * (1 - tolerance):
+            regressions.append("%s: throughput %.1f -> %.1f ops/sec" % (name, base["ops_per_sec"], curr["ops_per_sec"]))
+        if curr["commands_per_call"] > base["commands_per_call"]:
+            regressions.append("%s: commands per call %.2f -> %.2f" % (name, base["commands_per_call"], curr["commands_per_call"]))
+    return regressions
+
+
+def print_table(results: dict):
+    """
+    Prints the results as a table
+    """
+    header = "%-22s %10s %10s %10s %12s %10s" % ("operation", "p50 ms", "p95 ms", "p99 ms", "ops/sec", "cmds/call")
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        print("%-22s %10.3f %10.3f %10.3f %12.1f %10.2f" % (name, r["p50_ms"], r["p95_ms"], r["p99_ms"], r["ops_per_sec"], r["commands_per_call"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks AppDB operations against a local MongoDB")
+    parser.add_argument("--db-link", default="mongodb://localhost:27017", help="the MongoDB instance to benchmark against")
+    parser.add_argument("--iterations", type=int, default=200, help="timed calls per operation")
+    parser.add_argument("--warmup", type=int, default=20, help="untimed calls made before timing")
+    parser.add_argument("--users", type=int, default=100, help="number of seeded users")
+    parser.add_argument("--boards", type=int, default=200, help="number of seeded filler boards")
+    parser.add_argument("--small-posts", type=int, default=10, help="posts on the small board")
+    parser.add_argument("--huge-posts", type=int, default=2000, help="posts on the huge board")
+    parser.add_argument("--comments", type=int, default=200, help="comments on the benchmarked post")
+    parser.add_argument("--only", nargs="*", help="only run the named operations")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    parser.add_argument("--baseline", help="JSON results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown before flagging a regression")
+    args = parser.parse_args()
+
+    # Reply sizes are not measured so that re-encoding replies does not skew timings
+    client = pymongo.MongoClient(args.db_link, event_listeners=[db_monitor.CommandAccounting(measure_bytes=False)])
+    state = BenchState(AppDB(client, BENCH_DB_NAME), args)
+    print("Seeding benchmark database %s..." % BENCH_DB_NAME)
+    state.seed()
+
+    results = {}
+    for name, (setup, call) in bench_operations(state).items():
+        if args.only and name not in args.only:
+            continue
+        print("Running %s..." % name)
+        results[name] = run_benchmark(setup, call, args.iterations, args.warmup)
+
+    report = {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(),
+            "mongo_version": client.server_info().get("version"),
+            "iterations": args.iterations,
+            "users": args.users,
+            "huge_posts": args.huge_posts,
+        },
+        "results": results,
+    }
+    client.drop_database(BENCH_DB_NAME)
+    client.close()
+
+    print()
+    print_table(results)
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(report, outfile, indent=4)
+        print("\nResults written to %s" % args.output)
+
+    if args.baseline:
+        with open(args.baseline) as basefile:
+            baseline = json.load(basefile)
+        regressions = compare_results(results, baseline.get("results", {}), args.tolerance)
+        if regressions:
+            print("\nRegressions against %s:" % args.baseline)
+            for r in regressions:
+                print(" - " + r)
+            sys.exit(1)
+        print("\nNo regressions against %s" % args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,7 @@ import pymongo
 import logging
 
 import db
+import db_monitor
 import config
 
 
@@ -24,7 +25,7 @@ def get_db():
     try:
         app_db_client = getattr(ctx, "app_db_client", None)
         if app_db_client is None:
-            ctx.app_db_client = pymongo.MongoClient(config.get("db_link", ""))
+            ctx.app_db_client = pymongo.MongoClient(config.get("db_link", ""), event_listeners=db_monitor.event_listeners())
             ctx.app_db = db.AppDB(ctx.app_db_client)
         return ctx.app_db
     except:
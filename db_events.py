@@ -0,0 +1,121 @@
+"""
+In-process pub/sub hub for live database events
+
+AppDB write paths publish small delta events (a post's vote count changed, a new post,
+a new comment, a post was notified) on per-board and per-post channels. Server-Sent
+Events streams (see server_events.py) subscribe to the channels their page shows, so
+clients no longer poll the full board or post to stay current.
+
+The hub lives in the process memory, so a stream only sees writes made by the same
+process. Each subscriber has a bounded queue; a subscriber too slow to keep up loses
+its queued events and is told to resync (fetch the full document once) instead of
+holding on to an ever-growing backlog.
+"""
+
+import queue
+import threading
+
+# Event telling a subscriber that it missed events and should fetch the full document
+RESYNC = "resync"
+
+# Subscribers by channel
+_subscribers = {}
+_lock = threading.Lock()
+
+
+def board_channel(board_id):
+    """
+    Returns the channel of a board's events (new posts, votes and notifications of its posts)
+    """
+    return "board:%s" % board_id
+
+
+def post_channel(post_id):
+    """
+    Returns the channel of a post's events (votes, comments and its notification)
+    """
+    return "post:%s" % post_id
+
+
+class Subscription:
+    """
+    The queue of events published on a set of channels for one subscriber
+    """
+
+    def __init__(self, channels: list, max_pending: int):
+        self.channels = channels
+        self.events = queue.Queue(maxsize=max_pending)
+        self.missed = False
+
+    def put(self, event: str, data: dict):
+        try:
+            self.events.put_nowait((event, data))
+        except queue.Full:
+            self.missed = True
+
+    def get(self, timeout: float):
+        """
+        Waits for the next event
+
+        Parameters:
+         - timeout: seconds to wait
+        Returns:
+         - The (event, data) pair, (RESYNC, None) if events were dropped, or None on timeout
+        """
+        if self.missed:
+            self.missed = False
+            while True:
+                try:
+                    self.events.get_nowait()
+                except queue.Empty:
+                    break
+            return RESYNC, None
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+def subscribe(channels: list, max_pending: int = 100):
+    """
+    Starts receiving the events published on channels
+
+    Parameters:
+     - channels: the channels to listen to
+     - max_pending: events queued before the subscriber is told to resync
+    Returns:
+     - A Subscription, which must be passed to unsubscribe when done
+    """
+    subscription = Subscription(channels, max_pending)
+    with _lock:
+        for channel in channels:
+            _subscribers.setdefault(channel, set()).add(subscription)
+    return subscription
+
+
+def unsubscribe(subscription: Subscription):
+    with _lock:
+        for channel in subscription.channels:
+            subscribers = _subscribers.get(channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del _subscribers[channel]
+
+
+def publish(channels: list, event: str, data: dict):
+    """
+    Sends an event to every subscriber of the given channels. Never blocks, and costs
+    nothing when nobody is listening
+
+    Parameters:
+     - channels: the channels to publish on
+     - event: the name of the event
+     - data: the event's data, which subscribers must not modify
+    """
+    with _lock:
+        targets = set()
+        for channel in channels:
+            targets.update(_subscribers.get(channel, ()))
+    for subscription in targets:
+        subscription.put(event, data)
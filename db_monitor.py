@@ -0,0 +1,394 @@
+"""
+Accounts for every MongoDB command (round trip) made by the server
+
+A pymongo command listener is attached to the MongoClient created in db_connect. Each
+command is recorded (collection, operation, duration, documents returned, reply size)
+against whatever is tracking the current thread. During a Flask request that is the
+request itself, so the commands are attributed to the endpoint that made them and a
+per-request summary is logged once the request finishes.
+
+Endpoints may declare a round-trip budget, either with the round_trip_budget decorator
+or through the "db_budgets" config entry (endpoint name to maximum commands). Requests
+that exceed their budget are logged, and raise BudgetExceeded when the app is set to
+strict mode (app.config["DB_BUDGET_STRICT"] = True) so tests can fail on them.
+
+AppDB methods are also timed as a whole. Observers registered with add_call_observer
+receive the method name and duration of every AppDB call, and current_appdb_method
+reports which AppDB method is running on the current thread. A slow call handler
+(see set_slow_call_handler) additionally receives the full commands made by any AppDB
+call that exceeds a threshold.
+"""
+
+import collections
+import functools
+import inspect
+import logging
+import threading
+import time
+
+import bson
+import flask
+from pymongo import monitoring
+
+import config
+import db
+
+# A single command made to the database
+# The command document itself is only kept when a tracker asks for it
+CommandRecord = collections.namedtuple("CommandRecord", ["database", "collection", "operation", "duration_ms", "docs", "bytes", "ok", "command"])
+
+# Thread-local stack of active trackers and the running AppDB method
+_local = threading.local()
+
+# Functions called with (method name, duration in seconds) after every AppDB call
+_call_observers = []
+
+# Called with (method name, duration in seconds, commands) after AppDB calls slower than _slow_call_ms
+_slow_call_handler = None
+_slow_call_ms = None
+
+
+class BudgetExceeded(AssertionError):
+    """
+    Raised in strict mode when an endpoint makes more database commands than its budget
+    """
+
+
+class CommandTracker:
+    """
+    Collects the commands made on one thread while it is active
+    """
+
+    def __init__(self, name: str = None, keep_commands: bool = False):
+        """
+        Parameters:
+         - name: what is being tracked, such as the endpoint name
+         - keep_commands: whether to keep the full command documents
+        """
+        self.name = name
+        self.keep_commands = keep_commands
+        self.commands = []
+        self.started = time.perf_counter()
+
+    def count(self):
+        """
+        Returns the number of commands (round trips) recorded
+        """
+        return len(self.commands)
+
+    def total_ms(self):
+        """
+        Returns the total time spent waiting on the database in milliseconds
+        """
+        return sum(c.duration_ms for c in self.commands)
+
+    def summary(self):
+        """
+        Returns the commands grouped by "collection.operation", each with a count and total duration
+        """
+        groups = {}
+        for c in self.commands:
+            key = "%s.%s" % (c.collection, c.operation)
+            count, duration = groups.get(key, (0, 0.0))
+            groups[key] = (count + 1, duration + c.duration_ms)
+        return groups
+
+    def __enter__(self):
+        _trackers().append(self)
+        return self
+
+    def __exit__(self, *exc):
+        stack = _trackers()
+        if self in stack:
+            stack.remove(self)
+        return False
+
+
+def _trackers():
+    """
+    Returns the tracker stack for the current thread
+    """
+    stack = getattr(_local, "trackers", None)
+    if stack is None:
+        stack = _local.trackers = []
+    return stack
+
+
+def track(name: str = None):
+    """
+    Returns a context manager that records every command made on this thread while open.
+    Useful for tests and benchmarks that call AppDB directly:
+
+        with db_monitor.track() as tracker:
+            app_db.fetch_board(board_id)
+        assert tracker.count() <= 2
+    """
+    return CommandTracker(name)
+
+
+class CommandAccounting(monitoring.CommandListener):
+    """
+    Command listener that records each command against the active trackers of the
+    thread that issued it. Listener callbacks run on the issuing thread, so the
+    thread-local trackers identify who made the command
+    """
+
+    def __init__(self, measure_bytes: bool = True):
+        """
+        Parameters:
+         - measure_bytes: whether to measure reply sizes, which means re-encoding every reply
+        """
+        self.measure_bytes = measure_bytes
+        self._pending = {}
+
+    def started(self, event):
+        stack = _trackers()
+        if not stack:
+            return
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = event.database_name
+        command = event.command if any(t.keep_commands for t in stack) else None
+        self._pending[event.request_id] = (event.database_name, collection, event.command_name, command)
+
+    def succeeded(self, event):
+        self._finish(event, event.reply, True)
+
+    def failed(self, event):
+        self._finish(event, None, False)
+
+    def _finish(self, event, reply, ok):
+        pending = self._pending.pop(event.request_id, None)
+        stack = _trackers()
+        if pending is None or not stack:
+            return
+        docs = 0
+        size = 0
+        if reply is not None:
+            cursor = reply.get("cursor")
+            if isinstance(cursor, dict):
+                docs = len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+            elif reply.get("value") is not None:
+                docs = 1
+            if self.measure_bytes:
+                size = len(bson.encode(reply))
+        database, collection, operation, command = pending
+        record = CommandRecord(database, collection, operation, event.duration_micros / 1000, docs, size, ok, command)
+        for tracker in stack:
+            tracker.commands.append(record)
+
+
+# The listener attached to the server's MongoClient
+listener = CommandAccounting(measure_bytes=config.get("db_monitor_bytes", True))
+
+
+def enabled():
+    """
+    Returns whether per-request command accounting is turned on
+    """
+    return bool(config.get("db_monitor", False))
+
+
+def event_listeners():
+    """
+    Returns the event listeners to pass to a new MongoClient
+    """
+    return [listener] if enabled() or _slow_call_handler is not None else []
+
+
+def round_trip_budget(max_commands: int):
+    """
+    Declares the maximum number of database commands a view function may make per request
+
+    Parameters:
+     - max_commands: the round-trip budget
+    """
+    def decorator(view):
+        view.db_budget = max_commands
+        return view
+    return decorator
+
+
+def get_budget(app, endpoint: str):
+    """
+    Returns the round-trip budget of an endpoint, or None if it has none. The config
+    entry "db_budgets" takes precedence over budgets declared with round_trip_budget
+    """
+    budgets = config.get("db_budgets", {})
+    if endpoint in budgets:
+        return budgets[endpoint]
+    view = app.view_functions.get(endpoint)
+    return getattr(view, "db_budget", None)
+
+
+def current_request_tracker():
+    """
+    Returns the tracker of the current request, or None if accounting is off
+    """
+    return flask.g.get("db_tracker", None)
+
+
+def init_app(app):
+    """
+    Hooks per-request command accounting into the Flask app
+
+    Parameters:
+     - app: the Flask app
+    """
+    logger = logging.getLogger("db")
+
+    @app.before_request
+    def _start_tracking():
+        if not enabled():
+            return
+        tracker = CommandTracker(flask.request.endpoint)
+        tracker.__enter__()
+        flask.g.db_tracker = tracker
+
+    @app.after_request
+    def _check_tracking(response):
+        tracker = current_request_tracker()
+        if tracker is None:
+            return response
+        tracker.__exit__()
+        elapsed = (time.perf_counter() - tracker.started) * 1000
+        details = ", ".join("%s x%d %.1fms" % (key, count, duration) for key, (count, duration) in sorted(tracker.summary().items()))
+        logger.info("%s: %d db commands, %.1fms in db of %.1fms total [%s]",
+                    tracker.name, tracker.count(), tracker.total_ms(), elapsed, details)
+
+        budget = get_budget(app, tracker.name)
+        if budget is not None and tracker.count() > budget:
+            msg = "%s made %d db commands, over its budget of %d" % (tracker.name, tracker.count(), budget)
+            if app.config.get("DB_BUDGET_STRICT", False):
+                raise BudgetExceeded(msg)
+            logger.warning(msg)
+        return response
+
+    @app.teardown_request
+    def _stop_tracking(error=None):
+        tracker = current_request_tracker()
+        if tracker is not None:
+            tracker.__exit__()
+
+
+def add_call_observer(observer):
+    """
+    Registers a function to be called with (method name, duration in seconds) after every AppDB call
+
+    Parameters:
+     - observer: the function to call
+    """
+    if observer not in _call_observers:
+        _call_observers.append(observer)
+
+
+def set_slow_call_handler(threshold_ms: float, handler):
+    """
+    Registers a function to be called with (method name, duration in seconds, commands)
+    after any AppDB call slower than the threshold. The commands are the CommandRecords
+    (including full command documents) made during the call
+
+    Parameters:
+     - threshold_ms: the duration in milliseconds above which a call is slow
+     - handler: the function to call
+    """
+    global _slow_call_handler, _slow_call_ms
+    _slow_call_ms = threshold_ms
+    _slow_call_handler = handler
+
+
+def current_appdb_method():
+    """
+    Returns the name of the outermost AppDB method running on this thread, or None
+    """
+    return getattr(_local, "appdb_method", None)
+
+
+def _timed_method(name: str, method):
+    """
+    Wraps an AppDB method so that its duration is reported to the call observers
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        outer = current_appdb_method()
+        tracker = None
+        if outer is None:
+            _local.appdb_method = name
+            if _slow_call_handler is not None:
+                tracker = CommandTracker(name, keep_commands=True).__enter__()
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            if outer is None:
+                _local.appdb_method = None
+                for observer in _call_observers:
+                    observer(name, elapsed)
+                if tracker is not None:
+                    tracker.__exit__()
+                    if elapsed * 1000 >= _slow_call_ms:
+                        _slow_call_handler(name, elapsed, tracker.commands)
+    return wrapper
+
+
+def _timed_generator(name: str, method):
+    """
+    Wraps an AppDB generator method so that the time spent producing its items, rather than
+    only creating the generator, is reported to the call observers once it is done. The
+    caller's work between items is not counted, nor attributed to the method
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        items = method(*args, **kwargs)
+        outer = current_appdb_method()
+        tracker = CommandTracker(name, keep_commands=True) if outer is None and _slow_call_handler is not None else None
+        elapsed = 0.0
+        try:
+            while True:
+                if outer is None:
+                    _local.appdb_method = name
+                    if tracker is not None:
+                        tracker.__enter__()
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                    if outer is None:
+                        _local.appdb_method = None
+                        if tracker is not None:
+                            tracker.__exit__()
+                yield item
+        finally:
+            items.close()
+            if outer is None:
+                for observer in _call_observers:
+                    observer(name, elapsed)
+                if tracker is not None and elapsed * 1000 >= _slow_call_ms:
+                    _slow_call_handler(name, elapsed, tracker.commands)
+    return wrapper
+
+
+def instrument_appdb(cls):
+    """
+    Wraps every public method of an AppDB class with timing. Nested AppDB calls are
+    attributed to the outermost method, and generator methods are timed over their iteration
+
+    Parameters:
+     - cls: the class to instrument
+    """
+    if getattr(cls, "_instrumented", False):
+        return cls
+    for name, attr in list(vars(cls).items()):
+        if inspect.isgeneratorfunction(attr) and not name.startswith("_"):
+            setattr(cls, name, _timed_generator(name, attr))
+        elif callable(attr) and not name.startswith("_"):
+            setattr(cls, name, _timed_method(name, attr))
+    cls._instrumented = True
+    return cls
+
+
+instrument_appdb(db.AppDB)
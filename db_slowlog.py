@@ -0,0 +1,179 @@
+"""
+Slow query log
+
+Any AppDB call slower than the "slow_query_ms" config entry is captured along with the
+shape of every command it made (values replaced by their types). The slowest of those
+commands is then run through explain("executionStats") to find out how many documents
+were examined versus returned and which index (if any) was used. Entries are stored in
+the capped slow_queries collection and shown on the admin page.
+
+Explaining happens on a background thread with its own database client so that slow
+requests are not slowed down further. If the thread falls behind, new entries are dropped.
+"""
+
+import datetime
+import logging
+import queue
+import threading
+
+import flask
+import pymongo
+from bson import json_util
+
+import config
+import db
+import db_monitor
+
+# Commands that explain() understands
+EXPLAINABLE = {"find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"}
+
+# Fields the driver adds to commands that must be stripped before explaining them
+DRIVER_FIELDS = {"lsid", "$db", "$clusterTime", "$readPreference", "txnNumber", "$query", "readConcern", "writeConcern"}
+
+# Entries waiting to be explained and stored
+_queue = queue.Queue(maxsize=100)
+
+# The background thread doing the explaining
+_worker = None
+
+
+def enabled():
+    """
+    Returns whether the slow query log is turned on
+    """
+    return config.get("slow_query_ms", None) is not None
+
+
+def query_shape(value):
+    """
+    Replaces the values in a command with their type names, so commands differing only
+    in their arguments have the same shape
+
+    Parameters:
+     - value: the command or part of a command
+    Returns:
+     - The shape of the value
+    """
+    if isinstance(value, dict):
+        return {k: query_shape(v) for k, v in value.items() if k not in DRIVER_FIELDS}
+    if isinstance(value, (list, tuple)):
+        if any(isinstance(v, (dict, list, tuple)) for v in value):
+            return [query_shape(v) for v in value] # Such as the clauses of $or, or pipeline stages
+        return [query_shape(value[0])] if value else []
+    return "<%s>" % type(value).__name__
+
+
+def summarize_explain(explain: dict):
+    """
+    Extracts the interesting parts of explain("executionStats") output
+
+    Parameters:
+     - explain: the raw explain output
+    Returns:
+     - A dictionary with documents/keys examined, documents returned, the plan stages and indexes used
+    """
+    stats = explain.get("executionStats", {})
+    planner = explain.get("queryPlanner", {})
+    if "stages" in explain:
+        # Aggregations nest the query planner under their first ($cursor) stage
+        cursor = explain["stages"][0].get("$cursor", {})
+        stats = cursor.get("executionStats", stats)
+        planner = cursor.get("queryPlanner", planner)
+
+    stages = []
+    indexes = []
+    def walk(plan):
+        if not isinstance(plan, dict):
+            return
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        if "indexName" in plan:
+            indexes.append(plan["indexName"])
+        for key in ("inputStage", "queryPlan"):
+            walk(plan.get(key))
+        for child in plan.get("inputStages", []):
+            walk(child)
+    walk(planner.get("winningPlan", {}))
+
+    return {
+        "docs_examined": stats.get("totalDocsExamined"),
+        "keys_examined": stats.get("totalKeysExamined"),
+        "docs_returned": stats.get("nReturned"),
+        "execution_ms": stats.get("executionTimeMillis"),
+        "stages": stages,
+        "indexes": indexes,
+        "collscan": "COLLSCAN" in stages,
+    }
+
+
+def _handle_slow_call(method: str, seconds: float, commands: list):
+    """
+    Queues a slow AppDB call to be explained and stored
+    """
+    if threading.current_thread() is _worker:
+        return # Never log the slow query log itself
+    entry = {
+        "method": method,
+        "duration_ms": round(seconds * 1000, 2),
+        "date": datetime.datetime.now(),
+        "endpoint": flask.request.endpoint if flask.has_request_context() else None,
+    }
+    try:
+        _queue.put_nowait((entry, commands))
+    except queue.Full:
+        logging.getLogger("db").warning("Slow query log is behind, dropping entry for %s", method)
+
+
+def _explain(client, record):
+    """
+    Runs explain("executionStats") on a recorded command
+
+    Returns:
+     - The summarized explain output, or a dictionary with "error" set if it could not be explained
+    """
+    command = {k: v for k, v in record.command.items() if k not in DRIVER_FIELDS}
+    try:
+        explain = client[record.database].command("explain", command, verbosity="executionStats")
+    except pymongo.errors.PyMongoError as e:
+        return {"error": str(e)}
+    return summarize_explain(explain)
+
+
+def _run_worker():
+    """
+    Explains and stores queued slow calls until the process exits
+    """
+    client = pymongo.MongoClient(config.get("db_link", ""))
+    app_db = db.AppDB(client)
+    app_db.ensure_slow_query_log(config.get("slow_query_log_bytes", 16 * 1024 * 1024))
+    while True:
+        entry, commands = _queue.get()
+        try:
+            entry["commands"] = [{
+                "collection": c.collection,
+                "operation": c.operation,
+                "duration_ms": round(c.duration_ms, 2),
+                "docs": c.docs,
+                "shape": json_util.dumps(query_shape(c.command)) if c.command is not None else None,
+            } for c in commands]
+            explainable = [c for c in commands if c.operation in EXPLAINABLE and c.command is not None]
+            if explainable:
+                slowest = max(explainable, key=lambda c: c.duration_ms)
+                entry["explain"] = _explain(client, slowest)
+                entry["explain"]["collection"] = slowest.collection
+                entry["explain"]["operation"] = slowest.operation
+            app_db.log_slow_query(entry)
+        except Exception:
+            logging.getLogger("db").error("Error occurred logging slow query", exc_info=True)
+
+
+def init():
+    """
+    Turns on the slow query log if it is configured
+    """
+    global _worker
+    if not enabled() or _worker is not None:
+        return
+    _worker = threading.Thread(target=_run_worker, name="slow-query-log", daemon=True)
+    _worker.start()
+    db_monitor.set_slow_call_handler(float(config.get("slow_query_ms", 0)), _handle_slow_call)
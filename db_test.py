@@ -116,6 +116,34 @@ class DBTests(unittest.TestCase):
         post=self.db.fetch_post(boardid,postid)
         self.assertEqual({},post)
 
+    def test_upvotethreshold(self):
+        username="tchen4"
+        username2="tchen5"
+        boardname="board5"
+        self.boards.delete_many({"board_name": boardname})
+        self.users.delete_many({"username": username2})
+        self.db.add_user(username2, "2121")
+        userid2=self.users.find_one({"username":username2})["_id"]
+        boardid=self.db.create_board(None,username,boardname,"1",50)
+        self.db.subscribe_board(None,username,boardid)
+        postid=self.db.create_post(None,username,boardid,"1","1")
+        post=self.db.fetch_post(boardid,postid)
+        self.assertEqual(1,post["votes_needed"])
+        self.db.subscribe_board(None,username2,boardid)
+        self.db.change_votethreshold(None,username,boardid,100)
+        post=self.db.fetch_post(boardid,postid)
+        self.assertEqual(2,post["votes_needed"])
+
+        # Only the vote reaching votes_needed triggers the notification, and only once
+        self.assertEqual((postid,False),self.db.upvote_post_atomic(None,username,boardid,postid))
+        self.assertEqual(None,self.db.upvote_post_atomic(None,username,boardid,postid))
+        self.assertEqual((postid,True),self.db.upvote_post_atomic(userid2,None,boardid,postid))
+        self.assertEqual(None,self.db.upvote_post_atomic(userid2,None,boardid,postid))
+        post=self.db.fetch_post(boardid,postid)
+        self.assertEqual(1,post["post_notified"])
+        self.db.delete_board(None,username,boardid)
+        self.db.remove_user(None,username2)
+
 
 if __name__ == "__main__":
     unittest.main(module="db_test")
\ No newline at end of file
@@ -0,0 +1,73 @@
+"""
+Benchmarks web push payload encryption across worker processes
+
+Every push needs an ECDH key agreement and AES-GCM encryption with the subscription's own
+keys. This encrypts one payload for each of a large synthetic set of subscriptions, first
+in this process and then with increasing numbers of encryption worker processes (as used
+by the async push engine), and reports encryptions per second for each.
+
+To run the benchmark:
+    $ python3 encrypt_bench.py --pushes 20000 --processes 1,2,4,8
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from push_async import ENCRYPT_CHUNK_SIZE
+from push_bench import make_subscriptions
+from push_sender import encrypt_batch
+
+
+def run(pushes: list, processes: int):
+    """
+    Encrypts every push, in this process if processes is 0
+
+    Returns:
+     - The elapsed seconds and the number of failed encryptions
+    """
+    chunks = [pushes[i:i + ENCRYPT_CHUNK_SIZE] for i in range(0, len(pushes), ENCRYPT_CHUNK_SIZE)]
+    if processes == 0:
+        start = time.perf_counter()
+        results = [encrypt_batch(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+            list(pool.map(encrypt_batch, [chunks[0]] * processes)) # Start every process before timing
+            start = time.perf_counter()
+            results = list(pool.map(encrypt_batch, chunks))
+    elapsed = time.perf_counter() - start
+    failures = sum(1 for chunk in results for _, error in chunk if error is not None)
+    return elapsed, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks push payload encryption across worker processes")
+    parser.add_argument("--pushes", type=int, default=20000, help="number of synthetic subscriptions")
+    parser.add_argument("--processes", default="1,2,4,%d" % os.cpu_count(), help="comma separated process counts to try")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    print("Generating %d subscriptions..." % args.pushes)
+    payload = json.dumps({"board_name": "bench", "message": "benchmark push", "username": "bench"})
+    pushes = [(s, payload) for s in make_subscriptions("https://push.example.com", args.pushes)]
+
+    results = {}
+    print("%-12s %10s %14s %10s %10s" % ("processes", "seconds", "encrypts/sec", "speedup", "failures"))
+    for processes in [0] + sorted({int(p) for p in args.processes.split(",")}):
+        elapsed, failures = run(pushes, processes)
+        rate = args.pushes / elapsed
+        name = "inline" if processes == 0 else str(processes)
+        results[name] = {"seconds": round(elapsed, 3), "encrypts_per_sec": round(rate, 1), "failures": failures}
+        print("%-12s %10.3f %14.1f %9.2fx %10d" % (name, elapsed, rate, rate / results["inline"]["encrypts_per_sec"], failures))
+
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump({"config": vars(args), "cpus": os.cpu_count(), "results": results}, outfile, indent=4)
+        print("Results written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
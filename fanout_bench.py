@@ -0,0 +1,169 @@
+"""
+Benchmarks notification fan-outs end to end against a local stand-in push service
+
+For each board size, a board with that many members (each with one device subscribed to
+the stand-in push service of push_bench.py) and one post are seeded. do_push_notifications
+is then called just like when a vote crosses the threshold, and the benchmark waits for the
+fan-out's delivery ledger entry (see notif_ledger.py). For each size we report the
+end-to-end time from the call until the last push, the fan-out time and push service
+latency recorded in the ledger, and the pushes per second.
+
+The benchmarks use their own database (p2_fanout_bench by default) which is dropped and
+reseeded for every board size, so they never touch the app's data.
+
+To run the benchmark:
+    $ python3 fanout_bench.py --sizes 100,10000,100000 --engine async --latency-ms 20
+"""
+
+import argparse
+import datetime
+import json
+import time
+
+import flask
+import pymongo
+
+import config
+import notif_dispatcher
+import notif_ledger
+import server_notifs
+from db import AppDB
+from push_bench import make_subscriptions, make_vapid_key, start_push_service
+
+# The database the benchmark seeds and runs against
+BENCH_DB_NAME = "p2_fanout_bench"
+
+
+def seed_board(app_db: AppDB, subscriptions: list):
+    """
+    Drops the benchmark database and seeds a board whose members each have one device.
+    The indexes the dispatcher created go with the database, so they are created again
+
+    Returns:
+     - The board ID and the post ID to notify about
+    """
+    app_db.client.drop_database(app_db.db.name)
+    app_db.ensure_recipient_index()
+    app_db.ensure_push_subscriptions()
+    app_db.ensure_notif_ledger()
+    db = app_db.db
+    now = datetime.datetime.now()
+    app_db.add_user("bench_owner", "bench")
+    board_id = app_db.create_board(None, "bench_owner", "fanout-bench", "fan-out benchmark board", 50)
+    app_db.subscribe_board(None, "bench_owner", board_id) # Only members may post
+    usernames = ["bench_member_%d" % i for i in range(len(subscriptions))]
+    for i in range(0, len(usernames), 10000):
+        chunk = range(i, min(i + 10000, len(usernames)))
+        ids = db.users.insert_many([{"username": usernames[j], "password": "bench", "subscriptions": [board_id],
+                                     "user_date": now, "last_active_date": now} for j in chunk]).inserted_ids
+        db.boards.update_one({"_id": board_id}, {"$push": {"board_members": {"$each": ids}},
+                                                 "$inc": {"board_member_count": len(ids)}})
+        db.push_subscriptions.insert_many([{"endpoint": subscriptions[j]["endpoint"], "keys": subscriptions[j]["keys"],
+                                            "expirationTime": None, "username": usernames[j], "created": now}
+                                           for j in chunk])
+    post_id = app_db.create_post(None, "bench_owner", board_id, "Benchmark post", "fan-out benchmark post")
+    return board_id, post_id
+
+
+def wait_for_ledger(app_db: AppDB, post_id, timeout: float):
+    """
+    Waits for the fan-out of a post to be recorded in the delivery ledger
+
+    Returns:
+     - The ledger entry, or None if it did not show up within timeout seconds
+    """
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        entries = app_db.fetch_fanout_ledger(1, post_id=post_id)
+        if entries:
+            return entries[0]
+        time.sleep(0.01)
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks notification fan-outs end to end against a local stand-in push service")
+    parser.add_argument("--db-link", default="mongodb://localhost:27017", help="the MongoDB instance to benchmark against")
+    parser.add_argument("--sizes", default="100,10000,100000", help="comma separated board member counts to try")
+    parser.add_argument("--engine", choices=("threads", "async"), default="threads", help="how the dispatcher sends pushes")
+    parser.add_argument("--send-workers", type=int, default=16, help="send threads, or per push service concurrency of the async engine")
+    parser.add_argument("--latency-ms", type=float, default=0, help="artificial push service latency per push")
+    parser.add_argument("--timeout", type=float, default=1800, help="seconds to wait for a single fan-out")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    server, counter = start_push_service(args.latency_ms / 1000)
+    base_url = "http://127.0.0.1:%d" % server.server_address[1]
+    print("Generating %d subscriptions..." % max(sizes))
+    subscriptions = make_subscriptions(base_url, max(sizes))
+
+    # The same settings do_push_notifications reads from config.json
+    config.config = {
+        "db_link": args.db_link,
+        "vapid_email": "bench@example.com",
+        "vapid_private_key": make_vapid_key(),
+        "notif_engine": args.engine,
+        "notif_send_workers": args.send_workers,
+        "notif_fanout_concurrency": args.send_workers,
+        "notif_origin_concurrency": args.send_workers,
+        "metrics": False,
+    }
+    app = flask.Flask(__name__)
+    app.register_blueprint(server_notifs.blueprint)
+    dispatcher = notif_dispatcher.NotificationDispatcher(
+        db_link=args.db_link,
+        send=server_notifs.send_web_push,
+        vapid_email=config.config["vapid_email"],
+        private_key=config.config["vapid_private_key"],
+        send_workers=args.send_workers,
+        fanout_concurrency=args.send_workers,
+        engine=server_notifs.get_push_engine(config.config["vapid_email"], config.config["vapid_private_key"]),
+        db_name=BENCH_DB_NAME)
+    app.extensions["notif_dispatcher"] = dispatcher # Used by do_push_notifications
+    client = pymongo.MongoClient(args.db_link)
+    app_db = AppDB(client, BENCH_DB_NAME)
+
+    results = {}
+    print("%-10s %10s %12s %12s %12s %8s %8s" % ("members", "seconds", "fanout_ms", "pushes/sec", "avg_push_ms", "sent", "failed"))
+    for size in sizes:
+        board_id, post_id = seed_board(app_db, subscriptions[:size])
+        counter.reset()
+        with app.test_request_context():
+            start = time.perf_counter()
+            response = server_notifs.do_push_notifications(board_id, post_id)
+        status = response[1] if isinstance(response, tuple) else response.status_code
+        if status != 200:
+            raise SystemExit("do_push_notifications answered %s" % status)
+        entry = wait_for_ledger(app_db, post_id, args.timeout)
+        elapsed = time.perf_counter() - start
+        if entry is None:
+            raise SystemExit("The fan-out to %d members did not finish within %d seconds" % (size, args.timeout))
+
+        summary = notif_ledger.ledger_summary(entry)
+        timed = [s for s in summary["services"] if s["avg_latency_ms"] is not None]
+        avg_push_ms = sum(s["avg_latency_ms"] * s["pushes"] for s in timed) / max(1, sum(s["pushes"] for s in timed))
+        results[str(size)] = {"seconds": round(elapsed, 3),
+                              "fanout_ms": summary["fanout_ms"],
+                              "queue_ms": summary["queue_ms"],
+                              "pushes_per_sec": round(size / elapsed, 1),
+                              "avg_push_ms": round(avg_push_ms, 1),
+                              "sent": summary["sent"],
+                              "failed": summary["failed"],
+                              "received": counter.pushes,
+                              "connections": len(counter.connections)}
+        print("%-10d %10.3f %12.1f %12.1f %12.1f %8d %8d" % (size, elapsed, summary["fanout_ms"], size / elapsed,
+                                                          avg_push_ms, summary["sent"], summary["failed"]))
+
+    dispatcher.shutdown()
+    client.drop_database(BENCH_DB_NAME)
+    client.close()
+    server.shutdown()
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump({"config": vars(args), "results": results}, outfile, indent=4)
+        print("Results written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
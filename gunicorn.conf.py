@@ -0,0 +1,54 @@
+"""
+Gunicorn configuration, loaded automatically when gunicorn is launched from this directory
+
+Metrics are recorded by every worker process into a shared directory so they can be
+summed across workers when scraped (see server_metrics.py). The directory must be known
+before prometheus_client is first imported, and is wiped every time gunicorn starts.
+
+Rate limiting buckets are shared by the workers through one memory mapped file (see
+rate_limit.py), which is also reset every time gunicorn starts.
+
+Live update streams (see server_events.py) and notification long-polls (see
+server_notifs.py) each hold a thread for as long as they are open, so every worker runs
+several threads. Together they hold at most "held_threads" of them (see held_threads.py),
+which must stay well below the number of threads, so that regular requests are still served.
+"""
+
+import os
+import shutil
+import tempfile
+
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "tac_metrics"))
+
+from prometheus_client import multiprocess
+
+import config
+import held_threads
+import rate_limit
+
+# Threads per worker process (GUNICORN_THREADS to override), by default leaving 8 threads
+# for regular requests besides those held by streams and long-polls
+threads = int(os.environ.get("GUNICORN_THREADS", max(16, held_threads.limit() + 8)))
+
+
+def on_starting(server):
+    """
+    Checks the thread budget and clears out metrics and rate limiting buckets left behind by a previous run
+    """
+    if held_threads.limit() >= threads:
+        server.log.warning("held_threads (%d) leaves none of the %d threads per worker for regular requests",
+                           held_threads.limit(), threads)
+    path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+    try:
+        os.remove(config.get("rate_limit_file", rate_limit.default_path()))
+    except FileNotFoundError:
+        pass
+
+
+def child_exit(server, worker):
+    """
+    Stops counting the live gauges of a worker that exited
+    """
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,56 @@
+"""
+One budget for the server threads held by long-lived requests
+
+Live update streams (see server_events.py) and notification long-polls (see
+server_notifs.py) each hold a gunicorn thread for as long as they are open. Each has its
+own limit ("sse_max_streams" and "notif_inbox_max_waiters"), but both also take a thread
+from this per-process budget of "held_threads" (default 8), so that together they never
+hold more than that. Keep it well below the gunicorn threads per worker (16 by default, see
+gunicorn.conf.py), so that the other threads still serve regular requests.
+"""
+
+import threading
+
+import config
+
+# Number of threads held in this process
+_held = 0
+_held_lock = threading.Lock()
+
+
+def limit():
+    """
+    Returns the number of threads long-lived requests may hold at once in this process
+    """
+    return int(config.get("held_threads", 8))
+
+
+def try_hold():
+    """
+    Takes a thread from the budget
+
+    Returns:
+     - Whether the budget had a thread left. If so, release must be called once the request is done
+    """
+    global _held
+    with _held_lock:
+        if _held >= limit():
+            return False
+        _held += 1
+        return True
+
+
+def release():
+    """
+    Gives a thread taken with try_hold back to the budget
+    """
+    global _held
+    with _held_lock:
+        _held -= 1
+
+
+def held():
+    """
+    Returns the number of threads currently held in this process
+    """
+    return _held
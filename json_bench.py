@@ -0,0 +1,97 @@
+"""
+Benchmarks the API JSON encoder against bson.json_util.dumps on large board payloads
+
+Board payloads are built in memory the way /api/board returns them (see server_api.py),
+with the given numbers of posts and upvoters per post, and encoded repeatedly with
+json_util.dumps and with api_json's encoders (the json module, and orjson if installed).
+For each board size, we report the milliseconds per payload, payloads per second and the
+size of the JSON.
+
+To run the benchmark:
+    $ python3 json_bench.py --posts 10,100,1000 --upvoters 100 --repeat 20
+"""
+
+import argparse
+import datetime
+import json
+import time
+
+from bson import json_util
+from bson.objectid import ObjectId
+
+import api_json
+
+
+def make_board(posts: int, upvoters: int):
+    """
+    Builds a board payload with posts posts, each upvoted by upvoters users
+    """
+    now = datetime.datetime.utcnow()
+    return {
+        "board_id": str(ObjectId()),
+        "board_name": "bench board",
+        "board_description": "a board for benchmarking",
+        "board_date": now,
+        "board_vote_threshold": 50,
+        "board_member_count": upvoters * 2,
+        "subscribed": True,
+        "posts": [{
+            "_id": ObjectId(),
+            "post_subject": "post %d" % i,
+            "post_description": "a post for benchmarking",
+            "post_owner": ObjectId(),
+            "post_date": now,
+            "post_upvotes": upvoters,
+            "post_upvoters": [ObjectId() for _ in range(upvoters)],
+            "post_notified": 0,
+            "votes_needed": upvoters * 2,
+            "comments_container": ObjectId(),
+            "last_active_date": now,
+        } for i in range(posts)],
+    }
+
+
+def measure(encode, payload: dict, repeat: int):
+    """
+    Encodes a payload repeat times
+
+    Returns:
+     - The milliseconds per payload and the size of the JSON in bytes
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        data = encode(payload)
+    return (time.perf_counter() - start) * 1000 / repeat, len(data.encode("utf8") if isinstance(data, str) else data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the API JSON encoder against bson.json_util.dumps")
+    parser.add_argument("--posts", default="10,100,1000", help="comma separated numbers of posts per board to try")
+    parser.add_argument("--upvoters", type=int, default=100, help="upvoters per post")
+    parser.add_argument("--repeat", type=int, default=20, help="encodings per measurement")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    encoders = {"json_util": json_util.dumps, "json": api_json.encode_json}
+    if api_json.orjson is not None:
+        encoders["orjson"] = api_json.encode_orjson
+    results = {}
+    print("%-8s %-10s %10s %14s %12s" % ("posts", "encoder", "ms", "payloads/sec", "bytes"))
+    for posts in [int(p) for p in args.posts.split(",")]:
+        payload = make_board(posts, args.upvoters)
+        results[str(posts)] = {}
+        for name, encode in encoders.items():
+            ms, size = measure(encode, payload, args.repeat)
+            results[str(posts)][name] = {"ms": round(ms, 3), "payloads_per_sec": round(1000 / ms, 1), "bytes": size}
+            print("%-8d %-10s %10.3f %14.1f %12d" % (posts, name, ms, 1000 / ms, size))
+        fastest = min(r["ms"] for r in results[str(posts)].values())
+        print("%-8d %-10s %9.1fx" % (posts, "speedup", results[str(posts)]["json_util"]["ms"] / max(fastest, 0.001)))
+
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump({"config": vars(args), "results": results}, outfile, indent=4)
+        print("Results written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
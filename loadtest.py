@@ -0,0 +1,288 @@
+"""
+HTTP load test for a running deployment of the web server
+
+Virtual users register and log in through the regular /register.html and /login.html
+forms, then repeatedly hit a weighted mix of API endpoints. Throughput, latency
+percentiles and error rates are reported for each endpoint.
+
+Everything runs on one machine. To load test a local gunicorn deployment do the following:
+    Bring up MongoDB and the server (replace <> accordingly):
+        $ mongod --dbpath <dir>
+        $ CONFIG_LOC=./config.json gunicorn --workers <workers> --bind 0.0.0.0:5000 wsgi:app
+    Run the load test with the default endpoint mix:
+        $ python3 loadtest.py --url http://localhost:5000 --users 50 --duration 60
+    Run with a custom mix (weights are relative):
+        $ python3 loadtest.py --mix boards=5,board=40,post=30,upvote=15,comment=5,subscribe=5
+"""
+
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+
+import requests
+
+from db_bench import percentile
+
+# The default weighted endpoint mix, loosely modelled on users browsing boards
+DEFAULT_MIX = "boards=10,board=35,post=30,upvote=15,comment=5,subscribe=5"
+
+# Extracts the Flask-WTF CSRF token from a rendered form
+CSRF_PATTERN = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+
+
+class LoadTestError(Exception):
+    """
+    Raised when the load test cannot set up its users or data
+    """
+
+
+class Recorder:
+    """
+    Collects per-endpoint request samples from all virtual users
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.statuses = {}
+        self.errors = {}
+
+    def record(self, endpoint: str, elapsed: float, status: int):
+        """
+        Records one request. A status of 0 means the request never got a response
+        """
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(elapsed)
+            counts = self.statuses.setdefault(endpoint, {})
+            counts[status] = counts.get(status, 0) + 1
+            if status == 0 or status >= 500:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, duration: float):
+        """
+        Summarises the recorded samples
+
+        Parameters:
+         - duration: the wall clock length of the test in seconds
+        Returns:
+         - A dictionary with overall totals and per-endpoint statistics
+        """
+        endpoints = {}
+        total = 0
+        total_errors = 0
+        with self.lock:
+            for endpoint, samples in sorted(self.latencies.items()):
+                samples = sorted(samples)
+                errors = self.errors.get(endpoint, 0)
+                rejected = sum(c for s, c in self.statuses[endpoint].items() if 400 <= s < 500)
+                total += len(samples)
+                total_errors += errors
+                endpoints[endpoint] = {
+                    "requests": len(samples),
+                    "requests_per_sec": round(len(samples) / duration, 1),
+                    "p50_ms": round(percentile(samples, 50) * 1000, 2),
+                    "p95_ms": round(percentile(samples, 95) * 1000, 2),
+                    "p99_ms": round(percentile(samples, 99) * 1000, 2),
+                    "error_rate": round(errors / len(samples), 4),
+                    "rejected_rate": round(rejected / len(samples), 4),
+                    "statuses": {str(s): c for s, c in sorted(self.statuses[endpoint].items())},
+                }
+        return {
+            "duration_sec": round(duration, 2),
+            "requests": total,
+            "requests_per_sec": round(total / duration, 1) if duration > 0 else 0.0,
+            "error_rate": round(total_errors / total, 4) if total else 0.0,
+            "endpoints": endpoints,
+        }
+
+
+class VirtualUser:
+    """
+    A single simulated user with its own logged in HTTP session
+    """
+
+    def __init__(self, base_url: str, username: str, password: str, timeout: float):
+        self.base_url = base_url.rstrip("/")
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def _form_post(self, page: str, data: dict):
+        """
+        Fetches a form page to get its CSRF token, then posts the form to it
+        """
+        resp = self.session.get(self.base_url + page, timeout=self.timeout)
+        match = CSRF_PATTERN.search(resp.text)
+        if match is None:
+            raise LoadTestError("Could not find a CSRF token on %s" % page)
+        data = dict(data, csrf_token=match.group(1))
+        return self.session.post(self.base_url + page, data=data, timeout=self.timeout)
+
+    def register_and_login(self):
+        """
+        Registers the user (ignoring existing accounts) and logs in through /login.html
+        """
+        self._form_post("/register.html", {"username": self.username, "password": self.password, "confirm": self.password})
+        resp = self._form_post("/login.html", {"username": self.username, "password": self.password})
+        if not resp.url.endswith("/myboards.html"):
+            raise LoadTestError("Could not log in as %s" % self.username)
+
+    def get(self, path: str, params: dict = None):
+        return self.session.get(self.base_url + path, params=params, timeout=self.timeout)
+
+    def post(self, path: str, data: dict = None):
+        return self.session.post(self.base_url + path, data=data, timeout=self.timeout)
+
+
+def parse_mix(mix: str):
+    """
+    Parses an endpoint mix of the form "boards=10,board=35,..."
+
+    Returns:
+     - A list of (action, weight) pairs
+    """
+    pairs = []
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in ACTIONS:
+            raise LoadTestError("Unknown endpoint %s, expected one of %s" % (name, ", ".join(ACTIONS)))
+        pairs.append((name, float(weight)))
+    return pairs
+
+
+def seed(owner: VirtualUser, users: list, boards: int, posts: int, prefix: str):
+    """
+    Creates the boards and posts the load test runs against and subscribes every user
+
+    Returns:
+     - A list of (board_id, [post_id, ...]) pairs
+    """
+    seeded = []
+    for b in range(boards):
+        resp = owner.post("/api/board/create", {"board_name": "%s-%d" % (prefix, b),
+                                                "board_description": "load test board",
+                                                "board_vote_threshold": 100})
+        if resp.status_code != 200:
+            raise LoadTestError("Could not create board: %s" % resp.text)
+        board_id = resp.json()["board_id"]
+        for user in users:
+            user.post("/api/board/subscribe", {"board_id": board_id})
+        post_ids = []
+        for p in range(posts):
+            resp = users[p % len(users)].post("/api/post/create", {"board_id": board_id,
+                                                                   "post_subject": "load test post %d" % p,
+                                                                   "post_description": "load test post"})
+            if resp.status_code != 200:
+                raise LoadTestError("Could not create post: %s" % resp.text)
+            post_ids.append(resp.json()["post_id"])
+        seeded.append((board_id, post_ids))
+    return seeded
+
+
+# Each action issues one request against a randomly chosen board/post and returns the response
+ACTIONS = {
+    "boards": ("/api/boards", lambda u, b, p, prefix: u.get("/api/boards", {"search": prefix, "offset": 0})),
+    "board": ("/api/board", lambda u, b, p, prefix: u.get("/api/board", {"board_id": b})),
+    "post": ("/api/post", lambda u, b, p, prefix: u.get("/api/post", {"board_id": b, "post_id": p})),
+    "upvote": ("/api/post/upvote", lambda u, b, p, prefix: u.post("/api/post/upvote", {"board_id": b, "post_id": p})),
+    "comment": ("/api/comment/create", lambda u, b, p, prefix: u.post("/api/comment/create", {"board_id": b, "post_id": p, "message": "load test comment"})),
+    "subscribe": ("/api/board/subscribe", lambda u, b, p, prefix: u.post("/api/board/subscribe", {"board_id": b})),
+}
+
+
+def run_user(user: VirtualUser, mix: list, seeded: list, prefix: str, recorder: Recorder, deadline: float, think_time: float):
+    """
+    Drives one virtual user until the deadline passes
+    """
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    rng = random.Random()
+    while time.monotonic() < deadline:
+        action = rng.choices(names, weights)[0]
+        endpoint, call = ACTIONS[action]
+        board_id, post_ids = rng.choice(seeded)
+        post_id = rng.choice(post_ids)
+        start = time.perf_counter()
+        try:
+            status = call(user, board_id, post_id, prefix).status_code
+        except requests.RequestException:
+            status = 0
+        recorder.record(endpoint, time.perf_counter() - start, status)
+        if think_time > 0:
+            time.sleep(rng.expovariate(1 / think_time))
+
+
+def print_report(report: dict):
+    """
+    Prints the load test report as a table
+    """
+    header = "%-22s %9s %9s %9s %9s %9s %8s %8s" % ("endpoint", "requests", "req/sec", "p50 ms", "p95 ms", "p99 ms", "errors", "4xx")
+    print(header)
+    print("-" * len(header))
+    for endpoint, r in report["endpoints"].items():
+        print("%-22s %9d %9.1f %9.2f %9.2f %9.2f %7.2f%% %7.2f%%" % (endpoint, r["requests"], r["requests_per_sec"],
+              r["p50_ms"], r["p95_ms"], r["p99_ms"], r["error_rate"] * 100, r["rejected_rate"] * 100))
+    print("-" * len(header))
+    print("Total: %d requests in %.1fs (%.1f req/sec), %.2f%% errors" % (report["requests"], report["duration_sec"],
+          report["requests_per_sec"], report["error_rate"] * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load tests a running web server with a weighted endpoint mix")
+    parser.add_argument("--url", default="http://localhost:5000", help="base URL of the server")
+    parser.add_argument("--users", type=int, default=20, help="number of concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="length of the test in seconds")
+    parser.add_argument("--ramp-up", type=float, default=5, help="seconds over which virtual users are started")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weighted endpoint mix, e.g. " + DEFAULT_MIX)
+    parser.add_argument("--boards", type=int, default=5, help="number of boards to seed")
+    parser.add_argument("--posts", type=int, default=20, help="number of posts to seed per board")
+    parser.add_argument("--think-time", type=float, default=0, help="mean pause between a user's requests in seconds")
+    parser.add_argument("--timeout", type=float, default=30, help="request timeout in seconds")
+    parser.add_argument("--prefix", default="lt%d" % (int(time.time()) % 100000), help="name prefix for seeded users and boards")
+    parser.add_argument("--output", help="file to write the JSON report to")
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix)
+        print("Logging in %d virtual users..." % args.users)
+        users = [VirtualUser(args.url, "%s_u%d" % (args.prefix, i), "loadtest", args.timeout) for i in range(args.users)]
+        for user in users:
+            user.register_and_login()
+        print("Seeding %d boards with %d posts each..." % (args.boards, args.posts))
+        seeded = seed(users[0], users, args.boards, args.posts, args.prefix)
+    except (LoadTestError, requests.RequestException) as e:
+        print("Setup failed: %s" % e)
+        sys.exit(1)
+
+    print("Running load for %.0fs..." % args.duration)
+    recorder = Recorder()
+    start = time.monotonic()
+    deadline = start + args.ramp_up + args.duration
+    threads = []
+    for i, user in enumerate(users):
+        t = threading.Thread(target=run_user, args=(user, mix, seeded, args.prefix, recorder, deadline, args.think_time), daemon=True)
+        t.start()
+        threads.append(t)
+        if args.ramp_up > 0:
+            time.sleep(args.ramp_up / len(users))
+    for t in threads:
+        t.join()
+
+    report = recorder.report(time.monotonic() - start)
+    report["config"] = {"url": args.url, "users": args.users, "mix": dict(mix), "boards": args.boards, "posts": args.posts}
+    print()
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(report, outfile, indent=4)
+        print("Report written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Coalesces notifications into one push per user (digest mode)
+
+With the "notif_digest_seconds" config entry set, a post reaching its threshold is not
+pushed to its recipients right away. It is added to each recipient's digest instead, and
+once a digest has waited notif_digest_seconds, every notification gathered meanwhile goes
+out as a single push per device. A burst of posts on a user's boards then costs one push
+per device rather than one per post.
+
+Every digest push has the same Topic header, so a push service still holding an
+undelivered digest for an offline device replaces it with the newer one instead of
+queueing both. Since the newer digest hides the older one, each digest repeats the
+notifications pushed within the last "notif_ttl" seconds (the longest a push service
+holds a push). Digests are sent with the "notif_digest_urgency" Urgency header, so push
+services may hold them until a device is awake anyway.
+"""
+
+import datetime
+import logging
+import threading
+
+from bson import json_util
+
+import server_metrics
+
+# Topic header of digest pushes, so a newer digest replaces an undelivered one
+DIGEST_TOPIC = "digest"
+
+# The most notifications a digest keeps
+MAX_DIGEST_ITEMS = 20
+
+# Number of due digests claimed at a time
+DIGESTS_PER_FLUSH = 500
+
+
+def build_digest_payload(username: str, items: list):
+    """
+    Builds the JSON payload of a digest. A digest of a single notification looks like
+    a regular notification
+
+    Parameters:
+     - username: the user being notified
+     - items: the notifications, newest first
+    Returns:
+     - The payload string
+    """
+    latest = items[0]
+    payload = {
+        "board_id": latest["board_id"],
+        "post_id": latest["post_id"],
+        "username": str(username),
+        "board_name": latest["board_name"],
+        "message": latest["message"]
+    }
+    if len(items) > 1:
+        payload["board_name"] = "%d posts reached their vote threshold" % len(items)
+        payload["message"] = "\n".join("%s: %s" % (i["board_name"], i["message"]) for i in items)
+        payload["digest"] = len(items)
+    return json_util.dumps(payload)
+
+
+class DigestCoalescer:
+    """
+    Adds notifications to users' digests and pushes the digests that are due
+    """
+
+    def __init__(self, window_seconds: float, ttl: int = 0, urgency: str = "normal",
+                 poll_interval: float = 1, max_items: int = MAX_DIGEST_ITEMS):
+        """
+        Parameters:
+         - window_seconds: how long notifications are coalesced for
+         - ttl: seconds push services keep a push for an offline device
+         - urgency: the Urgency header of digest pushes ("very-low", "low", "normal" or "high")
+         - poll_interval: seconds between checks for due digests
+         - max_items: the most notifications a digest keeps
+        """
+        self.window_seconds = window_seconds
+        self.ttl = ttl
+        self.urgency = urgency
+        self.poll_interval = poll_interval
+        self.max_items = max_items
+        self.logger = logging.getLogger("notifs")
+
+    def add(self, app_db, board: dict, post: dict, user_names: list):
+        """
+        Adds a post's notification to the digests of its recipients
+
+        Parameters:
+         - app_db: the AppDB to use
+         - board: the board of the post
+         - post: the post
+         - user_names: the recipients (a user with several devices may be listed several times)
+        """
+        item = {"board_id": board["_id"],
+                "post_id": post["_id"],
+                "board_name": str(board["board_name"]),
+                "message": post.get("post_subject", "Unknown post subject")}
+        app_db.add_to_digests(list(dict.fromkeys(user_names)), item, self.window_seconds, self.max_items)
+
+    def flush(self, app_db, deliver):
+        """
+        Pushes the digests that are due
+
+        Parameters:
+         - app_db: the AppDB to use
+         - deliver: function sending a list of (subscription, payload, headers) pushes and
+           returning the result of each ("sent", "expired", "failed" or "retry")
+        Returns:
+         - A dictionary with the number of pushes sent, failed and expired
+        """
+        results = {"sent": 0, "failed": 0, "expired": 0}
+        digests = {}
+        for user_name in app_db.fetch_due_digests(DIGESTS_PER_FLUSH):
+            digest = app_db.claim_digest(user_name)
+            if digest is not None and digest.get("pending"):
+                digests[user_name] = digest
+        if not digests:
+            return results
+
+        items = {user_name: self._items(digest) for user_name, digest in digests.items()}
+        headers = {"Topic": DIGEST_TOPIC, "Urgency": self.urgency}
+        pushes = []
+        for device in app_db.fetch_users_push_subscriptions(list(digests)):
+            payload = build_digest_payload(device["username"], items[device["username"]])
+            pushes.append(({"endpoint": device["endpoint"], "keys": device["keys"]}, payload, headers))
+        pushed = deliver(pushes) if pushes else []
+
+        expired = []
+        for (subscription, _, _), result in zip(pushes, pushed):
+            # Digests are not retried, a later digest repeats them only within the TTL
+            result = "failed" if result == "retry" else result
+            results[result] += 1
+            if result == "expired":
+                expired.append(subscription["endpoint"])
+        app_db.remove_push_subscriptions(expired)
+        if self.ttl > 0:
+            for user_name, digest in digests.items():
+                app_db.add_recent_digests(user_name, digest["pending"], self.max_items)
+        for result, count in results.items():
+            server_metrics.record_push(result, count)
+        return results
+
+    def run(self, app_db, deliver, stopping: threading.Event):
+        """
+        Pushes due digests every poll_interval seconds until stopping is set
+        """
+        while not stopping.is_set():
+            try:
+                self.flush(app_db, deliver)
+            except Exception:
+                self.logger.error("Error occurred pushing notification digests", exc_info=True)
+            stopping.wait(self.poll_interval)
+
+    def _items(self, digest: dict):
+        """
+        Returns the notifications of a claimed digest, newest first: the pending ones, then the
+        ones pushed recently enough that the push service may still replace them
+        """
+        items = list(reversed(digest.get("pending", [])))
+        if self.ttl > 0 and digest.get("recent"):
+            cutoff = datetime.datetime.now() - datetime.timedelta(seconds=self.ttl)
+            items += [r for r in reversed(digest["recent"]) if r["sent"] > cutoff]
+        unique = {}
+        for item in items:
+            unique.setdefault(item["post_id"], item)
+        return list(unique.values())[:self.max_items]
@@ -0,0 +1,389 @@
+"""
+Dispatches notification fan-outs on a bounded pool of threads
+
+A fan-out notifies every member of a board about one post. Fan-outs are queued on a
+bounded queue and picked up by a fixed number of fan-out threads, which resolve the
+recipients and hand the individual web pushes to a shared, bounded pool of send
+threads. A single fan-out never has more than fanout_concurrency pushes in flight, so
+one huge board cannot starve the others. Alternatively, pushes are sent from an
+AsyncPushEngine (see push_async.py), which is limited per push service instead.
+In digest mode (see notif_digest.py), fan-outs only add the post to its recipients'
+digests, and a digest thread pushes the digests that are due. Unless disabled, fan-outs
+also add the post to the in-app inbox of every board member (see notif_inbox.py).
+
+When the queue is full, submit waits briefly and then gives up (back-pressure), so a
+burst of viral posts cannot pile up unbounded work. The dispatcher has its own database
+client since it outlives the requests that submit work, and drains its queue on shutdown.
+Every fan-out is recorded in the delivery ledger (see notif_ledger.py).
+
+Like the notification workers (see notif_worker.py), the dispatcher sweeps for posts that
+reached their vote threshold without a vote crossing it every "notif_sweep_seconds", and
+fans them out too. Every server process sweeps; a post is only marked notified by one of
+them, which is the one that queues it.
+"""
+
+import datetime
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+import pywebpush
+import requests
+from bson import ObjectId, json_util
+
+import db
+import notif_inbox
+import notif_ledger
+import server_metrics
+
+# Number of recipients fetched from the database at a time during a fan-out
+RECIPIENT_BATCH_SIZE = 500
+
+# Placed on the queue to stop a fan-out thread
+_STOP = object()
+
+# Checkpoint name of the threshold sweep, shared with the notification workers
+SWEEP_CHECKPOINT = "threshold_sweep"
+
+
+def build_payload(board: dict, post: dict, username: str):
+    """
+    Builds the JSON payload of a post's notification to one user
+
+    Parameters:
+     - board: the board of the post
+     - post: the post
+     - username: the user being notified
+    Returns:
+     - The payload string
+    """
+    return json_util.dumps({
+        "board_id": board["_id"],
+        "post_id": post["_id"],
+        "username": str(username),
+        "board_name": str(board["board_name"]),
+        "message": post.get("post_subject", "Unknown post subject")
+    })
+
+
+def classify_push_error(e: Exception):
+    """
+    Decides what a failed web push means for its subscription
+
+    Parameters:
+     - e: the exception raised while sending
+    Returns:
+     - "expired" if the subscription is gone and should be removed, "retry" if the push
+       may succeed later (rate limited, push service or network errors) and "failed" otherwise
+    """
+    if isinstance(e, pywebpush.WebPushException):
+        response = getattr(e, "response", None)
+        status = getattr(response, "status_code", None)
+        if status in (404, 410) or "subscription has unsubscribed or expired" in str(e):
+            return "expired"
+        if status is None or status == 429 or status >= 500:
+            return "retry"
+        return "failed"
+    if isinstance(e, requests.RequestException):
+        return "retry"
+    return "failed"
+
+
+class DispatcherFull(Exception):
+    """
+    Raised when a fan-out cannot be queued because the dispatcher is at capacity
+    """
+
+
+class NotificationDispatcher:
+    """
+    Owns the fan-out threads, the send pool and the queue between them
+    """
+
+    def __init__(self, db_link: str, send, vapid_email: str, private_key: str,
+                 fanout_workers: int = 2, send_workers: int = 16, queue_size: int = 100,
+                 fanout_concurrency: int = 8, submit_timeout: float = 0.5, engine=None, digest=None,
+                 inbox_bytes: int = 0, sweep_interval: float = 0, db_name: str = "p2_db"):
+        """
+        Initiates the dispatcher and starts its threads
+
+        Parameters:
+         - db_link: the URL to the MongoDB instance
+         - send: function sending one web push, called as send(subscription, payload, vapid_email, private_key, headers)
+         - vapid_email: the email of the VAPID key
+         - private_key: the private VAPID key
+         - fanout_workers: number of fan-outs processed at once
+         - send_workers: number of pushes sent at once across all fan-outs
+         - queue_size: number of fan-outs that may wait in the queue
+         - fanout_concurrency: maximum pushes in flight for a single fan-out
+         - submit_timeout: seconds submit waits for queue space before giving up
+         - engine: an AsyncPushEngine to send pushes with instead of the send pool, or None
+         - digest: a DigestCoalescer to coalesce notifications with, or None to push each post
+         - inbox_bytes: size of the in-app notification inbox, or 0 to not write to it
+         - sweep_interval: seconds between threshold sweeps, or 0 to not sweep
+         - db_name: the database to use, which is only changed for benchmarks
+        """
+        self.send = send
+        self.vapid_email = vapid_email
+        self.private_key = private_key
+        self.fanout_concurrency = fanout_concurrency
+        self.submit_timeout = submit_timeout
+        self.engine = engine
+        self.digest = digest
+        self.inbox_bytes = inbox_bytes
+        self.logger = logging.getLogger("notifs")
+
+        self.client = pymongo.MongoClient(db_link)
+        self.db = db.AppDB(self.client, db_name)
+        self.db.ensure_recipient_index()
+        self.db.ensure_push_subscriptions()
+        self.db.ensure_notif_ledger()
+        if inbox_bytes > 0:
+            self.db.ensure_notif_inbox(inbox_bytes)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.send_pool = ThreadPoolExecutor(max_workers=send_workers, thread_name_prefix="notif-send")
+        self.sends = set() # Futures of the pushes submitted to the send pool and not done yet
+        self.sends_lock = threading.Lock()
+        self.closed = False
+        self.stopping = threading.Event()
+        self.threads = []
+        for i in range(fanout_workers):
+            t = threading.Thread(target=self._run, name="notif-fanout-%d" % i, daemon=True)
+            t.start()
+            self.threads.append(t)
+        self.digest_thread = None
+        if digest is not None:
+            self.db.ensure_notif_digests()
+            self.digest_thread = threading.Thread(target=digest.run, args=(self.db, self.send_pushes, self.stopping),
+                                                  name="notif-digest", daemon=True)
+            self.digest_thread.start()
+        self.sweep_thread = None
+        if sweep_interval > 0:
+            self.db.ensure_threshold_sweep()
+            self.sweep_thread = threading.Thread(target=self.run_sweeps, args=(sweep_interval,),
+                                                 name="notif-sweep", daemon=True)
+            self.sweep_thread.start()
+
+    def submit(self, board_id: ObjectId, post_id: ObjectId):
+        """
+        Queues the fan-out of a post's notification
+
+        Parameters:
+         - board_id: The board ID of the post
+         - post_id: The post ID of the post
+        Error: raises DispatcherFull if the queue stays full for submit_timeout seconds
+        """
+        if self.closed:
+            raise DispatcherFull("Notification dispatcher is shutting down")
+        try:
+            self.queue.put((board_id, post_id, datetime.datetime.now()), timeout=self.submit_timeout)
+        except queue.Full:
+            raise DispatcherFull("Notification queue is full")
+
+    def pending(self):
+        """
+        Returns the approximate number of fan-outs waiting in the queue
+        """
+        return self.queue.qsize()
+
+    def shutdown(self, timeout: float = 30):
+        """
+        Stops accepting fan-outs and waits for queued ones to finish
+
+        Parameters:
+         - timeout: seconds to wait in total for the queue to drain. Fan-outs still queued
+           after that are dropped
+        """
+        if self.closed:
+            return
+        self.closed = True
+        deadline = time.monotonic() + timeout
+        for _ in self.threads:
+            try:
+                self.queue.put(_STOP, timeout=max(0, deadline - time.monotonic()))
+            except queue.Full:
+                break # Still full at the deadline, the threads are left to die with the process
+        for t in self.threads:
+            t.join(max(0, deadline - time.monotonic()))
+        self.stopping.set()
+        for t in (self.digest_thread, self.sweep_thread):
+            if t is not None:
+                t.join(max(0, deadline - time.monotonic()))
+        drained = not any(t.is_alive() for t in self.threads)
+        if not drained:
+            # Pushes of unfinished fan-outs are not waited for
+            with self.sends_lock:
+                pending = list(self.sends)
+            for f in pending:
+                f.cancel()
+        self.send_pool.shutdown(wait=drained)
+        if self.engine is not None:
+            self.engine.close()
+        self.client.close()
+
+    def sweep_thresholds(self):
+        """
+        Queues the fan-outs of posts that reached their threshold since the last sweep
+
+        Returns:
+         - The number of fan-outs queued
+        """
+        started = self.db.db_time()
+        queued = 0
+        for board_id, post_id in self.db.fetch_threshold_crossings(self.db.fetch_checkpoint(SWEEP_CHECKPOINT)):
+            if not self.db.notify_post_once(board_id, post_id):
+                continue # Notified by a vote or another process meanwhile
+            try:
+                self.submit(board_id, post_id)
+                queued += 1
+            except DispatcherFull:
+                # Unmarked so that a later sweep (or vote) queues it
+                self.db.unnotify_post(board_id, post_id)
+        self.db.save_checkpoint(SWEEP_CHECKPOINT, started)
+        return queued
+
+    def run_sweeps(self, interval: float):
+        """
+        Sweeps for threshold crossings every interval seconds until shut down
+        """
+        while not self.stopping.wait(interval):
+            try:
+                queued = self.sweep_thresholds()
+                if queued:
+                    self.logger.info("Threshold sweep queued %d notifications", queued)
+            except pymongo.errors.PyMongoError:
+                self.logger.error("Error occurred sweeping vote thresholds", exc_info=True)
+
+    def send_pushes(self, pushes: list, record=None):
+        """
+        Sends a list of (subscription, payload, headers) pushes and waits for all of them
+
+        Parameters:
+         - pushes: the pushes to send
+         - record: function called as record(endpoint, result, seconds) once each push is done
+        Returns:
+         - A list with the result of each push: "sent", "expired", "failed" or "retry"
+        """
+        if self.engine is not None:
+            return self.engine.deliver(pushes, record)
+        futures = [self.submit_send(self.send_one, push, record) for push in pushes]
+        return [f.result() for f in futures]
+
+    def submit_send(self, function, *args):
+        """
+        Runs function(*args) on the send pool, keeping track of it until it is done
+
+        Returns:
+         - The future of the call
+        """
+        future = self.send_pool.submit(function, *args)
+        with self.sends_lock:
+            self.sends.add(future)
+        future.add_done_callback(self._send_done)
+        return future
+
+    def _send_done(self, future):
+        with self.sends_lock:
+            self.sends.discard(future)
+
+    def send_one(self, push: tuple, record=None):
+        """
+        Sends one (subscription, payload, headers) push from the calling thread
+
+        Returns:
+         - The result of the push: "sent", "expired", "failed" or "retry"
+        """
+        start = time.perf_counter()
+        try:
+            self.send(push[0], push[1], self.vapid_email, self.private_key, push[2])
+            result = "sent"
+        except Exception as e:
+            result = classify_push_error(e)
+            if result != "expired":
+                self.logger.warning("Error occurred sending web push: %s", e)
+        if record is not None:
+            record(push[0].get("endpoint", ""), result, time.perf_counter() - start)
+        return result
+
+    def _run(self):
+        """
+        Processes queued fan-outs until stopped
+        """
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            try:
+                self.fanout(*item)
+            except Exception:
+                self.logger.error("Error occurred fanning out notification for post %s", item[1], exc_info=True)
+
+    def fanout(self, board_id: ObjectId, post_id: ObjectId, queued: datetime.datetime = None):
+        """
+        Sends a post's notification to every subscription of every board member
+
+        Parameters:
+         - board_id: The board ID of the post
+         - post_id: The post ID of the post
+         - queued: when the fan-out was queued, for the ledger
+        Returns:
+         - A dictionary with the number of pushes sent, failed and expired
+        """
+        results = {"sent": 0, "failed": 0, "expired": 0}
+        found = self.db.fetch_notification_post(board_id, post_id)
+        if found is None:
+            return results # Deleted before its notification went out
+        board, post = found
+        ledger = notif_ledger.FanoutRecord(board_id, post_id, queued)
+        if self.inbox_bytes > 0:
+            notif_inbox.add_post(self.db, board, post)
+        if self.digest is not None:
+            for batch in self.db.iter_notification_recipients(board_id, RECIPIENT_BATCH_SIZE):
+                ledger.add_recipients(len(batch))
+                self.digest.add(self.db, board, post, [r["username"] for r in batch])
+            ledger.save(self.db)
+            server_metrics.record_fanout(ledger.recipients)
+            return results
+        results_lock = threading.Lock()
+        in_flight = threading.BoundedSemaphore(self.fanout_concurrency)
+        futures = []
+        expired = []
+
+        def record(endpoint, result, seconds):
+            # Pushes are not retried here, so pushes that could be retried have failed
+            result = "failed" if result == "retry" else result
+            ledger.record(endpoint, result, seconds)
+            with results_lock:
+                results[result] += 1
+                if result == "expired":
+                    expired.append(endpoint)
+
+        def deliver(push):
+            try:
+                self.send_one(push, record)
+            finally:
+                in_flight.release()
+
+        # Recipients stream in from one cursor while earlier ones are being sent to
+        for batch in self.db.iter_notification_recipients(board_id, RECIPIENT_BATCH_SIZE):
+            ledger.add_recipients(len(batch))
+            pushes = [(r["subscription"], build_payload(board, post, r["username"]), None) for r in batch]
+            if self.engine is not None:
+                self.engine.deliver(pushes, record)
+                continue
+            for push in pushes:
+                in_flight.acquire() # Wait until this fan-out has a free slot
+                futures.append(self.submit_send(deliver, push))
+
+        for f in futures:
+            f.result()
+        # Remove expired subscriptions for the future, all at once
+        self.db.remove_push_subscriptions(expired)
+        ledger.save(self.db)
+        server_metrics.record_fanout(ledger.recipients)
+        for result, count in results.items():
+            server_metrics.record_push(result, count)
+        return results
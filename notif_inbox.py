@@ -0,0 +1,152 @@
+"""
+In-app notification inbox
+
+Web push only reaches users who enabled notifications on a device. To reach everyone else,
+every notification fan-out also writes the notification to the inbox of each board member
+(with or without devices), in the capped notif_inbox collection ("notif_inbox_bytes" big,
+the oldest notifications are dropped first). Pages long-poll /api/notifications and show
+new notifications as they arrive.
+
+A long-poll first checks the user's inbox with the (username, _id) index. If there is
+nothing new, it waits for a wakeup from the process's InboxWatcher: one thread with one
+tailable cursor following every notification added to the inbox, by this process or any
+other (such as the notification workers), and waking the long-polls of its users. The
+database therefore sees one indexed query per long-poll, rather than one query per poll
+interval, no matter how long the poll waits.
+"""
+
+import logging
+import threading
+
+import pymongo
+
+import db
+
+# Number of board members written to the inbox at a time during a fan-out
+INBOX_BATCH_SIZE = 1000
+
+
+def inbox_item(board: dict, post: dict):
+    """
+    Builds the inbox notification of a post
+
+    Parameters:
+     - board: the board of the post
+     - post: the post
+    Returns:
+     - The notification, {"board_id", "post_id", "board_name", "message"}
+    """
+    return {"board_id": board["_id"],
+            "post_id": post["_id"],
+            "board_name": str(board["board_name"]),
+            "message": post.get("post_subject", "Unknown post subject")}
+
+
+def add_post(app_db, board: dict, post: dict, batch_size: int = INBOX_BATCH_SIZE):
+    """
+    Adds a post's notification to the inbox of every member of its board
+
+    Parameters:
+     - app_db: the AppDB to use
+     - board: the board of the post
+     - post: the post
+     - batch_size: number of members written at a time
+    Returns:
+     - The number of inboxes written to
+    """
+    item = inbox_item(board, post)
+    count = 0
+    for user_names in app_db.iter_board_members(board["_id"], batch_size):
+        app_db.add_to_inbox(user_names, item)
+        count += len(user_names)
+    return count
+
+
+class InboxWatcher:
+    """
+    Follows the notifications added to the inbox and wakes up the long-polls waiting for them
+    """
+
+    def __init__(self, db_link: str, max_await_ms: int = 1000):
+        """
+        Starts the watcher thread
+
+        Parameters:
+         - db_link: the URL to the MongoDB instance
+         - max_await_ms: how long each fetch of the tailable cursor waits on the server
+        """
+        self.max_await_ms = max_await_ms
+        self.logger = logging.getLogger("notifs")
+        self.client = pymongo.MongoClient(db_link)
+        self.db = db.AppDB(self.client)
+        self.lock = threading.Lock()
+        self.waiters = {}
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="notif-inbox", daemon=True)
+        self.thread.start()
+
+    def wait(self, user_name: str):
+        """
+        Starts waiting for a user's next notification. Must be called before checking the
+        inbox, so that a notification added in between still wakes the waiter
+
+        Parameters:
+         - user_name: the user
+        Returns:
+         - An Event set once a notification for the user is added, which must be passed to done
+        """
+        event = threading.Event()
+        with self.lock:
+            self.waiters.setdefault(user_name, set()).add(event)
+        return event
+
+    def done(self, user_name: str, event: threading.Event):
+        """
+        Stops waiting with an Event returned by wait
+        """
+        with self.lock:
+            events = self.waiters.get(user_name)
+            if events is not None:
+                events.discard(event)
+                if not events:
+                    del self.waiters[user_name]
+
+    def waiting(self):
+        """
+        Returns the number of long-polls waiting in this process
+        """
+        with self.lock:
+            return sum(len(events) for events in self.waiters.values())
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join(self.max_await_ms / 1000 + 1)
+        self.client.close()
+
+    def _wake(self, user_name: str):
+        with self.lock:
+            events = list(self.waiters.get(user_name, ()))
+        for event in events:
+            event.set()
+
+    def _run(self):
+        """
+        Tails the inbox until closed, reopening the cursor when it dies (the collection
+        was empty, or wrapped past the cursor's position)
+        """
+        last_id = None
+        started = False
+        while not self.stopping.is_set():
+            try:
+                if not started:
+                    # Only notifications added from now on are of interest
+                    last_id = self.db.fetch_last_inbox_id()
+                    started = True
+                cursor = self.db.tail_inbox(last_id, self.max_await_ms)
+                while cursor.alive and not self.stopping.is_set():
+                    for entry in cursor:
+                        last_id = entry["_id"]
+                        self._wake(entry["username"])
+            except pymongo.errors.PyMongoError:
+                self.logger.error("Error occurred tailing the notification inbox", exc_info=True)
+            self.stopping.wait(1)
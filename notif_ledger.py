@@ -0,0 +1,132 @@
+"""
+Records every notification fan-out in the delivery ledger
+
+Each fan-out gets one entry in the notif_ledger collection, keyed by post, with the
+number of recipients, how many pushes were sent, failed, pruned (the subscription had
+expired) or left for a retry, when the notification was queued, started and finished,
+and the number of pushes and their latency per push service. Fan-outs split into
+several batch jobs (see notif_worker.py) add each batch to the same entry, so an entry
+always covers the whole fan-out. Admins can query the ledger at /api/admin/notifications.
+"""
+
+import datetime
+import threading
+from urllib.parse import urlparse
+
+# Ledger counters for each push result
+LEDGER_COUNTERS = {"sent": "sent", "failed": "failed", "expired": "pruned", "retry": "retried"}
+
+
+def service_key(endpoint: str):
+    """
+    Returns the key of a push service in a ledger entry (its host, without dots since
+    MongoDB field names cannot contain them)
+    """
+    return (urlparse(endpoint).netloc or "unknown").replace(".", "_")
+
+
+class FanoutRecord:
+    """
+    Collects the results of one fan-out (or one batch of it) until it is saved to the
+    ledger. Safe to share between threads
+    """
+
+    def __init__(self, board_id, post_id, queued: datetime.datetime = None):
+        """
+        Parameters:
+         - board_id: the board of the post
+         - post_id: the post being notified about
+         - queued: when the notification was queued, if known
+        """
+        self.board_id = board_id
+        self.post_id = post_id
+        self.queued = queued
+        self.started = datetime.datetime.now()
+        self.lock = threading.Lock()
+        self.recipients = 0
+        self.counts = {counter: 0 for counter in LEDGER_COUNTERS.values()}
+        self.services = {}
+
+    def add_recipients(self, count: int):
+        with self.lock:
+            self.recipients += count
+
+    def record(self, endpoint: str, result: str, seconds: float = None):
+        """
+        Records the result of one push
+
+        Parameters:
+         - endpoint: the subscription endpoint pushed to
+         - result: "sent", "failed", "expired" or "retry"
+         - seconds: how long the push service took to answer, or None if it was not contacted
+        """
+        counter = LEDGER_COUNTERS[result]
+        key = service_key(endpoint)
+        with self.lock:
+            self.counts[counter] += 1
+            service = self.services.get(key)
+            if service is None:
+                service = self.services[key] = {"origin": urlparse(endpoint).netloc, "pushes": 0, "latency_ms": 0.0,
+                                                "max_latency_ms": 0.0, "timed": 0}
+                service.update({c: 0 for c in LEDGER_COUNTERS.values()})
+            service["pushes"] += 1
+            service[counter] += 1
+            if seconds is not None:
+                service["timed"] += 1
+                service["latency_ms"] += seconds * 1000
+                service["max_latency_ms"] = max(service["max_latency_ms"], seconds * 1000)
+
+    def save(self, app_db):
+        """
+        Adds the collected results to the fan-out's ledger entry
+        """
+        with self.lock:
+            app_db.record_fanout_ledger(self.board_id, self.post_id, self.queued, self.started,
+                                        datetime.datetime.now(), self.recipients, dict(self.counts),
+                                        {k: dict(v) for k, v in self.services.items()})
+
+
+def ledger_summary(entry: dict):
+    """
+    Converts a ledger entry into its admin API form: durations in milliseconds and a
+    list of push services with their average latency
+
+    Parameters:
+     - entry: the ledger entry
+    Returns:
+     - A dictionary ready to be serialized
+    """
+    def ms(start, end):
+        if start is None or end is None:
+            return None
+        return round((end - start).total_seconds() * 1000, 1)
+
+    services = []
+    for service in entry.get("services", {}).values():
+        timed = service.get("timed", 0)
+        services.append({
+            "origin": service.get("origin"),
+            "pushes": service.get("pushes", 0),
+            "sent": service.get("sent", 0),
+            "failed": service.get("failed", 0),
+            "pruned": service.get("pruned", 0),
+            "retried": service.get("retried", 0),
+            "avg_latency_ms": round(service.get("latency_ms", 0) / timed, 1) if timed else None,
+            "max_latency_ms": round(service.get("max_latency_ms", 0), 1) if timed else None,
+        })
+    return {
+        "post_id": str(entry["_id"]),
+        "board_id": str(entry.get("board_id")),
+        "recipients": entry.get("recipients", 0),
+        "sent": entry.get("sent", 0),
+        "failed": entry.get("failed", 0),
+        "pruned": entry.get("pruned", 0),
+        "retried": entry.get("retried", 0),
+        "queued": entry["queued"].isoformat() if entry.get("queued") else None,
+        "started": entry["started"].isoformat() if entry.get("started") else None,
+        "finished": entry["finished"].isoformat() if entry.get("finished") else None,
+        "queue_ms": ms(entry.get("queued"), entry.get("started")),
+        "fanout_ms": ms(entry.get("started"), entry.get("finished")),
+        "total_ms": ms(entry.get("queued") or entry.get("started"), entry.get("finished")),
+        "services": sorted(services, key=lambda s: -s["pushes"]),
+    }
@@ -0,0 +1,377 @@
+"""
+Standalone worker delivering queued notifications
+
+When the "notif_queue" config entry is set, the web server does not send notifications
+itself. Instead it queues one fan-out job per post in the notif_jobs collection, and any
+number of these workers (on any number of machines) process them:
+ - A fan-out job resolves the post's recipients and splits them into batch jobs of
+   "notif_batch_size" subscriptions each
+ - A batch job sends the post's notification to each of its subscriptions
+
+Workers claim jobs with a lease ("notif_lease_seconds"), which they renew while the job
+runs. If a worker dies mid-job, the lease runs out and another worker picks the job up
+again. Failed jobs are retried with exponential backoff ("notif_retry_base" doubling up to
+"notif_retry_max" seconds) and are dead-lettered after "notif_max_attempts" attempts. Every
+successful push is recorded in notif_deliveries as soon as it is sent, so a retried batch
+only sends to the subscriptions it missed. The fan-out job and each batch job add their
+results to the post's delivery ledger entry (see notif_ledger.py).
+
+In digest mode ("notif_digest_seconds", see notif_digest.py), a fan-out job adds the post
+to its recipients' digests instead of queueing batch jobs, and workers push the digests
+that are due. Unless disabled, a fan-out job also adds the post to the in-app inbox of
+every board member (see notif_inbox.py).
+
+Workers also sweep for posts that reached their vote threshold without a vote crossing
+it (members left or the threshold was lowered) every "notif_sweep_seconds". Each sweep
+only checks boards whose thresholds changed since the previous sweep.
+
+To run a worker (replace <> accordingly):
+    $ CONFIG_LOC=<config file> python3 -m notif_worker --threads 4
+"""
+
+import argparse
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+
+import config
+import db
+import notif_dispatcher
+import notif_inbox
+import notif_ledger
+import server_metrics
+from server_notifs import get_inbox_bytes, get_push_digest, get_push_engine, send_web_push
+
+# Number of batch jobs queued per insert while a fan-out streams its recipients
+BATCHES_PER_INSERT = 10
+
+
+class RetryableError(Exception):
+    """
+    Raised when a job failed in a way that may succeed on a later attempt
+    """
+
+
+class NotificationWorker:
+    """
+    Claims and processes notification jobs until stopped
+    """
+
+    def __init__(self, db_link: str, send, vapid_email: str, private_key: str, name: str = None,
+                 send_workers: int = 16, batch_size: int = 100, lease_seconds: int = 60,
+                 max_attempts: int = 5, retry_base: float = 5, retry_max: float = 600,
+                 poll_interval: float = 1, engine=None, digest=None, inbox_bytes: int = 0,
+                 retention_seconds: int = 7 * 24 * 3600):
+        """
+        Parameters:
+         - db_link: the URL to the MongoDB instance
+         - send: function sending one web push, called as send(subscription, payload, vapid_email, private_key, headers)
+         - vapid_email: the email of the VAPID key
+         - private_key: the private VAPID key
+         - name: name of the worker, used as the lease owner
+         - send_workers: number of pushes sent at once
+         - batch_size: number of subscriptions per batch job
+         - lease_seconds: how long a claimed job is held before other workers may claim it
+         - max_attempts: number of attempts before a job is dead-lettered
+         - retry_base: seconds before the first retry, doubled on each later attempt
+         - retry_max: maximum seconds between retries
+         - poll_interval: seconds to wait when there are no jobs
+         - engine: an AsyncPushEngine to send pushes with instead of the send pool, or None
+         - digest: a DigestCoalescer to coalesce notifications with, or None to push each post
+         - inbox_bytes: size of the in-app notification inbox, or 0 to not write to it
+         - retention_seconds: how long finished jobs and delivery markers are kept
+        """
+        self.send = send
+        self.vapid_email = vapid_email
+        self.private_key = private_key
+        self.name = name or "%s-%d" % (socket.gethostname(), os.getpid())
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.poll_interval = poll_interval
+        self.engine = engine
+        self.digest = digest
+        self.inbox_bytes = inbox_bytes
+        self.logger = logging.getLogger("notifs")
+
+        self.client = pymongo.MongoClient(db_link)
+        self.db = db.AppDB(self.client)
+        self.db.ensure_notif_queue(retention_seconds)
+        self.db.ensure_recipient_index()
+        self.db.ensure_push_subscriptions()
+        self.db.ensure_threshold_sweep()
+        self.db.ensure_notif_ledger()
+        if digest is not None:
+            self.db.ensure_notif_digests()
+        if inbox_bytes > 0:
+            self.db.ensure_notif_inbox(inbox_bytes)
+        self.send_pool = ThreadPoolExecutor(max_workers=send_workers, thread_name_prefix="notif-send")
+        self.stopping = threading.Event()
+
+    def retry_delay(self, attempts: int):
+        """
+        Returns the seconds to wait before retrying a job that failed its given attempt
+        """
+        return min(self.retry_max, self.retry_base * 2 ** max(0, attempts - 1))
+
+    def run_once(self):
+        """
+        Claims and processes a single job
+
+        Returns:
+         - Whether a job was available
+        """
+        job = self.db.claim_notif_job(self.name, self.lease_seconds)
+        if job is None:
+            return False
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self.renew_lease, args=(job, done), name="notif-lease", daemon=True)
+        heartbeat.start()
+        try:
+            if job["kind"] == "fanout":
+                self.process_fanout(job)
+            else:
+                self.process_batch(job)
+            self.db.complete_notif_job(job["_id"], self.name)
+        except Exception as e:
+            dead = job["attempts"] >= self.max_attempts
+            if dead:
+                self.logger.error("Giving up on notification job %s after %d attempts: %s", job["_id"], job["attempts"], e)
+            elif not isinstance(e, RetryableError):
+                self.logger.warning("Error occurred processing notification job %s", job["_id"], exc_info=True)
+            self.db.retry_notif_job(job["_id"], self.name, str(e), self.retry_delay(job["attempts"]), dead)
+        finally:
+            done.set()
+            heartbeat.join()
+        return True
+
+    def renew_lease(self, job: dict, done: threading.Event):
+        """
+        Extends the lease of a job every third of the lease until done is set, so that other
+        workers do not claim a job that takes longer than its lease
+        """
+        while not done.wait(self.lease_seconds / 3):
+            try:
+                if not self.db.extend_notif_lease(job["_id"], self.name, self.lease_seconds):
+                    self.logger.warning("Lost the lease of notification job %s", job["_id"])
+                    return
+            except pymongo.errors.PyMongoError:
+                self.logger.error("Error occurred renewing the lease of notification job %s", job["_id"], exc_info=True)
+
+    def run(self):
+        """
+        Processes jobs until stop is called
+        """
+        while not self.stopping.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except pymongo.errors.PyMongoError:
+                self.logger.error("Error occurred claiming notification job", exc_info=True)
+            self.stopping.wait(self.poll_interval)
+
+    def sweep_thresholds(self):
+        """
+        Queues the notifications of posts that reached their threshold since the last sweep
+
+        Returns:
+         - The number of notifications queued
+        """
+        started = self.db.db_time()
+        queued = 0
+        for board_id, post_id in self.db.fetch_threshold_crossings(self.db.fetch_checkpoint(notif_dispatcher.SWEEP_CHECKPOINT)):
+            # Queued first so a crash cannot mark a post without notifying it. Queuing is
+            # idempotent per post, so a vote crossing the threshold meanwhile is harmless
+            self.db.enqueue_notif_job(board_id, post_id)
+            if self.db.notify_post_once(board_id, post_id):
+                queued += 1
+        self.db.save_checkpoint(notif_dispatcher.SWEEP_CHECKPOINT, started)
+        return queued
+
+    def run_sweeps(self, interval: float):
+        """
+        Sweeps for threshold crossings every interval seconds until stop is called
+        """
+        while not self.stopping.is_set():
+            try:
+                queued = self.sweep_thresholds()
+                if queued:
+                    self.logger.info("Threshold sweep queued %d notifications", queued)
+            except pymongo.errors.PyMongoError:
+                self.logger.error("Error occurred sweeping vote thresholds", exc_info=True)
+            self.stopping.wait(interval)
+
+    def run_digests(self):
+        """
+        Pushes due digests until stop is called
+        """
+        self.digest.run(self.db, self.send_pushes, self.stopping)
+
+    def stop(self):
+        """
+        Asks run to return once its current job is done
+        """
+        self.stopping.set()
+
+    def close(self):
+        self.send_pool.shutdown(wait=True)
+        if self.engine is not None:
+            self.engine.close()
+        self.client.close()
+
+    def send_pushes(self, pushes: list, record=None):
+        """
+        Sends a list of (subscription, payload, headers) pushes and waits for all of them
+
+        Parameters:
+         - pushes: the pushes to send
+         - record: function called as record(endpoint, result, seconds) once each push is done
+        Returns:
+         - A list with the result of each push: "sent", "expired", "failed" or "retry"
+        """
+        if self.engine is not None:
+            return self.engine.deliver(pushes, record)
+
+        def deliver(push):
+            start = time.perf_counter()
+            try:
+                self.send(push[0], push[1], self.vapid_email, self.private_key, push[2])
+                result = "sent"
+            except Exception as e:
+                result = notif_dispatcher.classify_push_error(e)
+                if result == "failed":
+                    self.logger.warning("Error occurred sending web push: %s", e)
+            if record is not None:
+                record(push[0].get("endpoint", ""), result, time.perf_counter() - start)
+            return result
+        return list(self.send_pool.map(deliver, pushes))
+
+    def process_fanout(self, job: dict):
+        """
+        Splits a post's recipients into batch jobs
+        """
+        found = self.db.fetch_notification_post(job["board_id"], job["post_id"])
+        if found is None:
+            return # Deleted before its notification went out
+        ledger = notif_ledger.FanoutRecord(job["board_id"], job["post_id"], job["created"])
+        recipients = 0
+        if self.inbox_bytes > 0 and not job.get("inbox_written"):
+            # Only written once, so a retried fan-out does not repeat the notification
+            notif_inbox.add_post(self.db, found[0], found[1])
+            self.db.mark_notif_job_inbox(job["_id"])
+        if self.digest is not None:
+            for batch in self.db.iter_notification_recipients(job["board_id"], self.batch_size):
+                recipients += len(batch)
+                self.digest.add(self.db, found[0], found[1], [r["username"] for r in batch])
+            ledger.add_recipients(recipients)
+            ledger.save(self.db)
+            server_metrics.record_fanout(recipients)
+            return
+        batches = []
+        first = 0
+        for batch in self.db.iter_notification_recipients(job["board_id"], self.batch_size):
+            recipients += len(batch)
+            batches.append(batch)
+            if len(batches) >= BATCHES_PER_INSERT:
+                self.db.add_notif_batches(job["board_id"], job["post_id"], batches, first)
+                first += len(batches)
+                batches = []
+        self.db.add_notif_batches(job["board_id"], job["post_id"], batches, first)
+        ledger.save(self.db) # Each batch job adds its recipients
+        server_metrics.record_fanout(recipients)
+
+    def process_batch(self, job: dict):
+        """
+        Sends a post's notification to every subscription of a batch not yet delivered to
+
+        Error: raises RetryableError if some pushes should be retried
+        """
+        found = self.db.fetch_notification_post(job["board_id"], job["post_id"])
+        if found is None:
+            return
+        board, post = found
+        endpoints = [r["subscription"].get("endpoint", "") for r in job["recipients"]]
+        delivered = self.db.fetch_delivered(job["post_id"], endpoints)
+        todo = [r for r, e in zip(job["recipients"], endpoints) if e not in delivered]
+        pushes = [(r["subscription"], notif_dispatcher.build_payload(board, post, r["username"]), None) for r in todo]
+        ledger = notif_ledger.FanoutRecord(job["board_id"], job["post_id"])
+        if job["attempts"] == 1:
+            ledger.add_recipients(len(job["recipients"])) # Counted once, even if the batch is retried
+
+        def record(endpoint, result, seconds):
+            ledger.record(endpoint, result, seconds)
+            # Marked as each push completes, so a batch reclaimed midway does not resend it.
+            # Expired and permanently failed subscriptions are not retried either
+            if result != "retry":
+                self.db.mark_delivered(job["post_id"], [endpoint])
+
+        results = self.send_pushes(pushes, record)
+        ledger.save(self.db)
+        # Remove expired subscriptions for the future, all at once
+        self.db.remove_push_subscriptions([r["subscription"]["endpoint"] for r, result in zip(todo, results) if result == "expired"])
+
+        for result in ("sent", "failed", "expired"):
+            server_metrics.record_push(result, results.count(result))
+        retries = results.count("retry")
+        if retries:
+            raise RetryableError("%d of %d pushes failed and will be retried" % (retries, len(todo)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Delivers queued notifications")
+    parser.add_argument("--threads", type=int, default=int(config.get("notif_worker_threads", 2)), help="number of jobs processed at once")
+    parser.add_argument("--name", help="name of this worker (defaults to host-pid)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    vapid_email = config.get("vapid_email", "")
+    private_key = config.get("vapid_private_key", "")
+    if vapid_email == "" or private_key == "":
+        raise SystemExit("The config needs vapid_email and vapid_private_key to send notifications")
+
+    worker = NotificationWorker(
+        db_link=config.get("db_link", ""),
+        send=send_web_push,
+        vapid_email=vapid_email,
+        private_key=private_key,
+        name=args.name,
+        send_workers=int(config.get("notif_send_workers", 16)),
+        batch_size=int(config.get("notif_batch_size", 100)),
+        lease_seconds=int(config.get("notif_lease_seconds", 60)),
+        max_attempts=int(config.get("notif_max_attempts", 5)),
+        retry_base=float(config.get("notif_retry_base", 5)),
+        retry_max=float(config.get("notif_retry_max", 600)),
+        engine=get_push_engine(vapid_email, private_key),
+        digest=get_push_digest(),
+        inbox_bytes=get_inbox_bytes(),
+        retention_seconds=int(float(config.get("notif_retention_days", 7)) * 24 * 3600))
+    logging.getLogger("notifs").info("Notification worker %s started with %d threads", worker.name, args.threads)
+
+    threads = [threading.Thread(target=worker.run, name="notif-worker-%d" % i) for i in range(args.threads)]
+    sweep_interval = float(config.get("notif_sweep_seconds", 60))
+    if sweep_interval > 0:
+        threads.append(threading.Thread(target=worker.run_sweeps, args=(sweep_interval,), name="notif-sweep"))
+    if worker.digest is not None:
+        threads.append(threading.Thread(target=worker.run_digests, name="notif-digest"))
+    for t in threads:
+        t.start()
+    try:
+        while any(t.is_alive() for t in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logging.getLogger("notifs").info("Stopping after the current jobs...")
+        worker.stop()
+        for t in threads:
+            t.join()
+    worker.close()
+
+
+if __name__ == "__main__":
+    main()
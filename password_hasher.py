@@ -0,0 +1,128 @@
+"""
+Hashes and verifies passwords in a bounded pool of worker processes
+
+Hashing a password with sha256_crypt takes hundreds of milliseconds of CPU on purpose.
+Done inside the request thread, a burst of logins or registrations holds the gunicorn
+worker's CPU (and, with threads, its GIL) and stalls every other request it serves.
+Instead, each server process hands hashing to its own small pool of worker processes
+("password_processes"). At most "password_max_pending" hashes may wait or run at once per
+server process; past that, callers get PasswordHasherBusy straight away and answer 503,
+rather than queueing logins the user will have given up on.
+
+The number of rounds of new hashes is set by "password_rounds". Existing hashes keep the
+rounds they were made with, which verify reads from the hash itself.
+"""
+
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from passlib.hash import sha256_crypt
+
+# Default sha256_crypt rounds (passlib's own default)
+DEFAULT_ROUNDS = 535000
+
+
+def hash_password(password: str, salt: str, rounds: int):
+    """
+    Hashes a password. Runs in a worker process
+
+    Parameters:
+     - password: the cleartext password
+     - salt: the salt to use
+     - rounds: the number of sha256_crypt rounds
+    Returns:
+     - The hash
+    """
+    return sha256_crypt.using(rounds=rounds, salt=salt).hash(password)
+
+
+def verify_password(password: str, hash_value: str):
+    """
+    Verifies a password against its hash. Runs in a worker process
+
+    Returns:
+     - Whether the password matches
+    """
+    return sha256_crypt.verify(password, hash_value)
+
+
+class PasswordHasherBusy(Exception):
+    """
+    Raised when too many hashes are already waiting or running
+    """
+
+
+class PasswordHasher:
+    """
+    Bounded pool of processes hashing and verifying passwords. Safe to share between threads
+    """
+
+    def __init__(self, processes: int = 1, max_pending: int = 8, rounds: int = DEFAULT_ROUNDS,
+                 timeout: float = 30):
+        """
+        Parameters:
+         - processes: number of worker processes, or 0 to hash in the calling thread
+         - max_pending: hashes that may wait or run at once before callers are turned away
+         - rounds: the number of sha256_crypt rounds of new hashes
+         - timeout: seconds to wait for a hash before giving up
+        """
+        self.rounds = rounds
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.pool = None
+        if processes > 0:
+            # Spawned rather than forked, since the server process already runs threads
+            self.pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+
+    def hash(self, password: str, salt: str):
+        """
+        Hashes a password
+
+        Parameters:
+         - password: the cleartext password
+         - salt: the salt to use
+        Returns:
+         - The hash
+        Error: raises PasswordHasherBusy if max_pending hashes are already pending, or on timeout
+        """
+        return self._run(hash_password, password, salt, self.rounds)
+
+    def verify(self, password: str, hash_value: str):
+        """
+        Verifies a password against its hash
+
+        Parameters:
+         - password: the cleartext password
+         - hash_value: the hash to verify against
+        Returns:
+         - Whether the password matches
+        Error: raises PasswordHasherBusy if max_pending hashes are already pending, or on timeout
+        """
+        return self._run(verify_password, password, hash_value)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+    def _run(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            raise PasswordHasherBusy("Too many logins at once, try again later")
+        if self.pool is None:
+            try:
+                return function(*args)
+            finally:
+                self.slots.release()
+        try:
+            future = self.pool.submit(function, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        # The slot is only given back once the hash is done or cancelled, so that hashes
+        # abandoned on timeout still count towards max_pending
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            future.cancel() # Dropped if it has not started yet
+            raise PasswordHasherBusy("Timed out waiting for the password to be checked, try again later")
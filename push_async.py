@@ -0,0 +1,227 @@
+"""
+Delivers web pushes concurrently from a single asyncio event loop
+
+Blocking HTTP needs one thread per push in flight, which caps fan-out throughput. An
+AsyncPushEngine instead runs one event loop on a background thread and keeps thousands
+of pushes in flight over aiohttp. Threads (such as the dispatcher's fan-out threads or
+notification workers) hand it whole batches with deliver and wait for the results.
+
+Each push service origin gets its own concurrency limit and connection pool. When a push
+service answers 429 Too Many Requests, every push to it is paused for its Retry-After
+and the rate limited pushes are tried again. Pushes answered with 404 or 410 are reported
+as "expired" so the caller can prune those subscriptions in bulk.
+
+Encryption and VAPID signing are done by a PushSender, so its cached VAPID headers are shared.
+Encryption is CPU-bound and would stall the event loop for large batches, so the engine
+can be given encryption worker processes. Batches are then split into chunks that are
+encrypted in the worker processes, and each chunk is sent as soon as it is encrypted.
+"""
+
+import asyncio
+import email.utils
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+
+from push_sender import PushSender, encrypt_batch, endpoint_origin
+
+# Number of pushes encrypted per task in an encryption worker process
+ENCRYPT_CHUNK_SIZE = 200
+
+
+def parse_retry_after(value: str, default: float):
+    """
+    Parses a Retry-After header, given either in seconds or as an HTTP date
+
+    Parameters:
+     - value: the header value, or None
+     - default: seconds to use when the header is missing or malformed
+    Returns:
+     - The number of seconds to wait
+    """
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class _Origin:
+    """
+    The concurrency limit, connections and rate limit state of one push service
+    """
+
+    def __init__(self, concurrency: int, timeout: float):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=concurrency),
+            timeout=aiohttp.ClientTimeout(total=timeout))
+        self.paused_until = 0.0
+
+
+class AsyncPushEngine:
+    """
+    Owns the event loop thread and the per-origin state. Safe to share between threads
+    """
+
+    def __init__(self, sender: PushSender, origin_concurrency: int = 100, max_retries: int = 3,
+                 default_retry_after: float = 5, max_retry_after: float = 60, encrypt_processes: int = 0):
+        """
+        Parameters:
+         - sender: the PushSender encrypting and signing the pushes
+         - origin_concurrency: maximum pushes in flight to a single push service
+         - max_retries: times a rate limited or failed push is retried
+         - default_retry_after: seconds to back off when a 429 has no Retry-After
+         - max_retry_after: the longest Retry-After honored, in seconds
+         - encrypt_processes: number of encryption worker processes, or 0 to encrypt on the event loop
+        """
+        self.sender = sender
+        self.origin_concurrency = origin_concurrency
+        self.max_retries = max_retries
+        self.default_retry_after = default_retry_after
+        self.max_retry_after = max_retry_after
+        self.logger = logging.getLogger("notifs")
+        self.origins = {}
+        self.encrypt_pool = None
+        if encrypt_processes > 0:
+            # Spawned rather than forked, since this process already runs threads
+            self.encrypt_pool = ProcessPoolExecutor(max_workers=encrypt_processes,
+                                                    mp_context=multiprocessing.get_context("spawn"))
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="notif-async", daemon=True)
+        self.thread.start()
+
+    def deliver(self, pushes: list, record=None):
+        """
+        Sends a batch of pushes and waits for all of them
+
+        Parameters:
+         - pushes: list of (subscription, payload) pairs, or (subscription, payload, headers)
+           triples to send extra headers (such as Topic or Urgency) to the push service
+         - record: function called as record(endpoint, result, seconds) once each push is done,
+           seconds being how long the push service took to answer (None if it was not contacted)
+        Returns:
+         - A list with the result of each push: "sent", "expired", "failed", or "retry"
+           when it kept failing temporarily and may succeed later
+        """
+        future = asyncio.run_coroutine_threadsafe(self._deliver(pushes, record), self.loop)
+        return future.result()
+
+    def close(self):
+        """
+        Closes every connection and stops the event loop
+        """
+        async def close_sessions():
+            for origin in self.origins.values():
+                await origin.session.close()
+        asyncio.run_coroutine_threadsafe(close_sessions(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        if self.encrypt_pool is not None:
+            self.encrypt_pool.shutdown(wait=True)
+
+    async def _deliver(self, pushes: list, record):
+        if self.encrypt_pool is None:
+            return await asyncio.gather(*(self._send(push[0], *self._encode(*push), record) for push in pushes))
+        chunks = [pushes[i:i + ENCRYPT_CHUNK_SIZE] for i in range(0, len(pushes), ENCRYPT_CHUNK_SIZE)]
+        results = await asyncio.gather(*(self._deliver_chunk(chunk, record) for chunk in chunks))
+        return [result for chunk in results for result in chunk]
+
+    async def _deliver_chunk(self, pushes: list, record):
+        """
+        Encrypts a chunk of pushes in an encryption worker process, then sends them
+        """
+        encrypted = await self.loop.run_in_executor(self.encrypt_pool, encrypt_batch, [push[:2] for push in pushes])
+        requests = []
+        for push, (body, error) in zip(pushes, encrypted):
+            if error is None:
+                requests.append((self.sender.request(push[0], body, push[2] if len(push) > 2 else None), None))
+            else:
+                requests.append((None, error))
+        return await asyncio.gather(*(self._send(push[0], request, error, record)
+                                      for push, (request, error) in zip(pushes, requests)))
+
+    def _encode(self, subscription: dict, payload: str, headers: dict = None):
+        """
+        Encrypts a push on the event loop
+
+        Returns:
+         - The (endpoint, body, headers) request and None, or None and the error
+        """
+        try:
+            return self.sender.encode(subscription, payload, headers), None
+        except Exception as e:
+            return None, str(e)
+
+    def _origin(self, origin: str):
+        state = self.origins.get(origin)
+        if state is None:
+            state = self.origins[origin] = _Origin(self.origin_concurrency, self.sender.timeout)
+        return state
+
+    async def _send(self, subscription: dict, request: tuple, error: str, record=None):
+        """
+        Sends one encrypted push, retrying it when rate limited or on temporary failures
+
+        Parameters:
+         - subscription: the subscription pushed to
+         - request: the (endpoint, body, headers) of the push, or None if it could not be encrypted
+         - error: why the push could not be encrypted
+         - record: function called as record(endpoint, result, seconds) with the result
+        """
+        result, seconds = await self._attempts(request, error)
+        if record is not None:
+            record(subscription.get("endpoint", ""), result, seconds)
+        return result
+
+    async def _attempts(self, request: tuple, error: str):
+        """
+        Returns the result of a push and how long the push service took to answer its last
+        attempt (None if it was never contacted)
+        """
+        if request is None:
+            self.logger.warning("Could not encrypt web push: %s", error)
+            return "failed", None
+        endpoint, body, headers = request
+        origin = self._origin(endpoint_origin(endpoint))
+
+        seconds = None
+        for attempt in range(self.max_retries + 1):
+            delay = origin.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay) # The push service asked us to back off
+            try:
+                async with origin.semaphore:
+                    start = time.perf_counter()
+                    async with origin.session.post(endpoint, data=body, headers=headers) as response:
+                        status = response.status
+                        retry_after = response.headers.get("Retry-After")
+                    seconds = time.perf_counter() - start
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.logger.warning("Error occurred sending web push: %s", e)
+                await asyncio.sleep(min(self.max_retry_after, self.default_retry_after * 2 ** attempt))
+                continue
+
+            if status <= 202:
+                return "sent", seconds
+            if status in (404, 410):
+                return "expired", seconds
+            if status == 429 or status >= 500:
+                wait = min(self.max_retry_after, parse_retry_after(retry_after, self.default_retry_after * 2 ** attempt))
+                if status == 429:
+                    origin.paused_until = max(origin.paused_until, time.monotonic() + wait)
+                else:
+                    await asyncio.sleep(wait)
+                continue
+            self.logger.warning("Push service rejected web push with status %d", status)
+            return "failed", seconds
+        return "retry", seconds
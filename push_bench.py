@@ -0,0 +1,204 @@
+"""
+Benchmarks sending web pushes against a local stand-in push service
+
+The stand-in push service accepts every push with 201 Created (like a real push service)
+and can add an artificial delay per push to mimic network latency. Synthetic subscriptions
+with real encryption keys are generated, so each push is encrypted and VAPID-signed just
+like in production. The following senders are compared:
+ - webpush: pywebpush.webpush per push (parses the key, signs a token and connects every time)
+ - sender: a shared PushSender (cached VAPID headers, pooled keep-alive connections)
+ - async: an AsyncPushEngine, handed batches of --batch pushes (uses --threads as its
+   per push service concurrency)
+
+To run the benchmark:
+    $ python3 push_bench.py --pushes 2000 --threads 16 --latency-ms 5
+"""
+
+import argparse
+import base64
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pywebpush
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from py_vapid import Vapid
+
+import push_async
+import push_sender
+
+
+def b64url(data: bytes):
+    return base64.urlsafe_b64encode(data).strip(b"=").decode("utf8")
+
+
+class StandInPushService(BaseHTTPRequestHandler):
+    """
+    Accepts every push, optionally after a delay
+    """
+    protocol_version = "HTTP/1.1" # Keep-alive, like real push services
+    latency = 0.0
+    counter = None
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.latency > 0:
+            time.sleep(self.latency)
+        self.counter.add(self.client_address)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class ConnectionCounter:
+    """
+    Counts the pushes received and the distinct client connections they arrived on
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pushes = 0
+        self.connections = set()
+
+    def add(self, address):
+        with self.lock:
+            self.pushes += 1
+            self.connections.add(address)
+
+    def reset(self):
+        with self.lock:
+            self.pushes = 0
+            self.connections = set()
+
+
+def start_push_service(latency: float):
+    """
+    Starts the stand-in push service on a free local port
+
+    Returns:
+     - The server and the counter of pushes it received
+    """
+    counter = ConnectionCounter()
+    handler = type("Handler", (StandInPushService,), {"latency": latency, "counter": counter})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, counter
+
+
+def make_subscriptions(base_url: str, count: int):
+    """
+    Generates subscriptions with real encryption keys pointing at the stand-in push service
+    """
+    subscriptions = []
+    for i in range(count):
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        p256dh = key.public_key().public_bytes(serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint)
+        subscriptions.append({"endpoint": "%s/push/%d" % (base_url, i),
+                              "keys": {"p256dh": b64url(p256dh), "auth": b64url(os.urandom(16))}})
+    return subscriptions
+
+
+def make_vapid_key():
+    """
+    Generates a VAPID private key in the raw base64url form used in config.json
+    """
+    vapid = Vapid()
+    vapid.generate_keys()
+    return b64url(vapid.private_key.private_numbers().private_value.to_bytes(32, "big"))
+
+
+def run(send, subscriptions: list, threads: int):
+    """
+    Sends one push to every subscription from a pool of threads
+
+    Returns:
+     - The elapsed seconds and the number of failed pushes
+    """
+    payload = json.dumps({"message": "benchmark push", "board_name": "bench"})
+    failures = []
+    def one(subscription):
+        try:
+            send(subscription, payload)
+        except Exception as e:
+            failures.append(e)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(one, subscriptions))
+    return time.perf_counter() - start, len(failures)
+
+
+def run_async(engine, subscriptions: list, batch: int):
+    """
+    Sends one push to every subscription through the async engine, a batch at a time
+
+    Returns:
+     - The elapsed seconds and the number of failed pushes
+    """
+    payload = json.dumps({"message": "benchmark push", "board_name": "bench"})
+    failures = 0
+    start = time.perf_counter()
+    for i in range(0, len(subscriptions), batch):
+        results = engine.deliver([(s, payload) for s in subscriptions[i:i + batch]])
+        failures += sum(1 for r in results if r != "sent")
+    return time.perf_counter() - start, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks web push senders against a local stand-in push service")
+    parser.add_argument("--pushes", type=int, default=1000, help="number of pushes per sender")
+    parser.add_argument("--threads", type=int, default=16, help="number of sending threads")
+    parser.add_argument("--batch", type=int, default=500, help="pushes handed to the async engine at a time")
+    parser.add_argument("--latency-ms", type=float, default=0, help="artificial push service latency per push")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    server, counter = start_push_service(args.latency_ms / 1000)
+    base_url = "http://127.0.0.1:%d" % server.server_address[1]
+    print("Generating %d subscriptions..." % args.pushes)
+    subscriptions = make_subscriptions(base_url, args.pushes)
+    vapid_email = "bench@example.com"
+    private_key = make_vapid_key()
+
+    sender = push_sender.PushSender(vapid_email, private_key, pool_size=args.threads)
+    engine = push_async.AsyncPushEngine(sender, origin_concurrency=args.threads)
+    senders = {
+        "webpush": lambda: run(lambda s, p: pywebpush.webpush(subscription_info=s, data=p, vapid_private_key=private_key,
+                                                               vapid_claims={"sub": "mailto: %s" % vapid_email}),
+                               subscriptions, args.threads),
+        "sender": lambda: run(sender.send, subscriptions, args.threads),
+        "async": lambda: run_async(engine, subscriptions, args.batch),
+    }
+
+    results = {}
+    print("%-10s %10s %12s %12s %10s" % ("sender", "seconds", "pushes/sec", "connections", "failures"))
+    for name, bench in senders.items():
+        counter.reset()
+        elapsed, failures = bench()
+        results[name] = {"seconds": round(elapsed, 3),
+                         "pushes_per_sec": round(args.pushes / elapsed, 1),
+                         "connections": len(counter.connections),
+                         "failures": failures}
+        print("%-10s %10.3f %12.1f %12d %10d" % (name, elapsed, args.pushes / elapsed, len(counter.connections), failures))
+    for name in ("sender", "async"):
+        print("Speedup of %s: %.2fx" % (name, results[name]["pushes_per_sec"] / results["webpush"]["pushes_per_sec"]))
+
+    engine.close()
+    sender.close()
+    server.shutdown()
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump({"config": vars(args), "results": results}, outfile, indent=4)
+        print("Results written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+Sends web pushes while reusing as much work as possible between them
+
+pywebpush.webpush parses the VAPID private key, signs a new VAPID token and opens a new
+HTTPS connection for every single push. A PushSender instead:
+ - Loads the VAPID private key once
+ - Signs one VAPID token per push service origin (such as https://fcm.googleapis.com)
+   and reuses it until shortly before it expires
+ - Keeps one keep-alive connection pool per push service origin
+
+Payload encryption is still done per push, since every subscription has its own keys.
+It is CPU-bound, so encrypt_batch is a plain function that encryption worker processes
+can run (see push_async.py).
+"""
+
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import pywebpush
+import requests
+from py_vapid import Vapid
+
+import server_metrics
+
+# How long signed VAPID tokens are valid for (push services accept at most 24 hours)
+VAPID_LIFETIME = 12 * 60 * 60
+
+# The payload encryption used for every push (RFC 8291)
+CONTENT_ENCODING = "aes128gcm"
+
+# Tokens are signed again once they have less than this many seconds left
+VAPID_REFRESH_MARGIN = 60 * 60
+
+
+def encrypt(subscription_information: dict, payload: str):
+    """
+    Encrypts a payload for one subscription (an ECDH key agreement and AES-GCM encryption)
+
+    Parameters:
+     - subscription_information: the subscription generated by the end client
+     - payload: the message string to send
+    Returns:
+     - The encrypted body of the push
+    Error: raises pywebpush.WebPushException if the subscription is malformed
+    """
+    return pywebpush.WebPusher(subscription_information).encode(payload, CONTENT_ENCODING)["body"]
+
+
+def encrypt_batch(pushes: list):
+    """
+    Encrypts a batch of pushes. Runs in encryption worker processes, so it only takes and
+    returns plain (picklable) values
+
+    Parameters:
+     - pushes: list of (subscription, payload) pairs
+    Returns:
+     - A list with a (body, None) or (None, error message) pair per push
+    """
+    results = []
+    for subscription, payload in pushes:
+        try:
+            results.append((encrypt(subscription, payload), None))
+        except Exception as e:
+            results.append((None, str(e)))
+    return results
+
+
+def endpoint_origin(endpoint: str):
+    """
+    Returns the origin ("scheme://host[:port]") of a push subscription endpoint
+    """
+    url = urlparse(endpoint)
+    return "%s://%s" % (url.scheme, url.netloc)
+
+
+class PushSender:
+    """
+    Sends web pushes with cached VAPID headers and pooled connections. Safe to share
+    between threads
+    """
+
+    def __init__(self, vapid_email: str, private_key: str, ttl: int = 0, timeout: float = 10,
+                 pool_size: int = 16):
+        """
+        Parameters:
+         - vapid_email: the email of the VAPID key
+         - private_key: the private VAPID key (or the path to a file containing it)
+         - ttl: seconds push services keep a push for an offline device
+         - timeout: seconds to wait for a push service to respond
+         - pool_size: connections kept open to each push service
+        """
+        if os.path.isfile(private_key):
+            self.vapid = Vapid.from_file(private_key_file=private_key)
+        else:
+            self.vapid = Vapid.from_string(private_key=private_key)
+        self.subject = "mailto: %s" % vapid_email
+        self.ttl = ttl
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.headers = {} # origin -> (VAPID headers, expiry)
+        self.sessions = {} # origin -> requests.Session
+
+    def vapid_headers(self, origin: str):
+        """
+        Returns the VAPID headers for a push service, signing new ones if needed
+
+        Parameters:
+         - origin: the origin of the push service
+        """
+        now = time.time()
+        with self.lock:
+            cached = self.headers.get(origin)
+        if cached is not None and cached[1] - now > VAPID_REFRESH_MARGIN:
+            server_metrics.record_cache("vapid_headers", True)
+            return cached[0]
+        server_metrics.record_cache("vapid_headers", False)
+        exp = int(now) + VAPID_LIFETIME
+        headers = self.vapid.sign({"sub": self.subject, "aud": origin, "exp": exp})
+        with self.lock:
+            self.headers[origin] = (headers, exp)
+        return headers
+
+    def session(self, origin: str):
+        """
+        Returns the HTTP session (and so the connection pool) used for a push service
+
+        Parameters:
+         - origin: the origin of the push service
+        """
+        with self.lock:
+            session = self.sessions.get(origin)
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount(origin, adapter)
+                self.sessions[origin] = session
+            return session
+
+    def encode(self, subscription_information: dict, payload: str, headers: dict = None):
+        """
+        Encrypts a web push and builds its HTTP request, without sending it
+
+        Parameters:
+         - subscription_information: the subscription generated by the end client
+         - payload: the message string to send
+         - headers: extra HTTP headers for the push service
+        Returns:
+         - The endpoint to POST to, the encrypted body and the HTTP headers
+        Error: raises pywebpush.WebPushException if the subscription is malformed
+        """
+        return self.request(subscription_information, encrypt(subscription_information, payload), headers)
+
+    def request(self, subscription_information: dict, body: bytes, headers: dict = None):
+        """
+        Builds the HTTP request of an already encrypted web push
+
+        Parameters:
+         - subscription_information: the subscription generated by the end client
+         - body: the encrypted body
+         - headers: extra HTTP headers for the push service
+        Returns:
+         - The endpoint to POST to, the encrypted body and the HTTP headers
+        """
+        endpoint = subscription_information.get("endpoint", "")
+        all_headers = {"ttl": str(self.ttl), "content-encoding": CONTENT_ENCODING}
+        all_headers.update(headers or {})
+        all_headers.update(self.vapid_headers(endpoint_origin(endpoint)))
+        return endpoint, body, all_headers
+
+    def send(self, subscription_information: dict, payload: str, headers: dict = None):
+        """
+        Encrypts and sends a single web push
+
+        Parameters:
+         - subscription_information: the subscription generated by the end client
+         - payload: the message string to send
+         - headers: extra HTTP headers for the push service
+        Returns:
+         - The push service's response
+        Error: raises pywebpush.WebPushException if the push service rejects the push
+        """
+        endpoint, body, all_headers = self.encode(subscription_information, payload, headers)
+        response = self.session(endpoint_origin(endpoint)).post(endpoint, data=body, headers=all_headers, timeout=self.timeout)
+        if response.status_code > 202:
+            raise pywebpush.WebPushException("Push failed: {} {}\nResponse body:{}".format(
+                response.status_code, response.reason, response.text), response=response)
+        return response
+
+    def close(self):
+        """
+        Closes every pooled connection
+        """
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
@@ -0,0 +1,235 @@
+"""
+Token bucket rate limiting shared across server processes
+
+Logins and registrations hash a password, and votes, posts and comments each make several
+database round trips, so a single client hammering them slows everybody down. Each of these
+endpoints gets token buckets per user and/or per client IP: a bucket holds up to "burst"
+tokens, refills at "rate" tokens per second and every request takes one. A request finding
+its bucket empty is answered 429 with a Retry-After header telling when a token will be back.
+
+The buckets of every gunicorn worker live in one memory mapped file (the "rate_limit_file"
+config entry), so a client cannot get around its limits by landing on another worker. The
+file is a fixed size hash table of sets of SET_SIZE slots; a key lives in one set, and when
+its set is full the bucket least recently used is replaced. Each set is guarded by an fcntl
+lock on its byte range (and a thread lock, as fcntl locks do not exclude threads of the same
+process), so taking a token costs a hash, two system calls and no network round trip.
+
+Limits are set per endpoint with the "rate_limits" config entry, which replaces the defaults
+in DEFAULT_LIMITS:
+    "rate_limits": {
+        "<endpoint>": {"rate": tokens per second, "burst": bucket size,
+                       "by": ["user", "ip"], "methods": ["POST"]},
+        ...
+    }
+"by" lists the buckets a request takes a token from (requests of logged out users use their
+IP for "user" buckets), and "methods" the HTTP methods that are limited.
+"""
+
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import flask
+
+import config
+import server_auth
+
+# Limits used when the "rate_limits" config entry is not set
+DEFAULT_LIMITS = {
+    "auth_blueprint.login": {"rate": 10 / 60, "burst": 10, "by": ["ip"]},
+    "auth_blueprint.register": {"rate": 1 / 60, "burst": 5, "by": ["ip"]},
+    "api_blueprint.api_board_add": {"rate": 1 / 60, "burst": 5, "by": ["user", "ip"]},
+    "api_blueprint.api_post_create": {"rate": 1 / 30, "burst": 5, "by": ["user", "ip"]},
+    "api_blueprint.api_post_upvote": {"rate": 1, "burst": 30, "by": ["user", "ip"]},
+    "api_blueprint.api_post_cancel_vote": {"rate": 1, "burst": 30, "by": ["user", "ip"]},
+    "api_blueprint.api_comment_create": {"rate": 1 / 5, "burst": 10, "by": ["user", "ip"]},
+    "api_blueprint.api_comment_upvote": {"rate": 1, "burst": 30, "by": ["user", "ip"]},
+}
+
+# Layout of a bucket: key hash (0 for an empty slot), tokens left, last time tokens were taken
+SLOT = struct.Struct("<Qdd")
+
+# Buckets per set; a key is only ever stored in its own set
+SET_SIZE = 8
+
+# Number of thread locks the sets are striped over
+THREAD_LOCKS = 256
+
+
+def default_path():
+    """
+    Returns the default location of the shared bucket file
+    """
+    return os.path.join(tempfile.gettempdir(), "tac_rate_limit")
+
+
+class TokenBuckets:
+    """
+    Fixed size table of token buckets in a memory mapped file, shared by every process
+    opening the same file. Safe to share between threads
+    """
+
+    def __init__(self, path: str, slots: int = 65536):
+        """
+        Opens (or creates) the bucket file
+
+        Parameters:
+         - path: the bucket file
+         - slots: number of buckets in the table, rounded up to a whole number of sets
+        """
+        self.sets = max(1, -(-slots // SET_SIZE))
+        self.set_bytes = SLOT.size * SET_SIZE
+        size = self.sets * self.set_bytes
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size) # New bytes read as zero, i.e. empty slots
+        self.map = mmap.mmap(self.fd, size)
+        self.locks = [threading.Lock() for _ in range(min(self.sets, THREAD_LOCKS))]
+
+    def take(self, key: str, rate: float, burst: float, now: float = None):
+        """
+        Takes a token from a key's bucket if it has one
+
+        Parameters:
+         - key: the bucket key
+         - rate: tokens added to the bucket per second
+         - burst: the most tokens the bucket holds (a new bucket starts full)
+         - now: the current time.monotonic(), mostly for tests
+        Returns:
+         - 0 if a token was taken, otherwise the seconds until the bucket has one again
+        """
+        digest = int.from_bytes(hashlib.blake2b(key.encode("utf8"), digest_size=8).digest(), "little") or 1
+        index = digest % self.sets
+        start = index * self.set_bytes
+        with self.locks[index % len(self.locks)]:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, self.set_bytes, start)
+            try:
+                if now is None:
+                    now = time.monotonic() # Read under the lock, so no other process wrote a later time
+                offset, tokens, last = self._find(start, digest)
+                if tokens is None or last > now + 60:
+                    tokens, last = burst, now # New bucket, or one from before a reboot
+                tokens = min(burst, tokens + max(0.0, now - last) * rate)
+                wait = 0.0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / rate if rate > 0 else math.inf
+                SLOT.pack_into(self.map, offset, digest, tokens, now)
+                return wait
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, self.set_bytes, start)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    def _find(self, start: int, digest: int):
+        """
+        Finds the slot of a key in its set: its own, else an empty one, else the least recently used
+
+        Returns:
+         - The slot's offset, and its tokens and last time, both None if the key has no bucket yet
+        """
+        free = None
+        oldest, oldest_time = None, math.inf
+        for offset in range(start, start + self.set_bytes, SLOT.size):
+            slot_digest, tokens, last = SLOT.unpack_from(self.map, offset)
+            if slot_digest == digest:
+                return offset, tokens, last
+            if slot_digest == 0:
+                if free is None:
+                    free = offset
+            elif last < oldest_time:
+                oldest, oldest_time = offset, last
+        return (free if free is not None else oldest), None, None
+
+
+# The buckets of this process, opened on first use
+_buckets = None
+_buckets_lock = threading.Lock()
+
+
+def get_buckets():
+    """
+    Fetches the process's view of the shared buckets, opening the bucket file on first use
+    """
+    global _buckets
+    with _buckets_lock:
+        if _buckets is None:
+            _buckets = TokenBuckets(config.get("rate_limit_file", default_path()),
+                                    int(config.get("rate_limit_slots", 65536)))
+        return _buckets
+
+
+def client_ip(request):
+    """
+    Returns the IP of the client, skipping the "rate_limit_proxies" trusted reverse proxies
+    in front of the server (which add themselves to X-Forwarded-For)
+    """
+    proxies = int(config.get("rate_limit_proxies", 0))
+    if proxies <= 0 or not request.headers.get("X-Forwarded-For"):
+        return request.remote_addr or "unknown"
+    forwarded = request.access_route # The X-Forwarded-For entries, client first
+    return forwarded[max(0, len(forwarded) - proxies)]
+
+
+def get_limit(endpoint: str, method: str):
+    """
+    Returns the limit of an endpoint for an HTTP method, or None if it is not limited
+    """
+    limit = config.get("rate_limits", DEFAULT_LIMITS).get(endpoint)
+    if limit is None or method not in limit.get("methods", ["POST"]):
+        return None
+    return limit
+
+
+def check(endpoint: str, limit: dict, ip: str, user: str):
+    """
+    Takes a token from every bucket of a request
+
+    Parameters:
+     - endpoint: the Flask endpoint of the request
+     - limit: the endpoint's limit (see get_limit)
+     - ip: the client IP
+     - user: the username of the client, or "" if logged out
+    Returns:
+     - 0 if the request may go ahead, otherwise the seconds to wait before retrying
+    """
+    buckets = get_buckets()
+    # A logged out user's "user" bucket is their IP bucket, which is only taken from once
+    keys = {"%s|user|%s" % (endpoint, user) if by == "user" and user else "%s|ip|%s" % (endpoint, ip)
+            for by in limit.get("by", ["ip"])}
+    wait = 0
+    for key in keys:
+        wait = max(wait, buckets.take(key, float(limit["rate"]), float(limit["burst"])))
+    return wait
+
+
+def init_app(app):
+    """
+    Hooks rate limiting into the Flask app, unless the "rate_limit" config entry is false
+
+    Parameters:
+     - app: the Flask app
+    """
+    if not config.get("rate_limit", True):
+        return
+
+    @app.before_request
+    def _rate_limit():
+        request = flask.request
+        limit = get_limit(request.endpoint, request.method)
+        if limit is None:
+            return None
+        wait = check(request.endpoint, limit, client_ip(request), server_auth.get_curr_username())
+        if wait <= 0:
+            return None
+        retry_after = str(max(1, math.ceil(min(wait, 86400))))
+        return flask.jsonify({"error": "Too many requests, try again in %s seconds" % retry_after}), 429, {"Retry-After": retry_after}
@@ -0,0 +1,125 @@
+"""
+Unit tests for rate limiting
+
+To run the tests on this file do the following:
+    Basic test:
+        $ python3 rate_limit_test.py
+    Verbose test to see each test function's success or failure:
+        $ python3 -m unittest -v rate_limit_test.py
+"""
+
+import multiprocessing
+import os
+import tempfile
+import unittest
+
+import flask
+
+import config
+import rate_limit
+
+
+def take_all(path: str, count: int):
+    """
+    Takes count tokens from the "shared" bucket in a separate process
+    """
+    buckets = rate_limit.TokenBuckets(path, 64)
+    for _ in range(count):
+        buckets.take("shared", 0, 1000)
+    buckets.close()
+
+
+class RateLimitTests(unittest.TestCase):
+    """
+    Unit test driver for rate_limit.py
+    """
+
+    def setUp(self):
+        """
+        Opens buckets in a fresh file
+        """
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "buckets")
+        self.buckets = rate_limit.TokenBuckets(self.path, 64)
+
+    def tearDown(self):
+        self.buckets.close()
+        self.dir.cleanup()
+
+    def test_burst_then_refill(self):
+        """
+        Tests that a bucket allows its burst, then one request per 1/rate seconds
+        """
+        for _ in range(5):
+            self.assertEqual(0, self.buckets.take("a", 1, 5, now=100))
+        self.assertAlmostEqual(1, self.buckets.take("a", 1, 5, now=100))
+        self.assertAlmostEqual(0.5, self.buckets.take("a", 1, 5, now=100.5))
+        self.assertEqual(0, self.buckets.take("a", 1, 5, now=101))
+        # Refills up to the burst only
+        for _ in range(5):
+            self.assertEqual(0, self.buckets.take("a", 1, 5, now=1000))
+        self.assertGreater(self.buckets.take("a", 1, 5, now=1000), 0)
+
+    def test_keys_are_separate(self):
+        """
+        Tests that emptying one bucket leaves the others alone
+        """
+        self.assertEqual(0, self.buckets.take("a", 1, 1, now=100))
+        self.assertGreater(self.buckets.take("a", 1, 1, now=100), 0)
+        self.assertEqual(0, self.buckets.take("b", 1, 1, now=100))
+
+    def test_full_set_replaces_least_recently_used(self):
+        """
+        Tests that a full table keeps working by replacing the oldest buckets
+        """
+        buckets = rate_limit.TokenBuckets(os.path.join(self.dir.name, "small"), 1) # A single set
+        for i in range(rate_limit.SET_SIZE):
+            buckets.take("key%d" % i, 1, 1, now=100 + i)
+        self.assertGreater(buckets.take("key%d" % (rate_limit.SET_SIZE - 1), 1, 1, now=100 + rate_limit.SET_SIZE - 1), 0)
+        self.assertEqual(0, buckets.take("new", 1, 1, now=200))
+        # key0 was the least recently used, so it lost its bucket to "new" and starts full again
+        self.assertEqual(0, buckets.take("key0", 1, 1, now=100))
+        buckets.close()
+
+    def test_shared_between_processes(self):
+        """
+        Tests that processes opening the same file take from the same buckets
+        """
+        context = multiprocessing.get_context("spawn")
+        workers = [context.Process(target=take_all, args=(self.path, 100)) for _ in range(4)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        # 400 of 1000 tokens are gone, with no refill
+        for _ in range(600):
+            self.assertEqual(0, self.buckets.take("shared", 0, 1000))
+        self.assertGreater(self.buckets.take("shared", 0, 1000), 0)
+
+    def test_too_many_requests(self):
+        """
+        Tests that a limited endpoint answers 429 with Retry-After once its bucket is empty
+        """
+        config.config = {"rate_limit_file": os.path.join(self.dir.name, "app"),
+                         "rate_limits": {"limited": {"rate": 0.1, "burst": 2, "by": ["user", "ip"]}}}
+        rate_limit._buckets = None
+        app = flask.Flask(__name__)
+        app.secret_key = "test"
+        import server_auth
+        app.register_blueprint(server_auth.blueprint)
+        app.add_url_rule("/limited", "limited", lambda: "ok", methods=["GET", "POST"])
+        rate_limit.init_app(app)
+        client = app.test_client()
+        self.assertEqual(200, client.post("/limited").status_code)
+        self.assertEqual(200, client.post("/limited").status_code)
+        response = client.post("/limited")
+        self.assertEqual(429, response.status_code)
+        self.assertTrue(1 <= int(response.headers["Retry-After"]) <= 10)
+        self.assertEqual(200, client.get("/limited").status_code) # Only POST is limited
+        self.assertEqual(200, client.post("/limited", environ_base={"REMOTE_ADDR": "10.0.0.2"}).status_code)
+        rate_limit.get_buckets().close()
+        rate_limit._buckets = None
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,11 +4,17 @@ import logging # Used for logging
 import flask # Used as the backend and for webpage rendering
 
 # Imports from our own modules
+import compression
 import db_connect
+import db_monitor
+import db_slowlog
+import rate_limit
 import server_webpages
 import server_auth
 import server_api
+import server_events
 import server_notifs
+import server_metrics
 import config
 
 # Global variables
@@ -25,11 +31,27 @@ app.logger.handlers.extend(gunicorn_error_logger.handlers)
 app.register_blueprint(server_webpages.blueprint)
 app.register_blueprint(server_auth.blueprint)
 app.register_blueprint(server_api.blueprint)
+app.register_blueprint(server_events.blueprint)
 app.register_blueprint(server_notifs.blueprint)
+app.register_blueprint(server_metrics.blueprint)
 
 # Register the teardown context for the database
 app.teardown_appcontext(db_connect.db_teardown)
 
+# Account for database commands made by each request, and log slow database calls
+db_monitor.init_app(app)
+db_slowlog.init()
+
+# Start the notification dispatcher, which sweeps for posts that reached their vote threshold
+server_notifs.init_app(app)
+
+# Answer 429 to clients over the request rates of login and write endpoints
+rate_limit.init_app(app)
+
+# Compress responses with gzip or brotli. Hooked in last so that it runs before the other
+# after_request hooks, and request timings include it
+compression.init_app(app)
+
 if __name__ == "__main__":
     # Run app
     port = config.get('port', 5000)
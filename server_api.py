@@ -4,13 +4,17 @@ import flask
 import flask_restful
 from flask import Response
 
+import api_etags
+import api_json
+import api_tokens
 import db_connect
+import db_monitor
+import notif_ledger
 import server_auth
 import server_notifs
 import bson
 import pymongo
 import re
-from bson import json_util
 from bson.objectid import ObjectId
 
 # The blueprint for Flask to load in the main server file
@@ -47,6 +51,8 @@ def api_boards():
         ...
     ]
 
+    Answers 304 if the If-None-Match header holds the ETag of the current boards.
+
     On error, return a JSON with "error" set to the message
     """
 
@@ -62,11 +68,15 @@ def api_boards():
             return err('offset must be a positive integer')
     except KeyError:
         return err('Must provide search term and offset')
+    #any write to any board changes the board list's version stamp
+    etag = api_etags.make_etag(db.fetch_versions([db.BOARDS_VERSION]).get(db.BOARDS_VERSION))
+    if (unchanged := api_etags.not_modified(etag)):
+        return unchanged
     try: #attempt to query the database
         boards = db.fetch_boards(search, offset, False) #query database with keyword
     except (pymongo.errors.OperationFailure, re.error):
         return err('Invalid search given') #catch an error in the regex
-    return json_util.dumps(boards) # Return a JSON (using BSON decoder) of the boards
+    return api_etags.tagged(api_json.response(boards), etag) # Return a JSON of the boards
 
 
 @blueprint.route("/api/board/user")
@@ -88,17 +98,24 @@ def api_user_boards():
         ...
     ]
 
+    Answers 304 if the If-None-Match header holds the ETag of the current boards.
+
     On error, return a JSON with "error" set to the message
     """
     if not server_auth.is_authenticated(): #ensure user is logged in
         return err("Must be logged in to fetch boards", 403)
     db = db_connect.get_db()
-    username = server_auth.get_curr_username() #fetch user's username
+    userid = server_auth.get_curr_userid() #fetch user's id from the session claims
     #fetch user from database, and fail if user is not found
-    if username is None or not (user := db.fetch_user(None, username)):
+    if userid is None or not (user := db.fetch_user(userid, None)):
         return err('Could not find user', 404)
     #retrieve ObjectIds from the fetched user
     board_ids = user['subscriptions']
+    #the payload only changes with the subscriptions or the subscribed boards
+    versions = db.fetch_versions(board_ids)
+    etag = api_etags.make_etag(*[(i, versions.get(i)) for i in board_ids])
+    if (unchanged := api_etags.not_modified(etag)):
+        return unchanged
     boards = [] #return array
     for i in board_ids: #iterate over boards user is subscribed to
         obj = db.fetch_board(i) #fetch information about the board
@@ -106,13 +123,13 @@ def api_user_boards():
             'board_id': str(obj['_id']),
             'board_name': obj['board_name'],
             'board_description': obj['board_description'],
-            'board_date': str(obj['board_date']),
+            'board_date': obj['board_date'],
             'board_member_count': obj['board_member_count'],
             'board_vote_threshold': obj['board_vote_threshold'],
             "subscribed": True #user is obviously subscribed
         }
         boards.append(board)
-    return flask.jsonify(boards)
+    return api_etags.tagged(api_json.response(boards), etag)
 
 @blueprint.route("/api/admins")
 def api_admins():
@@ -132,7 +149,7 @@ def api_admins():
         db = db_connect.get_db()
         admins = db.fetch_admins() #query database for administrators
         admins = [i['username'] for i in admins] #convert to usernames from ids
-        return flask.jsonify(admins)
+        return api_json.response(admins)
     return err('User must be an admin to request admins', 403)
 
 @blueprint.route("/api/admins/add", methods=["POST"])
@@ -195,7 +212,91 @@ def api_admins_remove():
             return Response(status=200) #success
     return err('User must be an admin to remove an admin', 403)
 
+@blueprint.route("/api/admin/slowqueries")
+def api_admin_slow_queries():
+    """
+    Fetches the most recent slow database calls along with their query plans.
+
+    The user must be an administrator to perform this action.
+
+    GET request takes the following parameters:
+    "limit": integer, the maximum number of entries to return (default 50, at most 200)
+
+    Returns an array of slow query entries, newest first:
+    [
+        {
+            "method": string, the database method that was slow
+            "duration_ms": number, how long the method took
+            "date": date, when the method finished
+            "endpoint": string, the endpoint that called the method
+            "commands": array of the commands made (collection, operation, duration_ms, docs, shape)
+            "explain": the query plan of the slowest command (docs_examined, docs_returned, indexes, collscan, ...)
+        },
+        ...
+    ]
+
+    Returns 200 OK or a JSON with "error" set to an associated message.
+    """
+    if not server_auth.is_admin():
+        return err('User must be an admin to view slow queries', 403)
+    try:
+        limit = int(flask.request.args.get('limit', 50))
+    except ValueError:
+        return err('limit must be a positive integer')
+    if limit < 1:
+        return err('limit must be a positive integer')
+    db = db_connect.get_db()
+    return api_json.response(db.fetch_slow_queries(min(limit, 200)))
+
+@blueprint.route("/api/admin/notifications")
+def api_admin_notifications():
+    """
+    Fetches the delivery ledger of the most recent notification fan-outs.
+
+    The user must be an administrator to perform this action.
+
+    GET request takes the following parameters:
+    "limit": integer, the maximum number of fan-outs to return (default 50, at most 200)
+    "board_id": string, only return fan-outs of this board (optional)
+    "post_id": string, only return the fan-out of this post (optional)
+
+    Returns an array of fan-outs, most recent first:
+    [
+        {
+            "post_id": string, the post notified about
+            "board_id": string, the board of the post
+            "recipients": integer, number of push subscriptions targeted
+            "sent", "failed", "pruned", "retried": integer, number of pushes by result
+            "queued", "started", "finished": string, when the fan-out was queued, started and finished
+            "queue_ms", "fanout_ms", "total_ms": number, time spent queued, fanning out and in total
+            "services": array of push services with their "origin", "pushes", counts by result,
+                        "avg_latency_ms" and "max_latency_ms"
+        },
+        ...
+    ]
+
+    Returns 200 OK or a JSON with "error" set to an associated message.
+    """
+    if not server_auth.is_admin():
+        return err('User must be an admin to view the notification ledger', 403)
+    try:
+        limit = int(flask.request.args.get('limit', 50))
+        board_id = flask.request.args.get('board_id')
+        post_id = flask.request.args.get('post_id')
+        board_id = ObjectId(board_id) if board_id else None
+        post_id = ObjectId(post_id) if post_id else None
+    except ValueError:
+        return err('limit must be a positive integer')
+    except bson.errors.InvalidId:
+        return err('Invalid board_id or post_id')
+    if limit < 1:
+        return err('limit must be a positive integer')
+    db = db_connect.get_db()
+    entries = db.fetch_fanout_ledger(min(limit, 200), board_id, post_id)
+    return api_json.response([notif_ledger.ledger_summary(e) for e in entries])
+
 @blueprint.route("/api/board")
+@db_monitor.round_trip_budget(5)
 def api_board():
     """
     Fetches information about a board.
@@ -227,6 +328,8 @@ def api_board():
         "upvoted": boolean, whether the user has upvoted it or not
     }
 
+    Answers 304 if the If-None-Match header holds the ETag of the current board.
+
     Returns 200 OK or a JSON with "error" set to an associated message.
     """
     db = db_connect.get_db()
@@ -236,31 +339,30 @@ def api_board():
         return err('Must provide a board id')
     except bson.errors.InvalidId: #given id was not proper
         return err('Given id is not valid')
+    userid = server_auth.get_curr_userid()
+    #"subscribed" and "upvoted" depend on the viewer, so the ETag does too
+    etag = api_etags.make_etag(db.fetch_versions([board_id]).get(board_id), userid)
+    if (unchanged := api_etags.not_modified(etag)):
+        return unchanged
     obj = db.fetch_board(board_id) #query the db for the board
     if not obj: #if board does not exist, return 404 error
         return err('Could not find board %s' % board_id, 404)
-    #if the user is logged in, check if user is subscribed to this board
-    username = server_auth.get_curr_username()
-    user = db.fetch_user(None, username)
-    if not user: #if user is not logged in, they are not subscribed
-        subscribed = False
-    else:
-        subs = user['subscriptions']
-        #subscriptions are stored as a list of board ids
-        subscribed = board_id in subs
+    #if the user is logged in, check if user is a member of this board
+    #members are stored as a list of user ids, so the user need not be fetched
+    subscribed = userid is not None and userid in obj.get('board_members', [])
     posts = obj["board_posts"]
     #construct an object to be sent to the frontend with board information
     board = {
         'board_id': str(obj['_id']),
         'board_name': obj['board_name'],
         'board_description': obj['board_description'],
-        'board_date': str(obj['board_date']),
+        'board_date': obj['board_date'],
         'board_vote_threshold': obj['board_vote_threshold'],
         'board_member_count': obj['board_member_count'],
         "subscribed": subscribed,
         "posts": posts
     }
-    return json_util.dumps(board)
+    return api_etags.tagged(api_json.response(board), etag)
 
 @blueprint.route("/api/board/create", methods=["POST"])
 def api_board_add():
@@ -311,7 +413,7 @@ def api_board_add():
         #or the user could not be found
         return err(e)
     ret = {'board_id': str(val)} #construct the return object
-    return flask.jsonify(ret)
+    return api_json.response(ret)
 
 @blueprint.route("/api/board/subscribe", methods=["POST"])
 def api_board_subscribe():
@@ -421,6 +523,7 @@ def api_board_purge():
     """
 
 @blueprint.route("/api/post")
+@db_monitor.round_trip_budget(8)
 def api_post():
     """
     Fetches information about a post.
@@ -450,6 +553,8 @@ def api_post():
         "comment_upvotes": integer, number of raw upvotes
     }
 
+    Answers 304 if the If-None-Match header holds the ETag of the current post.
+
     Returns 200 OK or a JSON with "error" set to an associated message.
     """
     args = flask.request.args
@@ -461,18 +566,20 @@ def api_post():
     except bson.errors.InvalidId: #fail if arg is invalid
         return err('Given id is not valid')
     db = db_connect.get_db()
+    user_id = server_auth.get_curr_userid()
+    #the post's stamp changes with its votes, its comments and its owner's name
+    etag = api_etags.make_etag(db.fetch_versions([post_id]).get(post_id), board_id, user_id)
+    if (unchanged := api_etags.not_modified(etag)):
+        return unchanged
     obj = db.fetch_post(board_id, post_id)
     if not obj: #fail if post does not exist
         return err('Could not find post', 404)
     comments = db.fetch_comments(post_id)
     upvoted = False
     #if user is logged in, determine whether user has upvoted post
-    if server_auth.is_authenticated():
-        username = server_auth.get_curr_username()
-        user = db.fetch_user(None, username)
-        user_id = user['_id']
+    if user_id is not None:
         upvotes = obj['post_upvoters']
-        upvoted = ObjectId(user_id) in upvotes
+        upvoted = user_id in upvotes
     owner = db.fetch_user(userid=obj['post_owner'], user_name=None)
     owner_username = owner['username']
     #build post object from object returned by db
@@ -487,7 +594,7 @@ def api_post():
         "post_notified": obj['post_notified'],
         "upvoted": upvoted
     }
-    return json_util.dumps(post)
+    return api_etags.tagged(api_json.response(post), etag)
 
 @blueprint.route("/api/post/create", methods=["POST"])
 def api_post_create():
@@ -534,7 +641,7 @@ def api_post_create():
     ret = db.create_post(None, username, board_id, subject, description)
     if not ret:
         return err('Could not create post', 404)
-    return flask.jsonify({'post_id': str(ret)})
+    return api_json.response({'post_id': str(ret)})
 
 @blueprint.route("/api/post/delete", methods=["POST"])
 def api_post_delete():
@@ -587,6 +694,8 @@ def api_post_purge():
     pass # TODO
 
 @blueprint.route("/api/post/upvote", methods=["POST"])
+# Claims check, the upvote, its version stamps (see AppDB.touch_versions) and queueing the notification
+@db_monitor.round_trip_budget(4)
 def api_post_upvote():
     """
     Upvotes a post. Triggers a notification if it passes the board vote threshold.
@@ -613,23 +722,24 @@ def api_post_upvote():
         return err('Must provide board and post ids')
     except bson.errors.InvalidId:
         return err('Given id is not valid')
-    username = server_auth.get_curr_username()
+    userid = server_auth.get_curr_userid() #from the session claims, saving a user lookup
+    if userid is None:
+        return err('Could not find user', 404)
     db = db_connect.get_db()
-    ret = db.upvote_post(None, username, board_id, post_id)
+    # The vote that crosses the threshold marks the post as notified in the same write,
+    # so concurrent votes cannot notify twice
+    ret = db.upvote_post_atomic(userid, None, board_id, post_id)
     if not ret:
         return err('Could not upvote post', 404)
-    board = db.fetch_board(board_id)
-    post = db.fetch_post(board_id, post_id)
-    threshold = int(board['board_vote_threshold'])
-    upvotes = int(post['post_upvotes'])
-    subscribers = int(board['board_member_count'])
-    #notify if not already notified and upvote ratio exceeds threshold
-    #upvotes/subscribers >= threshold/100
-    #multiply both sides by (100*subscribers) to get:
-    if (upvotes * 100) >= (subscribers * threshold):
-        if not post['post_notified']:
-            server_notifs.do_push_notifications(board_id, post_id)
-            db.notify_post(board_id, post_id)
+    _, crossed = ret
+    if crossed:
+        resp = server_notifs.do_push_notifications(board_id, post_id)
+        if isinstance(resp, tuple) and server_notifs.push_configured():
+            # The dispatcher could not take the notification, so the post is unmarked for a
+            # later vote or the threshold sweep to notify it. Without VAPID keys there is no
+            # push to send, and the post stays notified
+            db.unnotify_post(board_id, post_id)
+            return resp
     return Response(status=200)
 
 @blueprint.route("/api/post/upvote/cancel", methods=["POST"])
@@ -699,7 +809,7 @@ def api_comment_create():
     ret = db.add_comment(None, username, board_id, post_id, message)
     if not ret:
         return err('Could not create comment', 404)
-    return flask.jsonify({'comment_id': str(ret)})
+    return api_json.response({'comment_id': str(ret)})
 
 @blueprint.route("/api/comment/upvote", methods=["POST"])
 def api_comment_upvote():
@@ -764,3 +874,81 @@ def api_comment_delete():
     if not ret:
         return err('Could not delete comment', 404)
     return Response(status=200)
+
+@blueprint.route("/api/tokens", methods=["GET", "POST"])
+def api_tokens_manage():
+    """
+    Lists or creates the API tokens of the user. API clients send a token with the
+    "Authorization: Bearer <token>" header instead of logging in (see api_tokens.py).
+
+    Tokens can only be created from a logged in session, not with another token.
+
+    GET returns the following payload:
+    [
+        {
+            "token_id": string, unique ID of the token
+            "name": string, name of the token
+            "created": string, creation date of the token
+        },
+        ...
+    ]
+
+    POST request takes in the following payload:
+    {
+        "name": name of the token, with 100 char limit
+    }
+
+    POST returns the following payload:
+    {
+        "token_id": the ID of the new token
+        "token": the bearer token. It is only shown this once
+    }
+
+    Returns 200 OK or a JSON with "error" set to an associated message.
+    """
+    if not server_auth.is_authenticated():
+        return err('Must be logged in to manage API tokens', 403)
+    userid = server_auth.get_curr_userid()
+    if userid is None:
+        return err('Could not find user', 404)
+    db = server_auth.get_token_db()
+    if flask.request.method == "GET":
+        return api_json.response([{
+            'token_id': str(t['_id']),
+            'name': t['name'],
+            'created': t['created'].isoformat()
+        } for t in db.fetch_api_tokens(userid)])
+    if server_auth.get_api_token() is not None:
+        return err('API tokens must be created from a logged in session', 403)
+    name = flask.request.form.get('name', '')
+    if not name or len(name) > 100:
+        return err('Name must be a string with 1-100 characters')
+    token_id = db.add_api_token(userid, name)
+    return api_json.response({'token_id': str(token_id),
+                          'token': api_tokens.make_token(server_auth.get_token_secret(), token_id)})
+
+@blueprint.route("/api/tokens/revoke", methods=["POST"])
+def api_tokens_revoke():
+    """
+    Revokes one of the user's API tokens.
+
+    POST request takes in the following payload:
+    {
+        "token_id": the ID of the token
+    }
+
+    Returns 200 OK or a JSON with "error" set to an associated message.
+    """
+    if not server_auth.is_authenticated():
+        return err('Must be logged in to revoke an API token', 403)
+    try:
+        token_id = ObjectId(flask.request.form['token_id'])
+    except KeyError:
+        return err('Must provide a token id')
+    except bson.errors.InvalidId:
+        return err('Given id is not valid')
+    userid = server_auth.get_curr_userid()
+    if userid is None or not db_connect.get_db().revoke_api_token(userid, token_id):
+        return err('Could not find token', 404)
+    server_auth.get_token_cache().revoke(token_id)
+    return Response(status=200)
@@ -1,22 +1,27 @@
 # Handles user authentication and account creation
 
 
+import threading
+import time
+
 # Import helper functions from Flask
 import flask
 from flask import render_template, request, session, redirect, url_for, flash
 
-# Import helper functions from passlib for password hashing
-from passlib.hash import sha256_crypt as pwd_context
-
 # Import helper functions from flask login for user auth
 import flask_login
 from flask_login import login_required, logout_user, UserMixin, fresh_login_required, login_user
+from flask_httpauth import HTTPTokenAuth
 from flask_wtf import FlaskForm as Form
 from wtforms import BooleanField, StringField, validators, PasswordField
+from bson.objectid import ObjectId
 
 # Import our modules
+import api_tokens
 import db_connect
 import config
+import password_hasher
+import server_metrics
    
 class LoginForm(Form):
     """
@@ -57,28 +62,58 @@ def get_salt(base_string: str):
     """
     return base_string.replace(" ", "")[:16].zfill(16)
 
+# The password hasher of this process, created on first use
+_hasher = None
+_hasher_lock = threading.Lock()
+
+def get_hasher():
+    """
+    Fetches the process's password hasher, creating it on first use so that its worker
+    processes start in the server process that uses them
+
+    Returns:
+     - A PasswordHasher
+    """
+    global _hasher
+    with _hasher_lock:
+        if _hasher is None:
+            _hasher = password_hasher.PasswordHasher(
+                processes=int(config.get("password_processes", 1)),
+                max_pending=int(config.get("password_max_pending", 8)),
+                rounds=int(config.get("password_rounds", password_hasher.DEFAULT_ROUNDS)))
+        return _hasher
+
 def hash_password(password):
     """
-    Hashes a given password using SHA256
+    Hashes a given password using SHA256, in the process's password hasher
 
     Parameters:
      - password: the cleartext password to hash
     Returns:
       - The newly hashed password
+    Error: raises PasswordHasherBusy if too many passwords are being hashed already
     """
-    return pwd_context.hash(password, salt=get_salt(config.get("secret_key", "super secret")))
+    return get_hasher().hash(password, get_salt(config.get("secret_key", "super secret")))
 
 def verify_password(password, hashVal):
     """
-    Verifies a password matches a given hash
+    Verifies a password matches a given hash, in the process's password hasher
 
     Parameters:
      - password: the password in cleartext to verify
      - hashVal: The hashed password to verify against
     Returns:
      - Whether the passwords match
+    Error: raises PasswordHasherBusy if too many passwords are being hashed already
     """
-    return pwd_context.verify(password, hashVal)
+    return get_hasher().verify(password, hashVal)
+
+def busy_response(template: str, form):
+    """
+    Re-renders a form page with a 503 when the password hasher is at capacity
+    """
+    flash("The server is busy. Please try again in a few seconds", "error")
+    return render_template(template, form=form, username=""), 503, {"Retry-After": "5"}
 
 
 # The blueprint for Flask to load in the main server file
@@ -87,6 +122,13 @@ blueprint = flask.Blueprint("auth_blueprint", __name__)
 # The Flask login manager
 login_manager = flask_login.LoginManager()
 
+# Authenticates API clients with bearer tokens (see api_tokens.py)
+token_auth = HTTPTokenAuth(scheme="Bearer")
+
+# The claims of the tokens this process has seen, created on first use
+_token_cache = None
+_token_cache_lock = threading.Lock()
+
 @blueprint.record_once
 def on_load(state):
     """
@@ -112,23 +154,99 @@ class UserObject(UserMixin):
         return str(self.username)
 
 
-def is_admin():
+def make_claims(user: dict):
+    """
+    Builds the session claims of a user: their id, whether they are an administrator and
+    the version of these claims (see the users collection in db.py)
+
+    Parameters:
+     - user: the user entry
+    Returns:
+     - The claims, ready to be stored in the (signed) session cookie
+    """
+    admins = db_connect.get_db().fetch_admins()
+    return {
+        "uid": str(user["_id"]),
+        "name": user["username"],
+        # Decided that if no admins present, all users have admin privileges
+        "admin": len(admins) == 0 or any(a["username"] == user["username"] for a in admins),
+        "version": user.get("claims_version", 0),
+        "checked": time.time(),
+    }
+
+def check_claims(claims: dict):
     """
-    Returns whether the user is an administrator
+    Checks claims against the user's current claims version with a single read, rebuilding them if they changed
+
+    Returns:
+     - The up to date claims, or None if the user no longer exists
+    """
+    db = db_connect.get_db()
+    if db.fetch_claims_version(ObjectId(claims["uid"])) == claims["version"]:
+        return dict(claims, checked=time.time())
+    user = db.fetch_user(None, claims["name"])
+    return make_claims(user) if user else None
+
+def get_claims(verify: bool = False):
+    """
+    Fetches the session claims of the current user. The claims are trusted as they are for
+    "session_claims_seconds"; after that, a single read of the user's claims version tells
+    whether they must be rebuilt
+
+    Parameters:
+     - verify: check the claims version even within "session_claims_seconds", for
+       decisions that must not lag behind a change (such as admin rights)
+    Returns:
+     - The claims ("uid", "name", "admin", "version", "checked"), or None if the user is not
+       logged in or no longer exists
     """
-    # Check if they are even logged in first
     if not is_authenticated():
-        return False
+        return None
+    if "claims" in flask.g:
+        if not verify or flask.g.claims is None or flask.g.get("claims_verified"):
+            return flask.g.claims # Already known, or set by the bearer token
+        if "api_token" in flask.g:
+            # Set by the bearer token, from the token cache
+            flask.g.claims = check_claims(flask.g.claims)
+            flask.g.claims_verified = True
+            get_token_cache().put(flask.g.api_token, flask.g.claims)
+            return flask.g.claims
+    username = get_curr_username()
+    claims = session.get("claims")
+    db = db_connect.get_db()
+    fresh = (not verify and claims is not None and claims.get("name") == username
+             and time.time() - claims["checked"] <= float(config.get("session_claims_seconds", 30)))
+    server_metrics.record_cache("session_claims", fresh) # A hit needs no database read
+    if claims is None or claims.get("name") != username:
+        user = db.fetch_user(None, username)
+        claims = make_claims(user) if user else None
+    elif not fresh:
+        claims = check_claims(claims)
+    if claims is None:
+        session.pop("claims", None)
+    elif session.get("claims") != claims:
+        session["claims"] = claims
+    flask.g.claims = claims
+    flask.g.claims_verified = not fresh
+    return claims
 
-    # get the list of current admins
-    admins = db_connect.get_db().fetch_admins()
-    if len(admins) == 0:
-        return True # Decided that if no admins present, all users have admin privileges
+def is_admin():
+    """
+    Returns whether the user is an administrator. The claims version is always checked,
+    so that revoked rights take effect right away
+    """
+    claims = get_claims(verify=True)
+    return claims is not None and claims["admin"]
+
+def get_curr_userid():
+    """
+    Fetches the user ID of the current user from the session claims
 
-    for admin in admins: # Check all admins
-        if flask_login.current_user.get_id() == admin["username"]:
-            return True
-    return False
+    Returns:
+     - The user ID, or None if the user is not logged in or no longer exists
+    """
+    claims = get_claims()
+    return ObjectId(claims["uid"]) if claims is not None else None
 
 def is_authenticated():
     """
@@ -151,6 +269,81 @@ def user_loader(username):
     """
     return UserObject(username)
 
+def get_token_secret():
+    """
+    Returns the secret API tokens are signed with
+    """
+    return config.get("api_token_secret", config.get("secret_key", "super secret"))
+
+# Whether this process has set up the API token collection
+_tokens_ready = False
+
+def get_token_db():
+    """
+    Fetches the database, making sure the API token collection is set up (indexes created) once per process
+    """
+    global _tokens_ready
+    db = db_connect.get_db()
+    if not _tokens_ready:
+        db.ensure_api_tokens()
+        _tokens_ready = True
+    return db
+
+def get_token_cache():
+    """
+    Fetches the process's cache of token claims, creating it on first use
+    """
+    global _token_cache
+    with _token_cache_lock:
+        if _token_cache is None:
+            _token_cache = api_tokens.TokenCache(float(config.get("api_token_cache_seconds", 60)))
+        return _token_cache
+
+@token_auth.verify_token
+def verify_token(token):
+    """
+    Verifies a bearer token and makes its claims the claims of the request
+
+    Parameters:
+     - token: the bearer token
+    Returns:
+     - A UserObject for the token's user, or None if the token is invalid or revoked
+    """
+    token_id = api_tokens.parse_token(get_token_secret(), token)
+    if token_id is None:
+        return None
+    cache = get_token_cache()
+    found, claims = cache.get(token_id)
+    if not found:
+        db = db_connect.get_db()
+        entry = db.fetch_api_token(token_id)
+        user = db.fetch_user(entry["userid"], None) if entry else None
+        claims = make_claims(user) if user else None
+        cache.put(token_id, claims)
+    if claims is None:
+        return None
+    flask.g.claims = claims
+    flask.g.api_token = token_id
+    return UserObject(claims["name"])
+
+@login_manager.request_loader
+def request_loader(request):
+    """
+    Loads the user of a request carrying a bearer token instead of a session.
+    This is only used internally by Flask-Login
+    """
+    auth = token_auth.get_auth()
+    if auth is None:
+        return None
+    return verify_token(auth["token"])
+
+def get_api_token():
+    """
+    Returns the ID of the bearer token the request was authenticated with, or None for sessions
+    """
+    is_authenticated()
+    return flask.g.get("api_token")
+
 @blueprint.route("/register.html", methods=["GET", "POST"])
 def register():
     """
@@ -168,7 +361,10 @@ def register():
             user = db_connect.get_db().fetch_user(userid=None, user_name = username)
             #if the user isnt found, hash the password and register the new user      
             if user.get('username') is None:
-                hashed_pass = hash_password(password)
+                try:
+                    hashed_pass = hash_password(password)
+                except password_hasher.PasswordHasherBusy:
+                    return busy_response("register.html", form)
                 new_id = db_connect.get_db().add_user(user_name = request.form["username"], password = hashed_pass)
                 session['username'] = request.form['username']
                 flash("Account successfully created. Please log in", "info")
@@ -201,11 +397,17 @@ def login():
             user = db_connect.get_db().fetch_user(userid=None, user_name = username)
             #if that username exits, checking the password for a match
             if user.get('username') is not None:
-                if verify_password(password, user.get('password')):
+                try:
+                    verified = verify_password(password, user.get('password'))
+                except password_hasher.PasswordHasherBusy:
+                    return busy_response("login.html", form)
+                if verified:
                     #session['username'] = username
+                    claims = make_claims(user)
                     user = UserObject(username)
                     if login_user(user, remember=True):
                         session.permanent = True
+                        session["claims"] = claims
                         flash("Welcome, " + username, "info")
                         return redirect(url_for('pages_blueprint.my_boards')) # Redirect wants function name, not endpoint
                     else:
@@ -231,5 +433,6 @@ def logout():
     Logs out the user and redirects to the home page home.html
     """
     logout_user()
+    session.pop("claims", None)
     flash("Logged out.")
     return redirect(url_for('pages_blueprint.index'))
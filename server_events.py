@@ -0,0 +1,133 @@
+"""
+Streams live board and post updates to the browser with Server-Sent Events
+
+The board and post pages open a stream to stay current instead of re-requesting the
+full board or post. Streams send the small delta events published by the AppDB write
+paths on the in-process hub (see db_events.py):
+ - "vote": {"post_id", "post_upvotes"}, a post's vote count changed
+ - "post": {"_id", "post_subject", "post_date", "post_upvotes", "post_notified"}, a new post (board streams only)
+ - "comment": {"post_id", "comment_id", "comment_username", "comment_message", "comment_date", "comment_upvotes"},
+   a new comment (post streams only)
+ - "notified": {"post_id"}, a post reached its threshold and was notified
+ - "resync": the stream missed events, the page should fetch the full document once
+
+Every stream holds a server thread while open, so each process only serves up to
+"sse_max_streams" at once, within the budget shared with notification long-polls (see
+held_threads.py), and refuses more with 503. Streams are closed after
+"sse_max_seconds" (the browser reconnects by itself), and a comment line is sent every
+"sse_heartbeat_seconds" so proxies do not time out idle streams.
+"""
+
+import threading
+import time
+
+import bson
+import flask
+from bson.objectid import ObjectId
+
+import api_json
+import config
+import db_connect
+import db_events
+import held_threads
+
+# The blueprint for Flask to load in the main server file
+blueprint = flask.Blueprint("events_blueprint", __name__)
+
+# Number of streams open in this process
+_open_streams = 0
+_streams_lock = threading.Lock()
+
+
+@blueprint.route("/api/board/events")
+def board_events():
+    """
+    Streams the events of a board and its posts.
+
+    GET request takes in the following parameters:
+    "board_id": string, unique ID of the board
+
+    Returns a text/event-stream of "vote", "post", "notified" and "resync" events,
+    or a JSON with "error" set to an associated message.
+    """
+    try:
+        board_id = ObjectId(flask.request.args["board_id"])
+    except KeyError:
+        return flask.jsonify({"error": "Must provide a board id"}), 400
+    except bson.errors.InvalidId:
+        return flask.jsonify({"error": "Given id is not valid"}), 400
+    if not db_connect.get_db().board_exists(board_id):
+        return flask.jsonify({"error": "Could not find board %s" % board_id}), 404
+    return event_stream([db_events.board_channel(board_id)])
+
+
+@blueprint.route("/api/post/events")
+def post_events():
+    """
+    Streams the events of a post.
+
+    GET request takes in the following parameters:
+    "board_id": string, unique ID of the post's board
+    "post_id": string, unique ID of the post
+
+    Returns a text/event-stream of "vote", "comment", "notified" and "resync" events,
+    or a JSON with "error" set to an associated message.
+    """
+    try:
+        board_id = ObjectId(flask.request.args["board_id"])
+        post_id = ObjectId(flask.request.args["post_id"])
+    except KeyError:
+        return flask.jsonify({"error": "Must provide a board id and post id"}), 400
+    except bson.errors.InvalidId:
+        return flask.jsonify({"error": "Given id is not valid"}), 400
+    if not db_connect.get_db().board_exists(board_id, post_id):
+        return flask.jsonify({"error": "Could not find post"}), 404
+    return event_stream([db_events.post_channel(post_id)])
+
+
+def event_stream(channels: list):
+    """
+    Opens a Server-Sent Events stream of the events published on channels
+
+    Parameters:
+     - channels: the db_events channels to stream
+    Returns:
+     - A streaming Flask response, or a 503 response if this process has too many streams open
+    """
+    global _open_streams
+    with _streams_lock:
+        if _open_streams >= int(config.get("sse_max_streams", 8)) or not held_threads.try_hold():
+            return flask.jsonify({"error": "Too many live streams, try again later"}), 503, {"Retry-After": "30"}
+        _open_streams += 1
+
+    heartbeat = float(config.get("sse_heartbeat_seconds", 15))
+    max_seconds = float(config.get("sse_max_seconds", 300))
+    subscription = db_events.subscribe(channels, int(config.get("sse_max_pending", 100)))
+    closed = []
+
+    def close():
+        # Called once the response is closed, even if the stream never started
+        global _open_streams
+        if closed:
+            return
+        closed.append(True)
+        db_events.unsubscribe(subscription)
+        with _streams_lock:
+            _open_streams -= 1
+        held_threads.release()
+
+    def generate():
+        yield "retry: 3000\n\n" # Reconnect after 3 seconds when the stream ends
+        deadline = time.monotonic() + max_seconds
+        while time.monotonic() < deadline:
+            item = subscription.get(min(heartbeat, max(0.0, deadline - time.monotonic())))
+            if item is None:
+                yield ": keep-alive\n\n"
+                continue
+            event, data = item
+            yield "event: %s\ndata: %s\n\n" % (event, api_json.dumps(data) if data is not None else "{}")
+
+    response = flask.Response(generate(), mimetype="text/event-stream",
+                              headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.call_on_close(close)
+    return response
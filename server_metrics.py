@@ -0,0 +1,147 @@
+"""
+Sets up server metrics, exposed at /metrics in the Prometheus text format
+
+The following are recorded:
+ - Request latency histograms and status code counts per endpoint
+ - Requests currently in flight
+ - Latency of every AppDB method
+ - Cache hits and misses per cache (the hit ratio is hits / (hits + misses))
+ - Notification fan-outs and the pushes sent, failed and expired
+
+Under gunicorn every worker is a separate process, so metrics are kept in the
+prometheus_client multiprocess directory (PROMETHEUS_MULTIPROC_DIR, set up by
+gunicorn.conf.py) and summed across all workers when scraped. The development server
+runs in one process and uses the default in-memory registry.
+"""
+
+import os
+import time
+
+import flask
+import prometheus_client
+from prometheus_client import multiprocess
+
+import config
+import db_monitor
+
+# The blueprint for Flask to load in the main server file
+blueprint = flask.Blueprint("metrics_blueprint", __name__)
+
+# Buckets (in seconds) shared by request and database latency histograms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUEST_LATENCY = prometheus_client.Histogram(
+    "tac_http_request_duration_seconds", "Time spent handling a request",
+    ["endpoint", "method"], buckets=LATENCY_BUCKETS)
+RESPONSES = prometheus_client.Counter(
+    "tac_http_responses_total", "Responses sent by status code",
+    ["endpoint", "status"])
+IN_FLIGHT = prometheus_client.Gauge(
+    "tac_http_requests_in_flight", "Requests currently being handled",
+    multiprocess_mode="livesum")
+DB_LATENCY = prometheus_client.Histogram(
+    "tac_db_operation_duration_seconds", "Time spent in an AppDB method",
+    ["method"], buckets=LATENCY_BUCKETS)
+CACHE_REQUESTS = prometheus_client.Counter(
+    "tac_cache_requests_total", "Cache lookups by result (hit or miss)",
+    ["cache", "result"])
+NOTIF_FANOUTS = prometheus_client.Counter(
+    "tac_notification_fanouts_total", "Posts whose notifications were fanned out to board members")
+NOTIF_PUSHES = prometheus_client.Counter(
+    "tac_notification_pushes_total", "Web pushes by result (sent, failed or expired)",
+    ["result"])
+NOTIF_RECIPIENTS = prometheus_client.Histogram(
+    "tac_notification_fanout_recipients", "Push subscriptions targeted by one fan-out",
+    buckets=(1, 10, 100, 1000, 10000, 100000))
+
+
+def enabled():
+    """
+    Returns whether metrics are recorded and exposed
+    """
+    return bool(config.get("metrics", True))
+
+
+def record_cache(cache: str, hit: bool):
+    """
+    Records a cache lookup
+
+    Parameters:
+     - cache: the name of the cache
+     - hit: whether the lookup was a hit
+    """
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def record_fanout(recipients: int):
+    """
+    Records the start of a notification fan-out
+
+    Parameters:
+     - recipients: the number of push subscriptions targeted
+    """
+    NOTIF_FANOUTS.inc()
+    NOTIF_RECIPIENTS.observe(recipients)
+
+
+def record_push(result: str, count: int = 1):
+    """
+    Records delivered web pushes
+
+    Parameters:
+     - result: one of "sent", "failed" or "expired"
+     - count: how many pushes had this result
+    """
+    NOTIF_PUSHES.labels(result).inc(count)
+
+
+def _observe_db_call(method: str, seconds: float):
+    """
+    Records the duration of an AppDB method call
+    """
+    DB_LATENCY.labels(method).observe(seconds)
+
+
+@blueprint.record_once
+def on_load(state):
+    """
+    Hooks request timing into the Flask app
+    """
+    app = state.app
+    if not enabled():
+        return
+    db_monitor.add_call_observer(_observe_db_call)
+
+    @app.before_request
+    def _start_timer():
+        flask.g.metrics_start = time.perf_counter()
+        IN_FLIGHT.inc()
+
+    @app.after_request
+    def _record_request(response):
+        start = flask.g.get("metrics_start", None)
+        if start is not None:
+            endpoint = flask.request.endpoint or "none"
+            REQUEST_LATENCY.labels(endpoint, flask.request.method).observe(time.perf_counter() - start)
+            RESPONSES.labels(endpoint, str(response.status_code)).inc()
+        return response
+
+    @app.teardown_request
+    def _end_request(error=None):
+        if flask.g.pop("metrics_start", None) is not None:
+            IN_FLIGHT.dec()
+
+
+@blueprint.route("/metrics")
+def metrics():
+    """
+    Returns all metrics in the Prometheus text format, summed across worker processes
+    """
+    if not enabled():
+        flask.abort(404)
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return flask.Response(prometheus_client.generate_latest(registry), mimetype=prometheus_client.CONTENT_TYPE_LATEST)
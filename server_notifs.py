@@ -2,20 +2,34 @@
 Sets up logic for notifications
 
 Note that we are our own push server. This means we must offload notifications to
-a separate worker thread to not stall the Flask response. Push notifications happen
-on a separate thread from that of the request's
+not stall the Flask response. Fan-outs are handed to a NotificationDispatcher owned by
+the app (see notif_dispatcher.py), which sends pushes from a bounded pool of threads
+(or an asyncio event loop, see push_async.py). With "notif_digest_seconds" set, each
+user's notifications are coalesced into one push per window (see notif_digest.py).
+With the "notif_queue" config entry set, fan-outs are instead queued in the database
+and delivered by separate notification workers (see notif_worker.py). Every notification
+also goes to the in-app inbox of each board member, which pages long-poll at
+/api/notifications (see notif_inbox.py)
 """
 
+import atexit
+import bson
 import flask
-import pywebpush
 import json
 import threading
 
-from bson import ObjectId, json_util
+from bson import ObjectId
 
+import api_json
 import config
 import db_connect
+import held_threads
 import server_auth
+import notif_digest
+import notif_dispatcher
+import notif_inbox
+import push_async
+import push_sender
 
 # The blueprint for Flask to load in the main server file
 blueprint = flask.Blueprint("notifs_blueprint", __name__)
@@ -45,20 +59,60 @@ def push_subscription():
 
         # Add or remove subscription from database
         subscription_token = flask.request.get_json().get("subscription_token", "")
-        if subscription_token is None or subscription_token == "":
+        if subscription_token is None or subscription_token == "" or not isinstance(subscription_token, dict):
             return flask.jsonify({"error": "Invalid subscription"}), 400
         action = flask.request.get_json().get("action", "remove")
-        if action == "add":
-            db_connect.get_db().add_notification(userid=None, user_name=server_auth.get_curr_username(), notification=subscription_token)
+        db = get_registry_db()
+        username = server_auth.get_curr_username()
+        if action == "add" or action == "refresh":
+            # Refreshing an unchanged subscription does not write anything
+            if db.save_push_subscription(username, subscription_token, flask.request.user_agent.string) is None:
+                return flask.jsonify({"error": "Invalid subscription"}), 400
         elif action == "remove":
-            db_connect.get_db().remove_notification(userid=None, user_name=server_auth.get_curr_username(), notification=subscription_token)
-        elif action == "refresh":
-            db_connect.get_db().remove_notification(userid=None, user_name=server_auth.get_curr_username(), notification=subscription_token)
-            db_connect.get_db().add_notification(userid=None, user_name=server_auth.get_curr_username(), notification=subscription_token)
+            db.remove_push_subscription(username, subscription_token.get("endpoint", ""))
         else:
             return flask.jsonify({"error": "Unknown action"}), 400
         return flask.Response(status=200, mimetype="application/json")
 
+@blueprint.route("/push/devices", methods=["GET"])
+def push_devices():
+    """
+    Lists the devices of the current user that receive notifications
+
+    Returns the following payload:
+    [
+        {
+            "push_service": string, origin of the device's push service
+            "user_agent": string, the browser that subscribed (may be null)
+            "created": string, date the device subscribed
+        },
+        ...
+    ]
+    """
+    if not server_auth.is_authenticated():
+        return flask.jsonify({"error": "You must be logged in to list your devices"}), 403
+    devices = get_registry_db().fetch_push_subscriptions(server_auth.get_curr_username())
+    return flask.jsonify([{
+        "push_service": push_sender.endpoint_origin(d["endpoint"]),
+        "user_agent": d.get("user_agent"),
+        "created": d["created"].isoformat() if d.get("created") else None,
+    } for d in devices])
+
+# Whether this process has set up the push subscription registry
+_registry_ready = False
+
+def get_registry_db():
+    """
+    Fetches the database, making sure the push subscription registry is set up
+    (indexes created, legacy subscriptions migrated) once per process
+    """
+    global _registry_ready
+    db = db_connect.get_db()
+    if not _registry_ready:
+        db.ensure_push_subscriptions()
+        _registry_ready = True
+    return db
+
 @blueprint.route("/push/test", methods=["POST"])
 def push_test():
     """
@@ -71,6 +125,69 @@ def push_test():
         return flask.jsonify({"error": "Bad payload"}), 400
     return do_push_notifications(board_id=ObjectId(board_id), post_id=ObjectId(post_id))
 
+# Guards creating the app's dispatcher
+_dispatcher_lock = threading.Lock()
+
+def get_dispatcher(vapid_email: str, private_key: str):
+    """
+    Fetches the notification dispatcher of the current app, creating it on first use.
+    It is created lazily so that its threads start in the worker process that uses it
+
+    Parameters:
+     - vapid_email: the email of the VAPID key
+     - private_key: the private VAPID key
+    Returns:
+     - The app's NotificationDispatcher
+    """
+    app = flask.current_app._get_current_object()
+    with _dispatcher_lock:
+        dispatcher = app.extensions.get("notif_dispatcher")
+        if dispatcher is None:
+            dispatcher = notif_dispatcher.NotificationDispatcher(
+                db_link=config.get("db_link", ""),
+                send=send_web_push,
+                vapid_email=vapid_email,
+                private_key=private_key,
+                fanout_workers=int(config.get("notif_fanout_workers", 2)),
+                send_workers=int(config.get("notif_send_workers", 16)),
+                queue_size=int(config.get("notif_queue_size", 100)),
+                fanout_concurrency=int(config.get("notif_fanout_concurrency", 8)),
+                submit_timeout=float(config.get("notif_submit_timeout", 0.5)),
+                engine=get_push_engine(vapid_email, private_key),
+                digest=get_push_digest(),
+                inbox_bytes=get_inbox_bytes(),
+                sweep_interval=float(config.get("notif_sweep_seconds", 60)))
+            app.extensions["notif_dispatcher"] = dispatcher
+            # Let queued notifications go out before the process exits
+            atexit.register(dispatcher.shutdown, float(config.get("notif_drain_timeout", 30)))
+        return dispatcher
+
+def push_configured():
+    """
+    Returns whether the VAPID keys needed to send web pushes are configured
+    """
+    return config.get("vapid_email", "") != "" and config.get("vapid_private_key", "") != ""
+
+def start_dispatcher():
+    """
+    Starts the app's dispatcher on the first request of each process, so that its threshold
+    sweeps run even before any vote crosses a threshold. Nothing is started when
+    notifications are queued for the notification workers, which sweep instead
+    """
+    if config.get("notif_queue", False) or not push_configured():
+        return
+    if float(config.get("notif_sweep_seconds", 60)) > 0:
+        get_dispatcher(config.get("vapid_email", ""), config.get("vapid_private_key", ""))
+
+def init_app(app):
+    """
+    Hooks starting the notification dispatcher into the Flask app
+
+    Parameters:
+     - app: the Flask app
+    """
+    app.before_first_request(start_dispatcher)
+
 def do_push_notifications(board_id: ObjectId, post_id: ObjectId):
     """
     Performs the action of notifying all users of a post. This is an expensive operation but will return immediately
@@ -82,6 +199,10 @@ def do_push_notifications(board_id: ObjectId, post_id: ObjectId):
      - A Flask response that can be immediately returned to the client
     """
 
+    if not push_configured():
+        # Nothing else delivers the notification without push, so it only goes to the inboxes
+        write_inbox(board_id, post_id)
+
     # Valid VAPID credentials
     vapid_email = config.get("vapid_email", "")
     if vapid_email == "":
@@ -90,40 +211,193 @@ def do_push_notifications(board_id: ObjectId, post_id: ObjectId):
     if private_key == "":
         return flask.jsonify({"error": "Server does not have a valid VAPID private key"}), 503
 
-    # Define function to run in worker thread (expensive)
-    db_obj = db_connect.get_db()
-    def _push_notif_worker(board_id, post_id, vapid_email, private_key):
-        post = db_obj.fetch_post(board_id, post_id)
-        msg = post.get("post_subject", "Unknown post subject")
-        board = db_obj.fetch_board(board_id)
-        board_members = board.get("board_members", [])
-        for m in board_members:
-            member = db_obj.fetch_user(userid=m, user_name=None)
-            subscriptions = member.get("notification", [])
-            for s in subscriptions:
-                payload = {
-                    "board_id": board_id,
-                    "post_id": post_id,
-                    "username": str(member["username"]),
-                    "board_name": str(board["board_name"]),
-                    "message": msg
-                }
-                try:
-                    send_web_push(s, json_util.dumps(payload), vapid_email, private_key)
-                except pywebpush.WebPushException as e:
-                    if "subscription has unsubscribed or expired" in str(e):
-                        # Remove the subscription for the future
-                        db_obj.remove_notification(userid=None, user_name=member["username"], notification=s)
-
-    # Setup thread (daemon) worker and start it
-    t = threading.Thread(target=_push_notif_worker, args=(board_id, post_id, vapid_email, private_key,), daemon=True)
-    t.start()
+    if config.get("notif_queue", False):
+        # Queue the fan-out for the notification workers
+        db_connect.get_db().enqueue_notif_job(board_id, post_id)
+        return flask.Response(status=200, mimetype="application/json")
+
+    # Hand the fan-out to the dispatcher (expensive, runs on its threads)
+    try:
+        get_dispatcher(vapid_email, private_key).submit(board_id, post_id)
+    except notif_dispatcher.DispatcherFull as e:
+        return flask.jsonify({"error": str(e)}), 503
 
     # Finally, send back a proper response
     return flask.Response(status=200, mimetype="application/json")
 
 
-def send_web_push(subscription_information, payload, vapid_email, private_key):
+# Push senders by (VAPID email, private key), shared by every thread of the process
+_senders = {}
+_senders_lock = threading.Lock()
+
+def get_push_sender(vapid_email: str, private_key: str):
+    """
+    Fetches the process's push sender for a VAPID key, creating it on first use
+
+    Parameters:
+     - vapid_email: The email of the VAPID key
+     - private_key: The private VAPID key
+    Returns:
+     - A PushSender
+    """
+    with _senders_lock:
+        sender = _senders.get((vapid_email, private_key))
+        if sender is None:
+            sender = push_sender.PushSender(vapid_email, private_key,
+                                            ttl=int(config.get("notif_ttl", 0)),
+                                            pool_size=int(config.get("notif_send_workers", 16)))
+            _senders[(vapid_email, private_key)] = sender
+        return sender
+
+def get_push_engine(vapid_email: str, private_key: str):
+    """
+    Creates an asyncio push engine if the "notif_engine" config entry asks for one
+
+    Parameters:
+     - vapid_email: The email of the VAPID key
+     - private_key: The private VAPID key
+    Returns:
+     - An AsyncPushEngine, or None if pushes are sent from threads
+    """
+    if config.get("notif_engine", "threads") != "async":
+        return None
+    return push_async.AsyncPushEngine(
+        get_push_sender(vapid_email, private_key),
+        origin_concurrency=int(config.get("notif_origin_concurrency", 100)),
+        max_retries=int(config.get("notif_push_retries", 3)),
+        max_retry_after=float(config.get("notif_max_retry_after", 60)),
+        encrypt_processes=int(config.get("notif_encrypt_processes", 0)))
+
+def get_push_digest():
+    """
+    Creates a digest coalescer if the "notif_digest_seconds" config entry enables digest mode
+
+    Returns:
+     - A DigestCoalescer, or None if every post is pushed on its own
+    """
+    window = float(config.get("notif_digest_seconds", 0))
+    if window <= 0:
+        return None
+    return notif_digest.DigestCoalescer(
+        window,
+        ttl=int(config.get("notif_ttl", 0)),
+        urgency=config.get("notif_digest_urgency", "normal"))
+
+def get_inbox_bytes():
+    """
+    Returns the size of the in-app notification inbox, 0 if the "notif_inbox_bytes" config
+    entry disables it
+    """
+    return int(config.get("notif_inbox_bytes", 256 * 1024 * 1024))
+
+# Whether this process has set up the inbox collection
+_inbox_ready = False
+
+def write_inbox(board_id: ObjectId, post_id: ObjectId):
+    """
+    Adds a post's notification to the inbox of every member of its board from the calling
+    thread, for when no dispatcher or worker runs to do it (push is not configured)
+
+    Parameters:
+     - board_id: The board ID of the post
+     - post_id: The post ID of the post
+    """
+    global _inbox_ready
+    if get_inbox_bytes() <= 0:
+        return
+    db = db_connect.get_db()
+    if not _inbox_ready:
+        db.ensure_notif_inbox(get_inbox_bytes())
+        _inbox_ready = True
+    found = db.fetch_notification_post(board_id, post_id)
+    if found is not None:
+        notif_inbox.add_post(db, found[0], found[1])
+
+# Guards creating the app's inbox watcher
+_inbox_lock = threading.Lock()
+
+def get_inbox_watcher():
+    """
+    Fetches the inbox watcher of the current app, creating it on first use so that its
+    thread starts in the worker process that uses it
+
+    Returns:
+     - The app's InboxWatcher
+    """
+    app = flask.current_app._get_current_object()
+    with _inbox_lock:
+        watcher = app.extensions.get("notif_inbox")
+        if watcher is None:
+            db_connect.get_db().ensure_notif_inbox(get_inbox_bytes())
+            watcher = notif_inbox.InboxWatcher(config.get("db_link", ""))
+            app.extensions["notif_inbox"] = watcher
+        return watcher
+
+@blueprint.route("/api/notifications", methods=["GET"])
+def api_notifications():
+    """
+    Long-polls the current user's notification inbox
+
+    GET request takes the following parameters:
+    "after": string, optional, ID of the last notification seen. Without it, the latest notifications
+             are returned right away
+    "timeout": number, optional, seconds to wait for a new notification (capped by the
+               "notif_inbox_poll_seconds" config entry, its default)
+
+    Returns the following payload, once there are notifications after "after" or the timeout passed:
+    {
+        "notifications": [
+            {
+                "_id": string, ID of the notification
+                "board_id": string, board of the post
+                "post_id": string, post that reached its vote threshold
+                "board_name": string, name of the board
+                "message": string, subject of the post
+                "date": date the notification was added
+            },
+            ...
+        ], oldest first
+        "after": string, ID to pass as "after" on the next poll
+    }
+    """
+    if not server_auth.is_authenticated():
+        return flask.jsonify({"error": "You must be logged in to read your notifications"}), 403
+    if get_inbox_bytes() <= 0:
+        return flask.jsonify({"error": "The notification inbox is disabled"}), 404
+    after = flask.request.args.get("after")
+    try:
+        after = ObjectId(after) if after else None
+        max_wait = float(config.get("notif_inbox_poll_seconds", 25))
+        timeout = min(max_wait, max(0.0, float(flask.request.args.get("timeout", max_wait))))
+    except bson.errors.InvalidId:
+        return flask.jsonify({"error": "Given id is not valid"}), 400
+    except ValueError:
+        return flask.jsonify({"error": "Timeout must be a number"}), 400
+
+    db = db_connect.get_db()
+    username = server_auth.get_curr_username()
+    watcher = get_inbox_watcher()
+    # Each waiting poll holds a server thread, so past the limits polls return right away
+    if after is None or watcher.waiting() >= int(config.get("notif_inbox_max_waiters", 8)):
+        timeout = 0
+    holding = timeout > 0 and held_threads.try_hold()
+    event = watcher.wait(username)
+    try:
+        notifications = db.fetch_inbox(username, after)
+        if not notifications and holding and event.wait(timeout):
+            notifications = db.fetch_inbox(username, after)
+    finally:
+        watcher.done(username, event)
+        if holding:
+            held_threads.release()
+
+    if notifications:
+        after = notifications[-1]["_id"]
+    elif after is None:
+        after = ObjectId() # The inbox is empty, later notifications come after now
+    return api_json.response({"notifications": notifications, "after": after})
+
+def send_web_push(subscription_information, payload, vapid_email, private_key, headers=None):
     """
     Sends a single web push notification to one end client
 
@@ -132,13 +406,6 @@ def send_web_push(subscription_information, payload, vapid_email, private_key):
      - payload: The message string to send off
      - vapid_email: The email of the VAPID key
      - private_key: The private VAPID key
+     - headers: Extra headers for the push service, such as Topic or Urgency
     """
-    #print("Attempting to send message", message_body, "to", subscription_information)
-    return pywebpush.webpush(
-        subscription_info=subscription_information,
-        data=payload,
-        vapid_private_key=private_key,
-        vapid_claims={
-            "sub": f"mailto: {vapid_email}"
-        }
-    )
+    return get_push_sender(vapid_email, private_key).send(subscription_information, payload, headers)
@@ -55,7 +55,48 @@ $(document).ready(function () {
         }
     });
 
+    function refreshSlowQueries() {
+        let list = document.getElementById("slow-query-list");
+        let succ = function (data) {
+            list.innerHTML = "";
+            data.forEach(function (entry) {
+                let explain = entry["explain"] || {};
+                let slowest = explain["collection"] ? explain["collection"] + "." + explain["operation"] : "-";
+                let plan = explain["error"] || (explain["stages"] || []).join(" < ");
+                if (explain["indexes"] && explain["indexes"].length > 0) plan += " (" + explain["indexes"].join(", ") + ")";
+                let cells = [
+                    new Date(entry["date"]).toLocaleString("en-us"),
+                    entry["method"],
+                    entry["endpoint"] || "-",
+                    entry["duration_ms"],
+                    slowest,
+                    (explain["docs_examined"] ?? "-") + " / " + (explain["docs_returned"] ?? "-"),
+                    plan
+                ];
+                let row = document.createElement("tr");
+                cells.forEach(function (value) {
+                    let cell = document.createElement("td");
+                    cell.className = "p-2";
+                    cell.textContent = value;
+                    row.appendChild(cell);
+                });
+                if (explain["collscan"]) row.className = "text-red-500";
+                // Show the query shapes of every command when hovering the row
+                row.title = (entry["commands"] || []).map(function (c) {
+                    return c["collection"] + "." + c["operation"] + " " + c["duration_ms"] + "ms " + (c["shape"] || "");
+                }).join("\n");
+                list.appendChild(row);
+            });
+        }
+        let error = function (err) {
+            display_error("Failed to refresh slow queries: " + get_error(err));
+        }
+        fetch_slow_queries(50, succ, error);
+    }
+
     document.getElementById("btn-refresh-admins").addEventListener("click", refreshAdmins);
+    document.getElementById("btn-refresh-slow-queries").addEventListener("click", refreshSlowQueries);
 
     refreshAdmins();
+    refreshSlowQueries();
 });
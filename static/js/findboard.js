@@ -19,7 +19,7 @@ $(document).ready(function () {
                 $("#noboards_div").hide()
                 data.forEach(function(board) {
 
-                    let board_id = board["_id"]["$oid"];
+                    let board_id = board["_id"];
 
                     let b_succ = function(data) {
                         // Setup board
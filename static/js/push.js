@@ -84,10 +84,27 @@ function update_subscription_on_server(subscription, action) {
 		data: JSON.stringify({"subscription_token": subscription, "action": action}),
 		success: function(response) {
 			console.log("Subscription update accepted");
+			if (action === "remove") {
+				localStorage.removeItem('pushSubscriptionRefreshed');
+			} else {
+				// Remember which subscription the server has, so page loads need not refresh it
+				localStorage.setItem('pushSubscriptionRefreshed', JSON.stringify({"endpoint": subscription.endpoint, "username": $USERNAME, "time": Date.now()}));
+			}
 		}
 	});
 }
 
+// How often an unchanged subscription is refreshed on the server
+const SUBSCRIPTION_REFRESH_MS = 24 * 60 * 60 * 1000;
+
+function needs_refresh(subscription) {
+	// Whether the server may not have this subscription yet, for the user logged in now
+	const refreshed = JSON.parse(localStorage.getItem('pushSubscriptionRefreshed') || "null");
+	return refreshed === null || refreshed.endpoint !== subscription.endpoint
+		|| refreshed.username !== $USERNAME
+		|| Date.now() - refreshed.time > SUBSCRIPTION_REFRESH_MS;
+}
+
 
 function subscribe_user() {
     // Sets up the subscription
@@ -173,8 +190,10 @@ function init_push() {
 	sw_reg.pushManager.getSubscription()
 		.then(function(subscription) {
 			is_subscribed = !(subscription === null);
+			// Without push notifications, show the in-app ones while the page is open
+			if (!is_subscribed && $USERNAME) watch_inbox();
 
-			if (subscription !== null) {
+			if (subscription !== null && needs_refresh(subscription)) {
 				// Refresh subscription server-side
 				update_subscription_on_server(subscription, "refresh");
 			}
@@ -208,8 +227,12 @@ if ('serviceWorker' in navigator) {
                 sw_reg.active.postMessage(JSON.stringify({key: $USERNAME}));
 		}).catch(function(error) {
 			console.error('Service Worker Error', error);
+			if ($USERNAME) watch_inbox();
 		});
 	});
 } else {
     init_buttons();
+    window.addEventListener('load', function() {
+        if ($USERNAME) watch_inbox();
+    });
 }
@@ -95,6 +95,25 @@ function remove_admin(username, success, error) {
     });
 }
 
+//fetches the most recent slow database calls
+//only succeeds if called by an admin
+function fetch_slow_queries(limit, success, error) {
+    //use default callbacks if none given
+    if (!success) success = printer;
+    if (!error) error = printer;
+    var data = {limit: limit};
+    //send GET request to server with parameter
+    jQuery.ajax({
+        type: "GET",
+        url: $SCRIPT_ROOT + "/api/admin/slowqueries",
+        contentType: "application/json; charset=utf-8",
+        dataType: "json",
+        data: data,
+        success: success,
+        error: error
+    });
+}
+
 //fetches information about a specific board
 function fetch_board(board_id, success, error) {
     //use default callbacks if none given
@@ -334,3 +353,64 @@ function delete_comment(post_id, comment_id, success, error) {
         error: error
     });
 }
+
+//opens a live stream of events from the server (see server_events.py)
+//handlers maps event names to functions called with the event's data
+function watch_events(path, params, handlers) {
+    //without EventSource support the page simply does not update live
+    if (!window.EventSource) return null;
+    let source = new EventSource($SCRIPT_ROOT + path + "?" + jQuery.param(params));
+    Object.keys(handlers).forEach(function(event) {
+        source.addEventListener(event, function(e) {
+            handlers[event](JSON.parse(e.data));
+        });
+    });
+    return source;
+}
+
+//streams the "vote", "post", "notified" and "resync" events of a board
+function watch_board(board_id, handlers) {
+    return watch_events("/api/board/events", {board_id: board_id}, handlers);
+}
+
+//streams the "vote", "comment", "notified" and "resync" events of a post
+function watch_post(board_id, post_id, handlers) {
+    return watch_events("/api/post/events", {board_id: board_id, post_id: post_id}, handlers);
+}
+
+//escapes text to be shown as HTML
+function escape_html(text) {
+    return $("<div>").text(text).html();
+}
+
+//long-polls the user's in-app notification inbox (see notif_inbox.py) and shows each
+//new notification, for browsers that do not receive push notifications
+function watch_inbox() {
+    let after = null;
+    function poll() {
+        let params = after === null ? {} : {after: after};
+        $.ajax({
+            type: "GET",
+            url: $SCRIPT_ROOT + "/api/notifications?" + jQuery.param(params),
+            dataType: "json",
+            success: function(response) {
+                //the first answer only tells where the inbox is at
+                if (after !== null) {
+                    response.notifications.forEach(function(n) {
+                        display_info("<a href=\"/viewpost.html?board=" + n["board_id"] + "&post="
+                            + n["post_id"] + "\">" + escape_html(n["board_name"]) + ": "
+                            + escape_html(n["message"]) + "</a>");
+                    });
+                }
+                after = response.after;
+                //an empty answer means the poll timed out or the server is too busy to wait
+                setTimeout(poll, response.notifications.length ? 0 : 5000);
+            },
+            error: function(err) {
+                //stop when logged out or the inbox is disabled, otherwise back off
+                if (err.status !== 403 && err.status !== 404) setTimeout(poll, 10000);
+            }
+        });
+    }
+    poll();
+}
@@ -137,6 +137,10 @@ self.addEventListener('push', function(event) {
             let board_id = data["board_id"]["$oid"];
             let post_id = data["post_id"]["$oid"];
             let url = "/viewpost.html?board=" + board_id + "&post=" + post_id;
+            if (data["digest"]) {
+                // A digest of several posts, possibly on several boards
+                url = "/myboards.html";
+            }
 
             const options = {
                 body: msg,
@@ -145,6 +149,11 @@ self.addEventListener('push', function(event) {
                     url: url
                 }
             };
+            if (data["digest"]) {
+                // A newer digest replaces the one still on screen
+                options.tag = "digest";
+                options.renotify = true;
+            }
 
             return self.registration.showNotification(title, options);
         } else {
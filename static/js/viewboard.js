@@ -26,12 +26,12 @@ $(document).ready(function () {
                         let is_notified = post["post_notified"];
                         if ((is_notified && showNotif.checked) || (!is_notified && showNotNotif.checked)) {
 
-                            let post_id = post["_id"]["$oid"];
+                            let post_id = post["_id"];
 
                             let clone = template.content.cloneNode(true);
                             let title = clone.querySelector("#post_title");
                             title.innerHTML = post["post_subject"];
-                            let post_date = new Date(post["post_date"]["$date"]); // Assume server time uses UTC
+                            let post_date = new Date(post["post_date"]); // ISO 8601 date in UTC
                             let dt = clone.querySelector("#creation_date");
                             dt.innerHTML = post_date.toLocaleDateString("en-us") + " " + post_date.toLocaleTimeString("en-us");
                             let link = clone.querySelector("#post_link");
@@ -116,6 +116,37 @@ $(document).ready(function () {
             // Fetch posts
             fetch_board(board_id, success, error);
 
+            // Keep posts current with live events instead of fetching the board again
+            let find_post = function(post_id) {
+                return posts.find(post => post["_id"] === post_id);
+            };
+            watch_board(board_id, {
+                vote: function(data) {
+                    let post = find_post(data["post_id"]);
+                    if (post) {
+                        post["post_upvotes"] = data["post_upvotes"];
+                        display_posts();
+                    }
+                },
+                post: function(data) {
+                    if (!find_post(data["_id"])) {
+                        posts.push(data);
+                        display_posts();
+                    }
+                },
+                notified: function(data) {
+                    let post = find_post(data["post_id"]);
+                    if (post) {
+                        post["post_notified"] = 1;
+                        post["post_upvotes"] = -1;
+                        display_posts();
+                    }
+                },
+                resync: function() {
+                    fetch_board(board_id, success, error);
+                }
+            });
+
             // Setup UI elements
             document.getElementById("create-new-post").addEventListener("click", function () {
                 if (!subscribed) {
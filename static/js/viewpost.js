@@ -22,30 +22,64 @@ $(document).ready(function () {
                     document.getElementById("post-subject").innerHTML = post_data["post_subject"];
                     document.getElementById("post-username").innerHTML = post_data["post_username"];
                     document.getElementById("post-description").innerHTML = post_data["post_description"];
-                    let post_date = new Date(post_data["post_date"]["$date"]); // Assume server time uses UTC
+                    let post_date = new Date(post_data["post_date"]); // ISO 8601 date in UTC
                     document.getElementById("post-date").innerHTML = post_date.toLocaleDateString("en-us") + " " + post_date.toLocaleTimeString("en-us");
 
                     // Update board-related UI
                     document.getElementById("board-name").innerHTML = board_data["board_name"];
 
-                    // Update UI based on notified status
-                    if (post_data["post_notified"]) {
+                    let notified = false;
+                    let show_notified = function() {
                         // Has already been notified. Delete UI elements
-                        let pup = document.getElementById("post-upvote-percent-parent");
-                        pup.parentNode.removeChild(pup);
-                        pup = document.getElementById("post-upvote-count-parent");
-                        pup.parentNode.removeChild(pup);
+                        notified = true;
+                        ["post-upvote-percent-parent", "post-upvote-count-parent"].forEach(function(id) {
+                            let pup = document.getElementById(id);
+                            if (pup) pup.parentNode.removeChild(pup);
+                        });
 
                         let btn = document.getElementById("post-upvote");
                         btn.innerHTML = "Already notified!";
                         btn.disabled = true;
                         btn.style.cursor = "default";
+                    };
+
+                    // Update UI based on notified status
+                    if (post_data["post_notified"]) {
+                        show_notified();
                     } else {
                         let upvotes_raw = post_data["post_upvotes"];
                         let board_members = board_data["board_member_count"];
-                        let upp = Math.round(upvotes_raw / board_members * 100) + "%";
-                        document.getElementById("post-upvote-count").innerHTML = upvotes_raw;
-                        document.getElementById("post-upvote-percent").innerHTML = upp;
+                        let show_upvotes = function() {
+                            let upp = Math.round(upvotes_raw / board_members * 100) + "%";
+                            document.getElementById("post-upvote-count").innerHTML = upvotes_raw;
+                            document.getElementById("post-upvote-percent").innerHTML = upp;
+                        };
+                        show_upvotes();
+
+                        // Keep the vote count current with live events instead of fetching the post again
+                        let source = watch_post(board_id, post_id, {
+                            vote: function(data) {
+                                if (!notified) {
+                                    upvotes_raw = data["post_upvotes"];
+                                    show_upvotes();
+                                }
+                            },
+                            notified: function() {
+                                show_notified();
+                                if (source) source.close();
+                            },
+                            resync: function() {
+                                fetch_post(board_id, post_id, function(fresh) {
+                                    if (fresh["post_notified"]) {
+                                        show_notified();
+                                        if (source) source.close();
+                                    } else if (!notified) {
+                                        upvotes_raw = fresh["post_upvotes"];
+                                        show_upvotes();
+                                    }
+                                }, error);
+                            }
+                        });
 
                         let btn = document.getElementById("post-upvote");
                         if (post_data["upvoted"]) {
@@ -55,9 +89,11 @@ $(document).ready(function () {
                         } else {
                             btn.addEventListener("click", function() {
                                 let succ3 = function() {
-                                    let upp = Math.round((upvotes_raw+1) / board_members * 100) + "%";
-                                    document.getElementById("post-upvote-count").innerHTML = upvotes_raw + 1;
-                                    document.getElementById("post-upvote-percent").innerHTML = upp;
+                                    if (!notified) {
+                                        // The vote's own event may have been counted already
+                                        upvotes_raw = Math.max(upvotes_raw, post_data["post_upvotes"] + 1);
+                                        show_upvotes();
+                                    }
                                     btn.innerHTML = "Upvoted!";
                                     btn.style.cursor = "default";
                                     btn.disabled = true;
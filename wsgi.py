@@ -8,6 +8,9 @@ To deploy this app in production, run the following (replace <> accordingly):
 
     gunicorn --workers <threads> --bind 0.0.0.0:<port> wsgi:app
 
+gunicorn.conf.py in this directory is picked up automatically and sets up metrics
+collection across the worker processes
+
 """
 
 from server import app